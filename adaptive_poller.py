@@ -0,0 +1,90 @@
+import random
+import time
+
+
+"""
+Decide when a shard is read again, and how many records are asked for, from the MillisBehindLatest
+returned by every GetRecords call.
+    catching up  The consumer is more than --catch_up_lag ms behind the newest record (or the last
+                 call returned a full batch): the next call is made right away, asking for the
+                 maximum number of records, so a backlog is drained as fast as the API allows.
+    caught up    Calls are spread at --poll_rate calls per second (5 per second is the limit of
+                 GetRecords per shard), so an idle consumer does not waste calls.
+Throttled calls back off exponentially (with jitter) and other errors back off from 50 ms up to 2 s,
+instead of retrying 100 times per second. The last lag seen is kept, to be shown as a metric.
+"""
+
+
+MAX_RECORDS_PER_CALL = 10000
+GET_RECORDS_PER_SECOND = 5
+
+
+def add_poller_arguments(parser):
+    # Add the arguments used to configure the adaptive pollers to an argparse parser
+    parser.add_argument("--poll_rate", dest="poll_rate", type=float,
+                        default=GET_RECORDS_PER_SECOND, help="GetRecords calls per second and "
+                        "shard when the consumer has caught up. Default is {} (the limit of a "
+                        "shard).".format(GET_RECORDS_PER_SECOND), metavar="CALLS",)
+    parser.add_argument("--catch_up_lag", dest="catch_up_lag", type=float, default=1000,
+                        help="Read as fast as possible while the consumer is more than this "
+                        "behind the newest record. Default is 1000 ms.", metavar="MILLISECONDS",)
+
+
+class adaptive_poller(object):
+    # Pace the GetRecords calls of one shard
+    def __init__(self, rate=GET_RECORDS_PER_SECOND, period_ms=None, catch_up_lag_ms=1000,
+                 limit=MAX_RECORDS_PER_CALL):
+        # Save inputs (a period, if given, replaces the rate)
+        if period_ms is not None and period_ms >= 0:
+            self.interval = period_ms / 1000.0
+        else:
+            self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.catch_up_lag_ms = catch_up_lag_ms
+        self.limit = min(limit, MAX_RECORDS_PER_CALL)
+
+        # Create state variables
+        self.lag_ms = None
+        self.catching_up = False
+        self.backoff = 0.0
+        self.call_time = time.monotonic()
+
+        # Create statistics variables
+        self.catch_up_calls = 0
+        self.throttled_calls = 0
+        self.failed_calls = 0
+
+    def next_limit(self):
+        # Return the Limit of the next call
+        return MAX_RECORDS_PER_CALL if self.catching_up else self.limit
+
+    def call_started(self):
+        # Call it right before every GetRecords call
+        self.call_time = time.monotonic()
+
+    def succeeded(self, response, limit):
+        # Update the lag after a successful call, and return the seconds to wait for the next one
+        self.backoff = 0.0
+        self.lag_ms = response.get("MillisBehindLatest", self.lag_ms)
+        full = len(response["Records"]) >= limit
+        self.catching_up = full or (self.lag_ms is not None and self.lag_ms > self.catch_up_lag_ms)
+        if self.catching_up:
+            self.catch_up_calls += 1
+            return 0.0
+        return max(self.interval - (time.monotonic() - self.call_time), 0.0)
+
+    def throttled(self):
+        # Return the seconds to wait after a throttled call
+        self.throttled_calls += 1
+        self.backoff = min(max(2 * self.backoff, self.interval, 0.1), 5.0)
+        return self.backoff * random.uniform(0.5, 1.0)
+
+    def failed(self):
+        # Return the seconds to wait after a failed call
+        self.failed_calls += 1
+        self.backoff = min(max(2 * self.backoff, 0.05), 2.0)
+        return self.backoff
+
+    def stats(self):
+        return {"millis_behind_latest": self.lag_ms, "catching_up": self.catching_up,
+                "catch_up_calls": self.catch_up_calls, "throttled_calls": self.throttled_calls,
+                "failed_calls": self.failed_calls}
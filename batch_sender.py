@@ -0,0 +1,251 @@
+import threading
+import time
+from retry_engine import THROTTLING_ERRORS, get_error_code, is_retryable_error, retry_engine
+from metrics import metrics
+
+
+"""
+Send records into a stream in batches using PutRecords instead of one put_record call per record.
+Records are buffered and sent when the buffer reaches the PutRecords limits (500 records or 5 MB)
+or when the oldest buffered record has waited for the linger time, whatever happens first.
+This way we pay one HTTPS round trip for many records, and the added latency stays bounded by the
+linger time. Entries rejected inside a PutRecords response (usually because the shard is throttling
+us) are sent again with the retry engine, the rest of the batch is not sent twice.
+"""
+
+
+# Limits of a single PutRecords request
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+
+
+def add_batch_arguments(parser):
+    # Add the arguments used to configure a batch_sender to an argparse parser
+    parser.add_argument("--batch", dest="batch", action="store_true", help="Use it to buffer "
+                        "messages and send them in batches with PutRecords.",)
+    parser.add_argument("--linger", dest="linger", type=float, default=5,
+                        help="Maximum time a message waits in the buffer before being sent when "
+                        "--batch is used. Default is 5 ms.", metavar="MILLISECONDS",)
+
+
+class batch_sender(threading.Thread):
+    # Buffer records and send them with PutRecords from a separate thread
+    def __init__(self, kinesis_client, stream_name, linger_ms=5,
+                 max_records=MAX_RECORDS_PER_REQUEST, max_bytes=MAX_BYTES_PER_REQUEST,
+                 silent=True, retry=None, rate_limiter=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Save inputs
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.linger_s = max(linger_ms, 0) / 1000.0
+        self.max_records = min(max_records, MAX_RECORDS_PER_REQUEST)
+        self.max_bytes = min(max_bytes, MAX_BYTES_PER_REQUEST)
+        self.silent = silent
+        self.retry = retry_engine() if retry is None else retry
+        self.rate_limiter = rate_limiter
+
+        # Create buffer of (entry, size, arrival time) tuples, protected by the condition
+        self.condition = threading.Condition()
+        self.buffer = []
+        self.buffer_bytes = 0
+
+        # Create counters
+        self.records_sent = 0
+        self.records_failed = 0
+        self.bytes_sent = 0
+        self.requests = 0
+
+        # Create metrics
+        self.latency = metrics().histogram("kinesis_put_records_latency_ms",
+                                           "Latency of the put_records calls in ms")
+        self.records_out = metrics().counter("records_out_total", "Records sent")
+        self.bytes_out = metrics().counter("bytes_out_total", "Bytes of the records sent")
+        metrics().collect("batch_sender", self.stats)
+
+        # Create variable to stop thread
+        self.stop_event = threading.Event()
+
+    def make_entry(self, data, partition_key, explicit_hash_key=None):
+        # Return the PutRecords entry of a record and its size
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        size = len(data) + len(partition_key.encode("utf-8"))
+        if size > MAX_BYTES_PER_RECORD:
+            raise ValueError("Record of {} bytes exceeds the {} bytes limit.".format(
+                             size, MAX_BYTES_PER_RECORD))
+        entry = {"Data": data, "PartitionKey": partition_key}
+        if explicit_hash_key is not None:
+            entry["ExplicitHashKey"] = explicit_hash_key
+        return entry, size
+
+    def put(self, data, partition_key, explicit_hash_key=None):
+        # Add a record to the buffer, it will be sent in the next batch
+        entry, size = self.make_entry(data, partition_key, explicit_hash_key)
+        with self.condition:
+            self.buffer.append((entry, size, time.monotonic()))
+            self.buffer_bytes += size
+            # Wake up the sender to start the linger timer, or to send a full batch
+            if (len(self.buffer) == 1 or len(self.buffer) >= self.max_records or
+                    self.buffer_bytes >= self.max_bytes):
+                self.condition.notify()
+
+    def pending(self):
+        # Return number of records waiting in the buffer
+        with self.condition:
+            return len(self.buffer)
+
+    def _batch_ready(self):
+        # A batch is ready when the buffer is full or the oldest record has waited enough
+        if len(self.buffer) == 0:
+            return False
+        if len(self.buffer) >= self.max_records or self.buffer_bytes >= self.max_bytes:
+            return True
+        return time.monotonic() - self.buffer[0][2] >= self.linger_s
+
+    def _take_batch(self):
+        # Remove from the buffer as many records as fit in a single PutRecords request
+        # (must be called with the condition acquired)
+        batch = []
+        batch_bytes = 0
+        for entry, size, _ in self.buffer:
+            if len(batch) >= self.max_records or batch_bytes + size > self.max_bytes:
+                break
+            batch.append((entry, size))
+            batch_bytes += size
+        del self.buffer[:len(batch)]
+        self.buffer_bytes -= batch_bytes
+        return batch
+
+    def send_batch(self, batch):
+        # Send a list of (entry, size) tuples with PutRecords. If only some entries fail, only
+        # those are sent again (after a backoff), until they succeed or can not be retried
+        attempt = 0
+        while len(batch) > 0:
+            self.retry.wait_if_open()
+            entries = [entry for entry, _ in batch]
+            if self.rate_limiter is not None:
+                # Wait until every shard in the batch can take its part of it
+                self.rate_limiter.acquire_batch(entries)
+            self.requests += 1
+            time0 = time.monotonic()
+            try:
+                response = self.kinesis_client.put_records(StreamName=self.stream_name,
+                                                           Records=entries)
+                self.latency.observe(1000 * (time.monotonic() - time0))
+            except Exception as e:
+                error_code = get_error_code(e)
+                throttled = error_code in THROTTLING_ERRORS
+                self.retry.failure(throttled)
+                if is_retryable_error(error_code) and self.retry.acquire_retry(attempt,
+                                                                              throttled):
+                    self.retry.backoff(attempt)
+                    attempt += 1
+                    continue
+                print("Encountered an exception while trying to put {} records into "
+                      "stream '{}'.".format(len(entries), self.stream_name))
+                print("Exception: {}.".format(e))
+                self.drop(len(batch))
+                return
+
+            # Results are returned in the same order as the entries
+            failed = []
+            throttled = False
+            num_sent = 0
+            bytes_sent = 0
+            for (entry, size), result in zip(batch, response["Records"]):
+                if "ErrorCode" not in result:
+                    num_sent += 1
+                    bytes_sent += size
+                    continue
+                throttled = throttled or result["ErrorCode"] in THROTTLING_ERRORS
+                if is_retryable_error(result["ErrorCode"]):
+                    failed.append((entry, size))
+                else:
+                    print("Record dropped by stream '{}': {}.".format(self.stream_name,
+                                                                     result.get("ErrorMessage")))
+                    self.drop(1)
+            if not self.silent:
+                print("Sent {} records ({} failed) into stream '{}'.".format(
+                      len(entries), response["FailedRecordCount"], self.stream_name))
+            self.records_sent += num_sent
+            self.bytes_sent += bytes_sent
+            self.records_out.inc(num_sent)
+            self.bytes_out.inc(bytes_sent)
+            if num_sent > 0:
+                self.retry.success(num_sent)
+            if len(failed) == 0:
+                return
+            self.retry.failure(throttled)
+            if not self.retry.acquire_retry(attempt, throttled):
+                self.drop(len(failed))
+                return
+            self.retry.backoff(attempt)
+            attempt += 1
+            batch = failed
+
+    def send_now(self, records):
+        # Send a list of (data, partition key, explicit hash key) records from the calling thread,
+        # without buffering them, in as few PutRecords requests as the limits allow
+        batch = []
+        batch_bytes = 0
+        for data, partition_key, explicit_hash_key in records:
+            entry, size = self.make_entry(data, partition_key, explicit_hash_key)
+            if len(batch) >= self.max_records or batch_bytes + size > self.max_bytes:
+                self.send_batch(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append((entry, size))
+            batch_bytes += size
+        if len(batch) > 0:
+            self.send_batch(batch)
+
+    def drop(self, num_records):
+        # Count records that could not be sent
+        self.records_failed += num_records
+        self.retry.drop(num_records)
+
+    def flush(self):
+        # Send every buffered record now, from the calling thread
+        while True:
+            with self.condition:
+                if len(self.buffer) == 0:
+                    return
+                batch = self._take_batch()
+            self.send_batch(batch)
+
+    def run(self):
+        # Wait until a batch is ready and send it, until stopped
+        while not self.stop_event.is_set():
+            with self.condition:
+                while not self._batch_ready() and not self.stop_event.is_set():
+                    if len(self.buffer) == 0:
+                        self.condition.wait()
+                    else:
+                        remaining = self.linger_s - (time.monotonic() - self.buffer[0][2])
+                        self.condition.wait(max(remaining, 0))
+                if self.stop_event.is_set():
+                    break
+                batch = self._take_batch()
+            self.send_batch(batch)
+        self.flush()
+
+    def stop(self):
+        # Stop thread after sending the records still in the buffer
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        else:
+            self.flush()
+
+    def stats(self):
+        # Return a summary of what has been sent so far
+        stats = {"records_sent": self.records_sent, "records_failed": self.records_failed,
+                 "bytes_sent": self.bytes_sent, "requests": self.requests,
+                 "pending": self.pending()}
+        stats.update(self.retry.stats())
+        return stats
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from metrics import metrics
+
+
+"""
+Save the last sequence number processed in every shard, so a consumer that is restarted continues
+right after it (with AFTER_SEQUENCE_NUMBER) instead of losing what was sent while it was stopped
+(LATEST) or reading up to 24 hours of data again (TRIM_HORIZON).
+Checkpoints are kept in a SQLite database, one row per consumer name, stream and shard, so several
+consumers can share the same file. Updating a checkpoint only changes a dict in memory: a separate
+thread writes all the changes at once, in a single transaction, every --checkpoint_period ms (and
+when it is stopped). If the consumer crashes, at most that period of records is read again.
+Shards that were read to the end (closed by a split or a merge) are saved as SHARD_END, so they are
+not read again after a restart.
+"""
+
+
+SHARD_END = "SHARD_END"
+
+
+def add_checkpoint_arguments(parser):
+    # Add the arguments used to configure the checkpoint store to an argparse parser
+    parser.add_argument("--checkpoint", dest="checkpoint", default=None, help="SQLite file where "
+                        "the last sequence number read in every shard is saved, to continue from "
+                        "it when the program is restarted. If not set, there are no checkpoints.",
+                        metavar="FILE_NAME",)
+    parser.add_argument("--consumer_name", dest="consumer_name", default=None, help="Name of the "
+                        "checkpoints of this consumer (and of its enhanced fan-out consumer). "
+                        "Default is the name of the script.",
+                        metavar="NAME",)
+    parser.add_argument("--checkpoint_period", dest="checkpoint_period", type=float,
+                        default=1000, help="Period to save the checkpoints. Default is 1000 ms.",
+                        metavar="MILLISECONDS",)
+
+
+class checkpoint_store(threading.Thread):
+    # Keep the last sequence number of every shard in memory, and save them periodically
+    def __init__(self, filename, consumer_name, stream_name, period_ms=1000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Save inputs
+        self.filename = filename
+        self.consumer_name = consumer_name
+        self.stream_name = stream_name
+        self.period = max(period_ms, 0) / 1000.0
+
+        # Create checkpoints waiting to be saved (shard id -> sequence number)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+        # Create statistics variables
+        self.commits = 0
+        self.rows_written = 0
+        self.commit_time_max = 0.0
+
+        metrics().collect("checkpoint", self.stats)
+
+        # Create variable to stop thread
+        self.stop_event = threading.Event()
+
+        # Create the table if needed (connections can not be shared between threads, the thread
+        # opens its own one)
+        connection = self.connect()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS checkpoints (consumer TEXT, "
+                               "stream TEXT, shard_id TEXT, sequence_number TEXT, updated REAL, "
+                               "PRIMARY KEY (consumer, stream, shard_id))")
+        connection.close()
+
+    def connect(self):
+        # Open the database, with a write-ahead log so commits are cheap
+        connection = sqlite3.connect(self.filename)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def load(self):
+        # Return the saved checkpoints of this consumer and stream (shard id -> sequence number)
+        connection = self.connect()
+        rows = connection.execute("SELECT shard_id, sequence_number FROM checkpoints WHERE "
+                                  "consumer = ? AND stream = ?",
+                                  (self.consumer_name, self.stream_name)).fetchall()
+        connection.close()
+        return dict(rows)
+
+    def update(self, shard_id, sequence_number):
+        # Set the checkpoint of a shard, it will be saved in the next commit
+        with self.lock:
+            self.pending[shard_id] = sequence_number
+
+    def commit(self, connection):
+        # Save all the checkpoints updated since the last commit in a single transaction
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if len(pending) == 0:
+            return
+        time0 = time.monotonic()
+        now = time.time()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                                   [(self.consumer_name, self.stream_name, shard_id, sequence, now)
+                                    for shard_id, sequence in pending.items()])
+        self.commits += 1
+        self.rows_written += len(pending)
+        self.commit_time_max = max(self.commit_time_max, time.monotonic() - time0)
+
+    def run(self):
+        # Commit the checkpoints every period until stopped, and once more before finishing
+        connection = self.connect()
+        try:
+            while not self.stop_event.wait(self.period):
+                try:
+                    self.commit(connection)
+                except sqlite3.Error as e:
+                    print("Could not save checkpoints into '{}': {}.".format(self.filename, e))
+            self.commit(connection)
+        finally:
+            connection.close()
+
+    def stats(self):
+        return {"commits": self.commits, "rows_written": self.rows_written,
+                "max_commit_ms": 1000 * self.commit_time_max}
+
+    def stop(self):
+        # Stop the thread, saving the last checkpoints
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def default_consumer_name(args):
+    # Return the --consumer_name, or the name of the script if it is not set
+    if args.consumer_name is not None:
+        return args.consumer_name
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+
+def create_checkpoint_store(args, stream_name):
+    # Create and start the checkpoint store if --checkpoint is set, return None otherwise
+    if args.checkpoint is None:
+        return None
+    store = checkpoint_store(args.checkpoint, default_consumer_name(args), stream_name,
+                             period_ms=args.checkpoint_period)
+    store.start()
+    return store
@@ -0,0 +1,141 @@
+import struct
+import zlib
+import numpy as np
+
+
+"""
+Columnar format for batches of motor+encoder samples (msg_type 3), used by motor_encoder_producer.py
+for system identification runs.
+Instead of repeating the keys of every sample, a batch stores one column per field:
+    timestamp, encoder_counter, motor_counter, encoder   delta encoded, as zigzag varints
+    motor                                                 int16 array
+The header (magic byte, version, msg_type, flags, number of samples) is followed by the columns,
+compressed with zlib if the compress flag is set. Encoding and decoding are vectorized with NumPy,
+and decode_columns returns the columns as NumPy arrays.
+The magic byte is different from the one in message_codec.py, which uses this module to read
+columnar records too, so consumers can auto-detect every format.
+"""
+
+
+MAGIC = 0xB2
+VERSION = 1
+FLAG_ZLIB = 0x01
+HEADER_FORMAT = "<BBBBI"  # magic, version, msg_type, flags, number of samples
+COLUMNS = [("timestamp", "delta"), ("encoder_counter", "delta"), ("motor_counter", "delta"),
+           ("encoder", "delta"), ("motor", "<i2")]
+MAX_VARINT_BYTES = 10
+
+_header_struct = struct.Struct(HEADER_FORMAT)
+
+
+class ColumnarError(ValueError):
+    pass
+
+
+def add_columnar_arguments(parser):
+    # Add the arguments used to choose the columnar format to an argparse parser
+    parser.add_argument("--columnar", dest="columnar", action="store_true", help="Use it to send "
+                        "every batch of samples as columns (delta and varint encoded) instead of "
+                        "a list of messages.",)
+    parser.add_argument("--compress", dest="compress", action="store_true", help="Use it to "
+                        "compress the columnar batches with zlib.",)
+
+
+def is_columnar(data):
+    # Return True if a record contains a columnar batch
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode_varints(values):
+    # Encode an array of uint64 values as varints (7 bits per byte, lowest bits first)
+    values = np.asarray(values, dtype=np.uint64)
+    shifts = np.arange(MAX_VARINT_BYTES, dtype=np.uint64) * np.uint64(7)
+    groups = (values[:, None] >> shifts[None, :]) & np.uint64(0x7F)
+    num_bytes = np.maximum(np.sum((values[:, None] >> shifts[None, :]) > 0, axis=1), 1)
+    used = np.arange(MAX_VARINT_BYTES)[None, :] < num_bytes[:, None]
+    last = np.arange(MAX_VARINT_BYTES)[None, :] == (num_bytes - 1)[:, None]
+    groups[used & ~last] |= np.uint64(0x80)
+    return groups[used].astype(np.uint8).tobytes()
+
+
+def decode_varints(data, count, offset=0):
+    # Decode count varints starting at offset, return them (as uint64) and the end offset
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64), offset
+    buffer = np.frombuffer(data, dtype=np.uint8, offset=offset)
+    ends = np.flatnonzero(buffer < 0x80)[:count]
+    if len(ends) < count:
+        raise ColumnarError("Truncated varint column at byte {}.".format(offset))
+    buffer = buffer[:ends[-1] + 1].astype(np.uint64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_index = np.repeat(np.arange(count), ends - starts + 1)
+    shifts = (np.arange(len(buffer)) - starts[value_index]).astype(np.uint64) * np.uint64(7)
+    values = np.add.reduceat((buffer & np.uint64(0x7F)) << shifts, starts)
+    return values, offset + len(buffer)
+
+
+def zigzag(values):
+    # Map signed int64 values to uint64, so small negative numbers stay small
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values):
+    # Inverse of zigzag
+    values = np.asarray(values, dtype=np.uint64)
+    return ((values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64))
+
+
+def encode_columns(samples, msg_type=3, compress=False):
+    # Pack a list of sample dicts (the motor+encoder messages) into a columnar batch
+    parts = []
+    for name, encoding in COLUMNS:
+        column = np.array([sample.get(name, 0) for sample in samples], dtype=np.int64)
+        if encoding == "delta":
+            parts.append(encode_varints(zigzag(np.diff(column, prepend=np.int64(0)))))
+        else:
+            parts.append(column.astype(encoding).tobytes())
+    body = b"".join(parts)
+    flags = 0
+    if compress:
+        body = zlib.compress(body)
+        flags |= FLAG_ZLIB
+    return _header_struct.pack(MAGIC, VERSION, msg_type, flags, len(samples)) + body
+
+
+def decode_columns(data):
+    # Return a dict with the msg_type and a NumPy (int64) array for every column of a batch
+    if len(data) < _header_struct.size:
+        raise ColumnarError("Truncated columnar header.")
+    magic, version, msg_type, flags, count = _header_struct.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ColumnarError("Unsupported columnar batch (magic {}, version {}).".format(magic,
+                                                                                       version))
+    body = data[_header_struct.size:]
+    if flags & FLAG_ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise ColumnarError("Could not decompress columnar batch: {}.".format(e))
+    columns = {"msg_type": msg_type}
+    offset = 0
+    for name, encoding in COLUMNS:
+        if encoding == "delta":
+            deltas, offset = decode_varints(body, count, offset)
+            columns[name] = np.cumsum(unzigzag(deltas))
+        else:
+            size = np.dtype(encoding).itemsize * count
+            if len(body) - offset < size:
+                raise ColumnarError("Truncated column '{}'.".format(name))
+            columns[name] = np.frombuffer(body, dtype=encoding, count=count,
+                                          offset=offset).astype(np.int64)
+            offset += size
+    return columns
+
+
+def decode_messages(data):
+    # Return the samples of a batch as a list of message dicts, like message_codec.decode_all
+    columns = decode_columns(data)
+    names = [name for name, _ in COLUMNS]
+    rows = zip(*(columns[name].tolist() for name in names))
+    return [dict(zip(names, row), msg_type=columns["msg_type"]) for row in rows]
@@ -0,0 +1,94 @@
+from record_aggregator import deaggregate_records
+from message_codec import decode_all, peek_msg_type
+from metrics import metrics
+
+
+"""
+Keep only the newest command of every (msg_type, device) in a batch of records, for the consumers
+that drive an actuator. After a backlog (a consumer that was stopped, or a slow network), a batch
+can have hundreds of goal positions or speeds, and only the last one matters: replaying the others
+moves the motor through stale setpoints before reaching the current one.
+The records are read from the newest to the oldest, and the msg_type of a record with a single
+message is found from its header (binary) or with a search in its text (json), without decoding
+it. Records whose key was already seen in a newer record are skipped, so only the records that are
+applied are decoded. The device is the partition key of the record (producers that use the
+'device' or 'hash' partition strategies send every device with its own key).
+With --replay, every message is returned in order, like before.
+"""
+
+
+DEVICE_KEYS = ["partition_key", "none"]
+
+
+def add_conflation_arguments(parser):
+    # Add the arguments used to configure a conflator to an argparse parser
+    parser.add_argument("--replay", dest="replay", action="store_true", help="Use it to apply "
+                        "every command received, in order, instead of only the newest one of "
+                        "every message type and device in each batch.",)
+    parser.add_argument("--device_key", dest="device_key", default=DEVICE_KEYS[0],
+                        choices=DEVICE_KEYS, help="How the device of every record is found: "
+                        "its partition key, or none (all records come from the same device). "
+                        "Default is '{}'.".format(DEVICE_KEYS[0]), metavar="DEVICE_KEY",)
+
+
+class conflator(object):
+    # Return the newest message of every (msg_type, device) of a batch of records
+    def __init__(self, enabled=True, device_key="partition_key"):
+        if device_key not in DEVICE_KEYS:
+            raise ValueError("Unknown device key '{}'.".format(device_key))
+
+        # Save inputs
+        self.enabled = enabled
+        self.device_key = device_key
+
+        # Create statistics variables
+        self.records = 0
+        self.decoded = 0
+        self.skipped = 0
+        self.superseded = 0
+        metrics().collect("conflation", self.stats)
+
+    def device(self, record):
+        # Return the device that sent a record
+        if self.device_key == "partition_key":
+            return record.get("PartitionKey")
+        return None
+
+    def conflate(self, records):
+        # Return the messages to apply from the records returned by get_records (or pushed by
+        # SubscribeToShard), oldest first
+        return [obj for _, obj in self.conflate_records(records)]
+
+    def conflate_records(self, records):
+        # Like conflate, but return (record, message) pairs, to know where every message came from
+        records = deaggregate_records(records)
+        self.records += len(records)
+        if not self.enabled:
+            self.decoded += len(records)
+            return [(record, obj) for record in records for obj in decode_all(record["Data"])]
+        newest = {}
+        for record in reversed(records):
+            device = self.device(record)
+            msg_type = peek_msg_type(record["Data"])
+            if msg_type is not None and (msg_type, device) in newest:
+                # Superseded by a newer record, it does not need to be decoded
+                self.skipped += 1
+                continue
+            self.decoded += 1
+            for obj in reversed(decode_all(record["Data"])):
+                key = (obj.get("msg_type"), device)
+                if key in newest:
+                    self.superseded += 1
+                else:
+                    newest[key] = (record, obj)
+        # Keys were added from the newest to the oldest message
+        return list(reversed(list(newest.values())))
+
+    def stats(self):
+        return {"records": self.records, "decoded": self.decoded, "skipped": self.skipped,
+                "superseded": self.superseded}
+
+
+def create_conflator(args):
+    # Create a conflator from the parsed arguments
+    return conflator(enabled=not args.replay, device_key=args.device_key)
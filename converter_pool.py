@@ -0,0 +1,351 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import time
+from batch_sender import batch_sender
+from retry_engine import create_retry_engine
+from record_aggregator import deaggregate_records
+from partition_keys import create_partitioner
+from message_codec import timestamp_now
+from message_dispatcher import message_dispatcher
+from kinesis_session import connect_to_stream, create_kinesis_client, prewarm
+from stream_metadata import find_stream_shards, metadata_cache
+from stream_reader import parent_ids, stream_reader
+from checkpoint_store import create_checkpoint_store
+
+
+"""
+Run encoder_motor_converter.py in several processes (--processes), so one host can convert the
+messages of a fleet of motors using all its cores.
+The open shards of the input stream are split between the worker processes (at most one process
+per shard), and every closed shard goes with its first child, so its records are still read
+before the ones of its children. Every worker reads its shards with a stream_reader, and
+transforms its batches with motor_transform.py (NumPy is only imported by the workers), keeping the
+last motor value sent to every device (the partition key of its records).
+The goal position is the same for every device, like when the converter runs in a single
+process (goal messages do not say which device they are for). The goal records are in a single
+shard, so the worker that reads them shares the goal with the other workers through the
+supervisor (a value in shared memory), and they use it from their next batch. PID messages (type
+4) are ignored, like in a single process: their gains are not in the units of the P gain of the
+converter (motor value per degree).
+A supervisor (the main process) restarts the workers that die, and every --rebalance_period
+seconds lists the shards again: if they have changed (a split or a merge), all workers are stopped
+and started again with the new assignment. Use --checkpoint, so the restarted workers continue
+right after the last record processed (a merge whose parents were assigned to different workers
+can be read slightly out of order during the change).
+"""
+
+
+def add_pool_arguments(parser):
+    # Add the arguments used to run the converter in several processes to an argparse parser
+    parser.add_argument("--processes", dest="processes", type=int, default=None, help="Number "
+                        "of worker processes, each one converting the messages of a group of "
+                        "shards (0 uses one per CPU). If not set, everything runs in this "
+                        "process.", metavar="PROCESSES",)
+    parser.add_argument("--rebalance_period", dest="rebalance_period", type=float, default=30,
+                        help="Period to check the shards of the input stream and rebalance the "
+                        "processes if they changed. Default is 30 s.", metavar="SECONDS",)
+
+
+class device_converter(object):
+    # Transform the encoder messages of every device into motor messages, keeping the state of
+    # every device
+    def __init__(self, args, kinesis_client_out, sender=None, goal=None, p_constant=255 / 180,
+                 invert_motor=True):
+        # Save inputs
+        self.args = args
+        self.stream_name_out = args.stream_out_name
+        self.p_constant = p_constant
+        self.invert_motor = invert_motor
+        # Goal position of every device, shared by every worker (a multiprocessing Value)
+        self.goal = goal
+        self.goal_pos = 0 if goal is None else goal.value
+
+        # Choose how records are spread over the shards of the output stream
+        self.partitioner = create_partitioner(args, kinesis_client_out, self.stream_name_out,
+                                              default_key="123")
+        # Send the motor messages of every batch with PutRecords, or put them in the buffer of
+        # the batch sender if there is one
+        self.sender = sender
+        self.batch_writer = batch_sender(kinesis_client_out, self.stream_name_out,
+                                         retry=create_retry_engine(args))
+
+        # Timestamps are added to every message in the format of the output messages
+        if args.binary or args.ns_timestamps:
+            self.now = timestamp_now
+        else:
+            self.now = lambda: str(datetime.datetime.now())
+
+        # Create state of every device (partition key of its records)
+        self.devices = {}
+
+        # Route the goals and encoder messages that are not in binary records
+        self.dispatcher = message_dispatcher(args.period)
+        self.dispatcher.register(2, self.update_goal)
+        self.dispatcher.register(0, self.transform_messages)
+
+        # Create statistics variables
+        self.messages_sent = 0
+        self.errors = 0
+
+    def device(self, partition_key):
+        # Return the state of a device, creating it the first time
+        state = self.devices.get(partition_key)
+        if state is None:
+            state = {"value": None, "messages": 0}
+            self.devices[partition_key] = state
+        return state
+
+    def update_goal(self, messages):
+        # Update the goal position with the newest message of type 2, and share it
+        self.goal_pos = messages[-1][1]["value"]
+        if self.goal is not None:
+            self.goal.value = self.goal_pos
+
+    def read_goal(self):
+        # Use the goal shared by the worker that read the newest goal message
+        if self.goal is not None:
+            self.goal_pos = self.goal.value
+
+    def transform_messages(self, messages):
+        # Encoder messages that were not read by decode_encoder_records
+        from motor_transform import encoder_batch_from_messages
+        self.transform(encoder_batch_from_messages(messages), self.now())
+
+    def process(self, shard_id, response):
+        # Callback of the stream_reader: apply goals and gains, then transform the encoder
+        # messages of the batch at once, and wait the pacing period
+        from motor_transform import decode_encoder_records
+        timestamp2 = self.now()
+        self.read_goal()
+        batch, others = decode_encoder_records(deaggregate_records(response["Records"]))
+        self.dispatcher.route(self.dispatcher.decode(others))
+        if len(batch) > 0:
+            self.transform(batch, timestamp2)
+        self.dispatcher.pace()
+
+    def transform(self, batch, timestamp2):
+        # Transform a batch of encoder messages with the goal position, and send the motor
+        # messages
+        from motor_transform import encode_motor_messages, p_transform
+        states = [self.device(key) for key in batch.partition_keys]
+        values = p_transform(batch.values, self.goal_pos, self.p_constant, self.invert_motor)
+        records = []
+        for data, key, state, value in zip(encode_motor_messages(batch, values, timestamp2,
+                                                                 self.now(), self.args.binary),
+                                           batch.partition_keys, states, values.tolist()):
+            state["value"] = value
+            state["messages"] += 1
+            # The partition key of the encoder record identifies the device
+            partition = self.partitioner.partition(msg_type=1, device=key)
+            records.append((data, partition["PartitionKey"], partition.get("ExplicitHashKey")))
+        try:
+            if self.sender is not None:
+                for record in records:
+                    self.sender.put(*record)
+            else:
+                self.batch_writer.send_now(records)
+            self.messages_sent += len(records)
+        except Exception as e:
+            self.errors += 1
+            print("Encountered an exception while trying to put {} records into stream "
+                  "'{}'.".format(len(records), self.stream_name_out))
+            print("Exception: {}.".format(e))
+
+    def stats(self):
+        return {"devices": len(self.devices), "messages_sent": self.messages_sent,
+                "errors": self.errors}
+
+
+def converter_worker(args, shard_ids, stop_event, goal=None):
+    # Main function of a worker process: convert the messages of some shards until stopped
+    # (every process creates its own clients, they can not be shared between processes). Only
+    # the supervisor serves the metrics, every worker saves them in its own file
+    args = argparse.Namespace(**vars(args))
+    args.metrics_port = None
+    if args.metrics_file is not None:
+        args.metrics_file = "{}.{}".format(args.metrics_file, shard_ids[0])
+    kinesis_client_out = create_kinesis_client(args.region_out, args)
+    prewarm(kinesis_client_out, args.stream_out_name, args.prewarm)
+    sender = None
+    if args.batch:
+        sender = batch_sender(kinesis_client_out, args.stream_out_name, linger_ms=args.linger,
+                              retry=create_retry_engine(args))
+        sender.start()
+    converter = device_converter(args, kinesis_client_out, sender, goal)
+
+    kinesis_client = create_kinesis_client(args.region_in, args)
+    checkpoint = create_checkpoint_store(args, args.stream_in_name)
+    reader = stream_reader(kinesis_client, args.stream_in_name, converter.process, "LATEST",
+                           checkpoint=checkpoint, poll_rate=args.poll_rate,
+                           catch_up_lag_ms=args.catch_up_lag, prefetch=args.prefetch,
+                           shard_ids=shard_ids)
+    try:
+        reader.start()
+        while not stop_event.is_set() and not reader.wait(0.1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.stop()
+        if checkpoint is not None:
+            checkpoint.stop()
+        if sender is not None:
+            sender.stop()
+    print("Worker {} finished: {}.".format(os.getpid(), converter.stats()))
+
+
+def assign_shards(shards, processes):
+    # Split the shards between processes: the open shards are dealt in order of their hash keys,
+    # and every closed shard goes with its first descendant. Return a list of shard id lists
+    by_id = {s["ShardId"]: s for s in shards}
+    open_shards = sorted([s for s in shards if "EndingSequenceNumber" not in
+                          s["SequenceNumberRange"]],
+                         key=lambda s: int(s["HashKeyRange"]["StartingHashKey"]))
+    processes = max(min(processes, len(open_shards)), 1)
+    groups = [[] for _ in range(processes)]
+    assigned = set()
+    for i, shard in enumerate(open_shards):
+        # Add the shard and the ancestors that no other group has taken
+        pending = [shard["ShardId"]]
+        while len(pending) > 0:
+            shard_id = pending.pop()
+            if shard_id in assigned or shard_id not in by_id:
+                continue
+            assigned.add(shard_id)
+            groups[i % processes].append(shard_id)
+            pending.extend(parent_ids(by_id[shard_id]))
+    return [group for group in groups if len(group) > 0]
+
+
+class converter_supervisor(object):
+    # Start a worker process for every group of shards, restart the ones that die and rebalance
+    # them when the shards of the stream change
+    def __init__(self, args, kinesis_client, processes, rebalance_period=30,
+                 target=converter_worker):
+        # Save inputs
+        self.args = args
+        self.kinesis_client = kinesis_client
+        self.stream_name = args.stream_in_name
+        self.processes = processes
+        self.rebalance_period = rebalance_period
+        self.target = target
+
+        # Worker processes are started with spawn, so they do not inherit the threads and
+        # connections of this process
+        self.context = multiprocessing.get_context("spawn")
+        self.stop_event = self.context.Event()
+        # Goal position shared by every worker (kept when they are restarted)
+        self.goal = self.context.Value("d", 0.0)
+
+        # Create state: shard ids of the last assignment, and (process, shard ids) of every worker
+        self.shard_ids = None
+        self.workers = []
+
+        # Create statistics variables
+        self.restarts = 0
+        self.rebalances = 0
+
+    def start_worker(self, shard_ids):
+        process = self.context.Process(target=self.target, args=(self.args, shard_ids,
+                                                                 self.stop_event, self.goal))
+        process.daemon = True
+        process.start()
+        return process
+
+    def list_shards(self):
+        # Return the shards of the stream, asking Kinesis again
+        return metadata_cache().shards(self.kinesis_client, self.stream_name, refresh=True)
+
+    def rebalance(self, shards):
+        # Stop every worker and start them again with a new assignment of the shards
+        self.stop_workers()
+        self.stop_event.clear()
+        self.shard_ids = set(s["ShardId"] for s in shards)
+        groups = assign_shards(shards, self.processes)
+        self.workers = [(self.start_worker(group), group) for group in groups]
+        self.rebalances += 1
+        print("Started {} worker(s) for {} shard(s) of stream '{}'.".format(
+              len(groups), len(self.shard_ids), self.stream_name))
+
+    def check_workers(self):
+        # Restart the workers that died. Return True if some worker finished its shards (they
+        # were closed, so the stream must be listed again)
+        finished = False
+        workers = []
+        for process, group in self.workers:
+            if process.is_alive():
+                workers.append((process, group))
+            elif process.exitcode == 0:
+                finished = True
+            else:
+                print("Worker {} (shards {}) exited with code {}, restarting it.".format(
+                      process.pid, group, process.exitcode))
+                workers.append((self.start_worker(group), group))
+                self.restarts += 1
+        self.workers = workers
+        return finished
+
+    def run(self):
+        # Supervise the workers until interrupted
+        self.rebalance(self.list_shards())
+        next_check = time.monotonic() + self.rebalance_period
+        while True:
+            time.sleep(1.0)
+            finished = self.check_workers()
+            if not finished and time.monotonic() < next_check:
+                continue
+            next_check = time.monotonic() + self.rebalance_period
+            try:
+                shards = self.list_shards()
+            except Exception as e:
+                print("Could not list the shards of stream '{}'.".format(self.stream_name))
+                print("Exception: {}.".format(e))
+                continue
+            if set(s["ShardId"] for s in shards) != self.shard_ids:
+                print("The shards of stream '{}' changed, rebalancing the workers.".format(
+                      self.stream_name))
+                self.rebalance(shards)
+
+    def stop_workers(self, timeout=10):
+        # Stop the workers (they save their checkpoints), terminating the ones that do not stop
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process, _ in self.workers:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.workers = []
+
+    def stats(self):
+        return {"workers": len(self.workers), "restarts": self.restarts,
+                "rebalances": self.rebalances}
+
+
+def run_pool(args):
+    # Convert the messages of the input stream with several worker processes
+    stream_name_out = args.stream_out_name
+    print("Connecting to output stream '{}' in region '{}'.".format(stream_name_out,
+                                                                    args.region_out))
+    kinesis_client_out = create_kinesis_client(args.region_out, args)
+    if not connect_to_stream(kinesis_client_out, stream_name_out, args.shards):
+        return
+    stream_name_in = args.stream_in_name
+    print("Connecting to input stream '{}' in region '{}'.".format(stream_name_in, args.region_in))
+    kinesis_client = create_kinesis_client(args.region_in, args)
+    if find_stream_shards(kinesis_client, stream_name_in) is None:
+        return
+    if args.checkpoint is None:
+        print("Running without --checkpoint: records sent while the workers restart are lost.")
+
+    processes = args.processes if args.processes > 0 else os.cpu_count()
+    supervisor = converter_supervisor(args, kinesis_client, processes, args.rebalance_period)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print("Ctrl+C interrupt received, stopping the workers.")
+    finally:
+        supervisor.stop_workers()
+    print("Supervisor finished: {}.".format(supervisor.stats()))
@@ -1,10 +1,12 @@
 import argparse
 import json
-import datetime
 import time
 import numpy as np
-import boto3
-from matplotlib_utils import plotLine, plotPlotBox, plt_ion, plt_ioff
+from timestamp_utils import delays_ms_between, to_datetime64, to_ns_array
+from kinesis_session import add_session_arguments, create_kinesis_client
+from stream_metadata import find_stream_shards
+from stream_reader import stream_reader
+from adaptive_poller import add_poller_arguments
 
 
 def create_parser():
@@ -19,8 +21,8 @@ This code is really dirty, I was just trying to get some graphs fast. Don't judg
                         help="The region you'd like to make this stream in. Default is "
                         "'us-east-1'", metavar="REGION_NAME",)
     parser.add_argument("-p", "--period", dest="period", type=int, default=None,
-                        help="How often to read stream. Default is 0. This number will increase"
-                        " if the stream is read too often.", metavar="MILLISECONDS",)
+                        help="How often to read stream once it has caught up. Default is "
+                        "--poll_rate.", metavar="MILLISECONDS",)
     parser.add_argument("-t", "--timeout", dest="timeout", type=int, default=60,
                         help="When to timeout and plot results. Default waits 1 minute.",
                         metavar="SECONDS",)
@@ -32,6 +34,8 @@ This code is really dirty, I was just trying to get some graphs fast. Don't judg
                         metavar="SHARD_ITERATOR_TYPE")
     parser.add_argument("-f", "--filename", dest="filename", default="",
                         help="The name of the figures saved", metavar="FILE_NAME",)
+    add_session_arguments(parser)
+    add_poller_arguments(parser)
     return parser.parse_args()
 
 
@@ -40,118 +44,58 @@ def main():
     stream_name = args.stream_name
 
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status != "ACTIVE":
-            print("The stream '{}' has status {}, please rerun the script when the stream "
-                  "is ACTIVE.".format(stream_name))
-            return
-        else:
-            shard_id = stream_description["StreamDescription"]["Shards"][0]["ShardId"]
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("The stream '{}' was not found, please rerun the script when the stream has "
-              "been created.".format(stream_name))
+    kinesis_client = create_kinesis_client(args.region, args)
+    # Read the shards of the stream from the shared metadata cache, waiting for it to be ACTIVE
+    if find_stream_shards(kinesis_client, stream_name) is None:
         return
 
-    # If we reach this point, the string is active
-    shard_iterator_type = args.shard_iterator_type
-    shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
-                                                       ShardIteratorType=shard_iterator_type)["ShardIterator"]
+    # Save every record received (from any shard) with the time it was received
+    start_end_times = []
 
-    # Calculate termination time
-    terminate_time = datetime.datetime.now() + datetime.timedelta(seconds=args.timeout)
+    def receive(shard_id, response):
+        now_time = time.time_ns()
+        for r in response["Records"]:
+            start_end_times.append((r["Data"], now_time))
 
-    # Read stream until timeout
-    max_num_records = 10000
-    start_end_times = []
-    sleep_time = 0.0 if args.period is None else args.period / 1000.0
-    number_exceptions = 0
+    # If we reach this point, the string is active. Read all its shards until timeout
+    reader = stream_reader(kinesis_client, stream_name, receive, args.shard_iterator_type,
+                           period_ms=args.period, poll_rate=args.poll_rate,
+                           catch_up_lag_ms=args.catch_up_lag)
     try:
         print("Monitoring data in stream for {} seconds.".format(args.timeout))
-        while datetime.datetime.now() < terminate_time:
-            try:
-                records = kinesis_client.get_records(ShardIterator=shard_iterator,
-                                                     Limit=max_num_records)
-                now_time = datetime.datetime.now()
-                for r in records["Records"]:
-                    start_end_times.append((r["Data"], now_time))
-                shard_iterator = records["NextShardIterator"]  # Update shard_iterator
-                time.sleep(sleep_time)
-            except Exception as e:
-                number_exceptions += 1
-                time.sleep(0.01)
-        print("Finished data monitoring.".format(args.timeout))
-    except KeyError:
+        reader.start()
+        reader.wait(args.timeout)
+        print("Finished data monitoring.")
+    except KeyboardInterrupt:
         print("Ctrl+C interrupt received, prematurely halting data monitoring.")
+    finally:
+        reader.stop()
+    number_exceptions = reader.stats()["errors"]
 
-    # Calculate delay and print some data about them
-    delays1 = []
-    delays2 = []
-    delays3 = []
-    delays4 = []
-    delays5 = []
-    d0 = []
-    d1 = []
-    d2 = []
-    d3 = []
-    d4 = []
-    d5 = []
-    for json_obj0, date5 in start_end_times:
+    # Calculate all delays at once (timestamps in ns), and save the timestamps
+    columns = [[], [], [], [], []]
+    date5 = []
+    for json_obj0, now_time in start_end_times:
         obj = json.loads(json_obj0.decode("utf-8"))
-        time0 = obj["TIMESTAMP1"]
-        time1 = obj["TIMESTAMP2"]
-        time2 = obj["TIMESTAMP3"]
-        time3 = obj["TIMESTAMP4"]
-        time4 = obj["TIMESTAMP5"]
-        date0 = datetime.datetime.strptime(time0, "%Y-%m-%d %H:%M:%S.%f")
-        date1 = datetime.datetime.strptime(time1, "%Y-%m-%d %H:%M:%S.%f")
-        date2 = datetime.datetime.strptime(time2, "%Y-%m-%d %H:%M:%S.%f")
-        date3 = datetime.datetime.strptime(time3, "%Y-%m-%d %H:%M:%S.%f")
-        date4 = datetime.datetime.strptime(time4, "%Y-%m-%d %H:%M:%S.%f")
-        delay1 = date1 - date0
-        delay2 = date2 - date0
-        delay3 = date3 - date1
-        delay4 = date4 - date2
-        delay5 = date5 - date0
-        delays1.append(delay1)
-        delays2.append(delay2)
-        delays3.append(delay3)
-        delays4.append(delay4)
-        delays5.append(delay5)
-        d0.append(date0)
-        d1.append(date1)
-        d2.append(date2)
-        d3.append(date3)
-        d4.append(date4)
-        d5.append(date5)
-    d0 = np.array(d0)
-    d1 = np.array(d1)
-    d2 = np.array(d2)
-    d3 = np.array(d3)
-    d4 = np.array(d4)
-    d5 = np.array(d5)
-    np.save("data0", d0)
-    np.save("data1", d1)
-    np.save("data2", d2)
-    np.save("data3", d3)
-    np.save("data4", d4)
-    np.save("data5", d5)
+        for i, column in enumerate(columns):
+            column.append(obj["TIMESTAMP{}".format(i + 1)])
+        date5.append(now_time)
+    d0, d1, d2, d3, d4 = [to_ns_array(column) for column in columns]
+    d5 = np.array(date5, dtype=np.int64)
+    for i, d in enumerate([d0, d1, d2, d3, d4, d5]):
+        np.save("data{}".format(i), to_datetime64(d))
     print("Data saved")
-    delays1 = np.array(delays1)
-    delays2 = np.array(delays2)
-    delays3 = np.array(delays3)
-    delays4 = np.array(delays4)
-    delays5 = np.array(delays5)
+    delays1 = delays_ms_between(d0, d1)
+    delays3 = delays_ms_between(d1, d3)
+    delays5 = delays_ms_between(d0, d5)
+
+    # matplotlib is imported here, so monitoring starts as soon as possible
+    from matplotlib_utils import plotLine, plt_ion, plt_ioff
     plt_ion()
     c = 1
-    for delays in [delays1, delays3, delays5]:
-        delays_ms = [1000.0 * d.total_seconds() for d in delays]
-        print("Samples: {}".format(len(delays)))
-        if len(delays) == 0:
+    for delays_ms in [delays1, delays3, delays5]:
+        print("Samples: {}".format(len(delays_ms)))
+        if len(delays_ms) == 0:
             return
         print("Min: {:.3f} ms".format(np.min(delays_ms)))
         print("Max: {:.3f} ms".format(np.max(delays_ms)))
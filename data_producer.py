@@ -1,9 +1,12 @@
 import argparse
-import boto3
-import datetime
-import json
-import numpy as np
+import random
 import time
+from batch_sender import add_batch_arguments, batch_sender
+from rate_limiter import add_rate_limit_arguments, create_rate_limiter, record_size
+from retry_engine import add_retry_arguments, create_retry_engine
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from message_codec import add_codec_arguments, add_timestamp, serialize
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
 
 
 """
@@ -24,64 +27,51 @@ def create_parser():
                         metavar="MILLISECONDS",)
     parser.add_argument("-opm", "--objects_per_message", metavar="NUMBER_OBJECTS", default=1,
                         help="Default is 1.", type=int,)
+    add_batch_arguments(parser)
+    add_retry_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_codec_arguments(parser)
+    add_session_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 def main():
     args = create_parser()
 
     # Create and connect to stream
     stream_name = args.stream_name
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    if not connect_to_stream(kinesis_client, stream_name):
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
         return
+    prewarm(kinesis_client, stream_name, args.prewarm)
+
+    # Choose how records are spread over the shards of the stream
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key="SergiRamis")
+
+    # Retry throttled records instead of dropping them
+    retry = create_retry_engine(args)
+
+    # Pace records to stay just under the shard write limits, if requested
+    rate_limiter = create_rate_limiter(args, kinesis_client, stream_name)
+
+    # Start thread that sends messages in batches, if requested
+    sender = None
+    if args.batch:
+        sender = batch_sender(kinesis_client, stream_name, linger_ms=args.linger, retry=retry,
+                              rate_limiter=rate_limiter)
+        sender.start()
 
     # Create object that will be sent over and over again
     objects = []
     for i in range(args.objects_per_message):
         obj = {}
         obj["msg_type"] = 3
-        obj["encoder"] = np.random.randint(-180, 180)
-        obj["motor"] = np.random.randint(-255, 256)
-        obj["timestamp"] = str(datetime.datetime.now())
+        obj["encoder"] = random.randint(-180, 179)
+        obj["motor"] = random.randint(-255, 255)
+        add_timestamp(obj, args.binary or args.ns_timestamps)
         obj["encoder_counter"] = i * 100
         obj["motor_counter"] = i
         objects.append(obj)
@@ -89,22 +79,33 @@ def main():
     # Send encoder values into stream at args.period rate
     sleep_s = 0.0 if args.period is None or args.period < 0 else args.period / 1000.0
     counter = 0
-    while True:
-        for i in range(args.objects_per_message):
-            objects[i]["timestamp"] = str(datetime.datetime.now())
-            objects[i]["motor_counter"] = counter
-            counter += 1
-        encoder_motor_str = json.dumps(objects)
-        try:
-            kinesis_client.put_record(StreamName=stream_name, Data=encoder_motor_str,
-                                      PartitionKey="SergiRamis")
-            # print("Sent encoder message {} into stream '{}'.".format(encoder_motor_str,
-            #                                                          stream_name))
-        except Exception as e:
-            print("Encountered an exception while trying to put sensor data into "
-                  "stream '{}'.".format(stream_name))
-            print("Exception: {}.".format(e))
-        time.sleep(sleep_s)
+    try:
+        while True:
+            for i in range(args.objects_per_message):
+                add_timestamp(objects[i], args.binary or args.ns_timestamps)
+                objects[i]["motor_counter"] = counter
+                counter += 1
+            encoder_motor_str = serialize(objects, args.binary)
+            try:
+                partition = partitioner.partition(msg_type=3)
+                if sender is not None:
+                    sender.put(encoder_motor_str, partition["PartitionKey"],
+                               partition.get("ExplicitHashKey"))
+                else:
+                    if rate_limiter is not None:
+                        rate_limiter.acquire(partition, record_size(encoder_motor_str, partition))
+                    retry.call(kinesis_client.put_record, StreamName=stream_name,
+                               Data=encoder_motor_str, **partition)
+                # print("Sent encoder message {} into stream '{}'.".format(encoder_motor_str,
+                #                                                          stream_name))
+            except Exception as e:
+                print("Encountered an exception while trying to put sensor data into "
+                      "stream '{}'.".format(stream_name))
+                print("Exception: {}.".format(e))
+            time.sleep(sleep_s)
+    finally:
+        if sender is not None:
+            sender.stop()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
-import boto3
 import argparse
+from kinesis_session import add_session_arguments, create_kinesis_client
+from stream_metadata import metadata_cache
 
 def create_parser():
     parser = argparse.ArgumentParser("""
@@ -9,11 +10,12 @@ Delete all streams, or if a stream is specified, only delete that one
                         help="The region you'd like to make this stream in. Default is 'us-east-1'.", metavar="REGION_NAME",)
     parser.add_argument("-s", "--stream", dest="stream_name", default=None,
                         help="The stream you'd like to delete. If no stream is selected, delete all.", metavar="STREAM_NAME",)
+    add_session_arguments(parser)
     return parser.parse_args()
 
 def main():
     args = create_parser()
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
+    kinesis_client = create_kinesis_client(args.region, args)
     
     response = kinesis_client.list_streams()
     
@@ -23,6 +25,8 @@ def main():
             continue
         print("Deleting stream {}".format(stream_name))
         kinesis_client.delete_stream(StreamName=stream_name)
+        metadata_cache().invalidate(kinesis_client, stream_name)
+
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,17 @@
 import argparse
-import time
 import datetime
-import boto3
-import json
+from batch_sender import add_batch_arguments, batch_sender
+from record_aggregator import deaggregate_records
+from retry_engine import add_retry_arguments, create_retry_engine
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from message_codec import add_codec_arguments, serialize, timestamp_now
+from message_dispatcher import message_dispatcher
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
+from stream_metadata import find_stream_shards
+from stream_reader import add_prefetch_argument, stream_reader
+from checkpoint_store import add_checkpoint_arguments, create_checkpoint_store
+from adaptive_poller import add_poller_arguments
+from converter_pool import add_pool_arguments
 
 
 def create_parser():
@@ -26,140 +35,176 @@ controller and send it into the output stream.
                         metavar="MILLISECONDS",)
     parser.add_argument("--silent", dest="silent", action="store_true", help="Use it to mute "
                         "terminal prints every time a message is sent",)
+    parser.add_argument("--vectorized", dest="vectorized", action="store_true", help="Use it to "
+                        "transform all the encoder messages of a batch at once with NumPy, and "
+                        "send their motor messages with a single PutRecords call.",)
+    add_batch_arguments(parser)
+    add_retry_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_codec_arguments(parser)
+    add_session_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_poller_arguments(parser)
+    add_prefetch_argument(parser)
+    add_pool_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 def main():
     args = create_parser()
+    if args.processes is not None:
+        # Run one converter process per group of shards, supervised from this one
+        from converter_pool import run_pool
+        run_pool(args)
+        return
 
     # Create and connect to output stream
     stream_name_out = args.stream_out_name
     print("Connecting to output stream '{}' in region '{}'.".format(stream_name_out,
                                                                     args.region_out))
-    kinesis_client = boto3.client('kinesis', region_name=args.region_out)
-    if not connect_to_stream(kinesis_client, stream_name_out):
+    kinesis_client_out = create_kinesis_client(args.region_out, args)
+    if not connect_to_stream(kinesis_client_out, stream_name_out, args.shards):
         return
+    prewarm(kinesis_client_out, stream_name_out, args.prewarm)
+
+    # Choose how records are spread over the shards of the output stream
+    partitioner = create_partitioner(args, kinesis_client_out, stream_name_out, default_key="123")
+
+    # Retry throttled records instead of dropping them
+    retry = create_retry_engine(args)
+
+    # Start thread that sends messages in batches, if requested
+    sender = None
+    if args.batch:
+        sender = batch_sender(kinesis_client_out, stream_name_out, linger_ms=args.linger,
+                              retry=retry)
+        sender.start()
 
     # Create and connect to input stream
     stream_name_in = args.stream_in_name
     print("Connecting to input stream '{}' in region '{}'.".format(stream_name_in, args.region_in))
-    kinesis_client = boto3.client('kinesis', region_name=args.region_in)
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name_in)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status != "ACTIVE":
-            print("The stream '{}' has status {}, please rerun the script when the stream "
-                  "is ACTIVE.".format(stream_name_in))
-            return
-        else:
-            shard_id = stream_description["StreamDescription"]["Shards"][0]["ShardId"]
-    except:
-        # We assume the stream doesn't exist so we will interrupt the program
-        print("The stream '{}' was not found, please rerun the script when the stream has "
-              "been created.".format(stream_name_in))
+    kinesis_client = create_kinesis_client(args.region_in, args)
+    # Read the shards of the stream from the shared metadata cache, waiting for it to be ACTIVE
+    if find_stream_shards(kinesis_client, stream_name_in) is None:
         return
 
-    # If we reach this point, both strings are active
-    shard_iterator_type = "LATEST"
-    shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name_in,
-                                                       ShardId=shard_id,
-                                                       ShardIteratorType=shard_iterator_type)["ShardIterator"]
-
-    # Send messages from 'stream in' to 'stream out' after transforming them
-    max_num_records = 10000
-    sleep_s = 0.0 if args.period is None else args.period / 1000
+    # Send messages from 'stream in' to 'stream out' after transforming them. The period is waited
+    # once per batch
+    dispatcher = message_dispatcher(args.period)
     invert_motor = True
     p_constant = 255 / 180
     goal_pos = 0
+    # Timestamps are added to every message in the format of the output messages
+    if args.binary or args.ns_timestamps:
+        now = timestamp_now
+    else:
+        now = lambda: str(datetime.datetime.now())
     if args.silent:
-        print("Reading stream and sending data every every {} seconds.".format(sleep_s))
-    while True:
-        try:
-            records = kinesis_client.get_records(ShardIterator=shard_iterator,
-                                                 Limit=max_num_records)
-            shard_iterator = records["NextShardIterator"]  # Update shard_iterator
-        except Exception as e:
-            time.sleep(0.01)
-            continue
-
-        for record in records["Records"]:
-            # Receive object from input stream
-            json_str_in = record["Data"].decode("utf-8")
-            obj = json.loads(json_str_in)
-            obj["timestamp2"] = str(datetime.datetime.now())  # Add new timestamp
-
-            # Update goal_postion if we get a message of type 2
-            if obj["msg_type"] == 2:
-                goal_pos = obj["value"]
-
-            # If object is not encoder ob
-            if obj["msg_type"] != 0:
-                continue
+        print("Reading stream and sending data every every {} seconds.".format(dispatcher.sleep_s))
+
+    def update_goal(messages):
+        # Update goal_postion with the newest message of type 2
+        nonlocal goal_pos
+        goal_pos = messages[-1][1]["value"]
+
+    def transform(messages):
+        # Receive encoder objects (messages of type 0) from input stream (json or binary)
+        for record, obj in messages:
+            obj["timestamp2"] = now()  # Add new timestamp
 
             # Transform data
-            obj["value"] = (obj["value"] % 360)  # transform values from linear to degrees
+            # Transform values from linear to degrees
+            obj["value"] = (obj["value"] % 360)
             obj["value"] = 360 - obj["value"] if obj["value"] > 180 else obj["value"]
             obj["value"] = (obj["value"] - goal_pos) * p_constant  # P transformation
             if invert_motor:
                 obj["value"] = -obj["value"]
             obj["msg_type"] = 1  # type 1 refers to motor data
-            obj["timestamp3"] = str(datetime.datetime.now())  # Add new timestamp
+            obj["timestamp3"] = now()  # Add new timestamp
 
             # Send object in output stream
-            json_str_out = json.dumps(obj)
+            json_str_out = serialize(obj, args.binary)
 
-            # Send into stream
+            # Send into stream (or add it to the next batch)
             try:
-                kinesis_client.put_record(StreamName=stream_name_out, Data=json_str_out,
-                                          PartitionKey="123")
+                # The partition key of the encoder record identifies the device
+                partition = partitioner.partition(msg_type=1,
+                                                  device=record["PartitionKey"])
+                if sender is not None:
+                    sender.put(json_str_out, partition["PartitionKey"],
+                               partition.get("ExplicitHashKey"))
+                else:
+                    retry.call(kinesis_client_out.put_record,
+                               StreamName=stream_name_out, Data=json_str_out,
+                               **partition)
                 if not args.silent:
-                    print("Received: '{}' from stream '{}'.".format(json_str_in, stream_name_in))
-                    print("Sent:     '{}' into stream '{}'.".format(json_str_out, stream_name_out))
+                    print("Received: '{}' from stream '{}'.".format(record["Data"],
+                                                                    stream_name_in))
+                    print("Sent:     '{}' into stream '{}'.".format(json_str_out,
+                                                                    stream_name_out))
             except Exception as e:
                 print("Encountered an exception while trying to put record '{}'"
-                      " into stream '{}'.".format(stream_name_out))
-                print("Exception: {}.".format(json_str_out, e))
-
-            # Wait delay
-            time.sleep(sleep_s)
+                      " into stream '{}'.".format(json_str_out, stream_name_out))
+                print("Exception: {}.".format(e))
+
+    # The goal is updated before the encoder messages of the same batch are transformed
+    dispatcher.register(2, update_goal)
+    dispatcher.register(0, transform)
+    callback = dispatcher.dispatch
+
+    if args.vectorized:
+        # NumPy is only imported if it is used
+        from motor_transform import decode_encoder_records, encode_motor_messages, p_transform
+        # Sends the motor messages of every batch from this thread, if they are not buffered
+        batch_writer = batch_sender(kinesis_client_out, stream_name_out, retry=retry)
+
+        def transform_batch(shard_id, response):
+            timestamp2 = now()
+            batch, others = decode_encoder_records(deaggregate_records(response["Records"]))
+            # Goals (and records with mixed messages) go through the handlers first
+            dispatcher.route(dispatcher.decode(others))
+            if len(batch) > 0:
+                values = p_transform(batch.values, goal_pos, p_constant, invert_motor)
+                records = []
+                for data, key in zip(encode_motor_messages(batch, values, timestamp2, now(),
+                                                           args.binary), batch.partition_keys):
+                    # The partition key of the encoder record identifies the device
+                    partition = partitioner.partition(msg_type=1, device=key)
+                    records.append((data, partition["PartitionKey"],
+                                    partition.get("ExplicitHashKey")))
+                try:
+                    if sender is not None:
+                        for record in records:
+                            sender.put(*record)
+                    else:
+                        batch_writer.send_now(records)
+                    if not args.silent:
+                        print("Transformed {} messages from stream '{}' into stream '{}'.".format(
+                              len(records), stream_name_in, stream_name_out))
+                except Exception as e:
+                    print("Encountered an exception while trying to put {} records into stream "
+                          "'{}'.".format(len(records), stream_name_out))
+                    print("Exception: {}.".format(e))
+            dispatcher.pace()
+
+        callback = transform_batch
+
+    # If we reach this point, both strings are active. Read all shards of 'stream in'
+    # Save the last record processed in every shard, to continue from it after a restart
+    checkpoint = create_checkpoint_store(args, stream_name_in)
+    reader = stream_reader(kinesis_client, stream_name_in, callback, "LATEST",
+                           checkpoint=checkpoint, poll_rate=args.poll_rate,
+                           catch_up_lag_ms=args.catch_up_lag, prefetch=args.prefetch)
+    try:
+        reader.start()
+        reader.wait()
+    finally:
+        reader.stop()
+        if checkpoint is not None:
+            checkpoint.stop()
+        if sender is not None:
+            sender.stop()
 
 
 if __name__ == '__main__':
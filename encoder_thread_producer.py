@@ -1,10 +1,15 @@
 from RPi import GPIO
 import argparse
-import boto3
-import datetime
-import json
+import queue
 import threading
 import time
+from batch_sender import add_batch_arguments, batch_sender
+from retry_engine import add_retry_arguments, create_retry_engine
+from record_aggregator import add_aggregation_arguments, record_aggregator
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from message_codec import add_codec_arguments, add_timestamp, serialize
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
+from startup_benchmark import add_startup_arguments, report_first_sample
 
 
 """
@@ -12,6 +17,9 @@ This program will send the state of the encoder at a selected rate.
 The encoder needs to be read as fast as possible to make sure that we don't miss any frame.
 For this reason, we are using a separate thread to read the encoder and update its position,
 and we will stream such position at a periodic, lower-frequency rate.
+The position is sampled at a fixed rate and the samples are put in a bounded queue. Another thread
+empties the queue at the publishing rate and sends the samples into the stream, so a slow network
+only delays the samples but does not make them sparser.
 This code should be used in a Raspberry Pi connected to an encoder.
 
 In my case, I am using the JGA25-371 motor with encoder. This code only uses the encoder.
@@ -36,59 +44,42 @@ def create_parser():
                         help="Period to wait between every stream transmition. "
                         "If not set, data will be sent as fast as possible.",
                         metavar="MILLISECONDS",)
+    parser.add_argument("-sp", "--sample_period", dest="sample_period", type=float,
+                        help="Period between every encoder sample. If not set, the "
+                        "transmission period is used (or 10 ms if that is not set either).",
+                        metavar="MILLISECONDS",)
+    parser.add_argument("-qs", "--queue_size", dest="queue_size", type=int, default=10000,
+                        help="Maximum number of samples waiting to be sent. New samples are "
+                        "dropped while the queue is full. Default is 10000.", metavar="SAMPLES",)
+    parser.add_argument("--stats", dest="stats_period", type=float, default=10,
+                        help="Period to print queue and latency statistics. Default is 10 s.",
+                        metavar="SECONDS",)
     parser.add_argument("--clk", dest="clk", default=17, help="The GPIO where our encoder's clk "
                         "wire will be connected. Default is 17.", metavar="GPIO_NUMBER",)
     parser.add_argument("--dt", dest="dt", default=18, help="The GPIO where our encoder's dt "
                         "wire will be connected. Default is 18.", metavar="GPIO_NUMBER",)
+    add_batch_arguments(parser)
+    add_retry_arguments(parser)
+    add_aggregation_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_codec_arguments(parser)
+    add_session_arguments(parser)
+    add_startup_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 class encoder_reader(threading.Thread):
     # Parse encoder as fast as possible, and if
-    def __init__(self, clk, dt, message_type=0):
+    def __init__(self, clk, dt, message_type=0, binary=False, ns_timestamps=False):
         threading.Thread.__init__(self)
 
         # Save inputs
         self.clk = clk
         self.dt = dt
         self.message_type = message_type
+        self.binary = binary
+        self.ns_timestamps = ns_timestamps
 
         # Initialize the GPIO's that will be used in the Raspberry Pi
         GPIO.setmode(GPIO.BCM)
@@ -127,48 +118,188 @@ class encoder_reader(threading.Thread):
         obj = {}
         obj["msg_type"] = self.message_type
         obj["value"] = self.position
-        obj["timestamp"] = str(datetime.datetime.now())
+        add_timestamp(obj, self.binary or self.ns_timestamps)
         obj["sequence"] = self.message_number
         obj["counter"] = self.counter
         self.message_number += 1
 
-        # Convert dictionary to json and return it
-        return json.dumps(obj)
+        # Convert dictionary to json (or to the binary format) and return it
+        return serialize(obj, self.binary)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class sample_publisher(threading.Thread):
+    # Send the samples put in a bounded queue into a stream, every period_ms
+    def __init__(self, sender, partitioner, period_ms=None, queue_size=10000, aggregator=None):
+        threading.Thread.__init__(self)
+
+        # Save inputs
+        self.sender = sender
+        self.period = 0.0 if period_ms is None or period_ms < 0 else period_ms / 1000.0
+        self.aggregator = aggregator
+        self.partitioner = partitioner
+
+        # Create queue of (monotonic time, sample) tuples
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+
+        # Create statistics variables
+        self.samples_sent = 0
+        self.samples_dropped = 0
+        self.max_queue_depth = 0
+        self.sends = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+        self.sample_age_total = 0.0
+        self.sample_age_max = 0.0
+
+        # Create variable to stop thread
+        self.stop_event = threading.Event()
+
+    def add(self, sample):
+        # Put a sample in the queue without blocking, drop it if the queue is full
+        try:
+            self.queue.put_nowait((time.monotonic(), sample))
+        except queue.Full:
+            self.samples_dropped += 1
+
+    def publish(self, timeout=None):
+        # Send all samples waiting in the queue. If timeout is set, wait up to timeout seconds for
+        # the first sample to arrive
+        samples = []
+        if timeout is not None:
+            try:
+                samples.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                return
+        while True:
+            try:
+                samples.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(samples) == 0:
+            return
+        self.max_queue_depth = max(self.max_queue_depth, len(samples))
+        if self.aggregator is None:
+            records = [sample for _, sample in samples]
+        else:
+            records = [self.aggregator.add(sample) for _, sample in samples]
+            records.append(self.aggregator.flush())
+        time0 = time.monotonic()
+        for record in records:
+            if record is not None:
+                partition = self.partitioner.partition(msg_type=0)
+                self.sender.put(record, partition["PartitionKey"],
+                                partition.get("ExplicitHashKey"))
+        self.sender.flush()
+        time1 = time.monotonic()
+
+        # Update statistics
+        send_time = time1 - time0
+        oldest_age = time1 - samples[0][0]
+        self.samples_sent += len(samples)
+        self.sends += 1
+        self.send_time_total += send_time
+        self.send_time_max = max(self.send_time_max, send_time)
+        self.sample_age_total += sum(time1 - t for t, _ in samples)
+        self.sample_age_max = max(self.sample_age_max, oldest_age)
+        print("Sent {} encoder messages into stream '{}' in {:.1f} ms.".format(
+              len(samples), self.sender.stream_name, 1000 * send_time))
+
+    def run(self):
+        # Publish samples every period until stopped
+        while not self.stop_event.is_set():
+            next_time = time.monotonic() + self.period
+            # Without a period, block until there is something to send instead of spinning
+            self.publish(timeout=0.1 if self.period == 0 else None)
+            self.stop_event.wait(max(next_time - time.monotonic(), 0))
+        self.publish()
+
+    def stats(self):
+        # Return queue depth and latency statistics
+        sends = max(self.sends, 1)
+        samples = max(self.samples_sent, 1)
+        return {"queue_depth": self.queue.qsize(), "max_queue_depth": self.max_queue_depth,
+                "samples_sent": self.samples_sent, "samples_dropped": self.samples_dropped,
+                "avg_send_ms": 1000 * self.send_time_total / sends,
+                "max_send_ms": 1000 * self.send_time_max,
+                "avg_sample_age_ms": 1000 * self.sample_age_total / samples,
+                "max_sample_age_ms": 1000 * self.sample_age_max}
 
     def stop(self):
         self.stop_event.set()
+        if self.is_alive():
+            self.join()
 
 
 def main():
     args = create_parser()
 
+    # Start thread to monitor encoder's position before connecting, so no movement is missed
+    # while the stream is prepared
+    reader = encoder_reader(args.clk, args.dt, message_type=0,  # type 0 refers to encoder data
+                            binary=args.binary, ns_timestamps=args.ns_timestamps)
+    reader.start()
+
     # Create and connect to stream
     stream_name = args.stream_name
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    if not connect_to_stream(kinesis_client, stream_name):
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
+        reader.stop()
         return
+    prewarm(kinesis_client, stream_name, args.prewarm)
 
-    # Start thread to monitor encoder's position
-    reader = encoder_reader(args.clk, args.dt, message_type=0)  # type 0 refers to encoder data
-    reader.start()
+    # Create sender (retrying throttled records), and start its thread to send messages in
+    # batches if requested (otherwise the publisher will flush it every period)
+    retry = create_retry_engine(args)
+    sender = batch_sender(kinesis_client, stream_name, linger_ms=args.linger, retry=retry)
+    if args.batch:
+        sender.start()
 
-    # Send encoder values into stream at args.period rate
-    sleep_s = 0.0 if args.period is None or args.period < 0 else args.period / 1000.0
+    # Choose how records are spread over the shards of the stream
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key=";P")
+
+    # Create aggregator to pack several encoder messages into every record, if requested
+    aggregator = None
+    if args.aggregate:
+        aggregator = record_aggregator(max_messages=args.aggregate_messages)
+
+    # Start thread to send encoder values into stream at args.period rate
+    publisher = sample_publisher(sender, partitioner, period_ms=args.period,
+                                 queue_size=args.queue_size, aggregator=aggregator)
+    publisher.start()
+
+    # Sample encoder at a fixed rate, independently of how long sending takes
+    sample_period_ms = args.sample_period
+    if sample_period_ms is None:
+        sample_period_ms = args.period if args.period is not None and args.period > 0 else 10
+    sample_s = sample_period_ms / 1000.0
+    next_sample = time.monotonic()
+    next_stats = next_sample + args.stats_period
+    first = True
     try:
         while True:
-            encoder_str = reader.status()
-            try:
-                kinesis_client.put_record(StreamName=stream_name, Data=encoder_str,
-                                          PartitionKey=";P")
-                print("Sent encoder message {} into stream '{}'.".format(encoder_str, stream_name))
-            except Exception as e:
-                print("Encountered an exception while trying to put record sensor data into "
-                      "stream '{}'.".format(stream_name))
-                print("Exception: {}.".format(e))
-            time.sleep(sleep_s)
+            publisher.add(reader.status())
+            if first:
+                report_first_sample(args.first_sample_budget)
+                first = False
+            next_sample += sample_s
+            now = time.monotonic()
+            if now >= next_stats:
+                print("Publisher stats: {}".format(publisher.stats()))
+                next_stats = now + args.stats_period
+            if next_sample > now:
+                time.sleep(next_sample - now)
+            else:
+                # We are late, skip the missed samples instead of sampling in a burst
+                next_sample = now
     finally:
         reader.stop()
+        publisher.stop()
+        sender.stop()
+        print("Publisher stats: {}".format(publisher.stats()))
 
 
 if __name__ == '__main__':
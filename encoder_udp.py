@@ -1,9 +1,10 @@
 from RPi import GPIO
 import argparse
-import datetime
 import json
 import socket
 import time
+from message_codec import add_timestamp, add_timestamp_argument
+from startup_benchmark import add_startup_arguments, report_first_sample
 
 
 """
@@ -30,6 +31,8 @@ def create_parser():
                         "localhost.", metavar="IP_ADDRESS")
     parser.add_argument("--port", dest="port", default=9999, type=int, help="Connection port. "
                         "Default is 9999.", metavar="PORT")
+    add_timestamp_argument(parser)
+    add_startup_arguments(parser)
     return parser.parse_args()
 
 
@@ -70,9 +73,11 @@ def main():
             obj = {}
             obj["sensor"] = 1
             obj["value"] = position
-            obj["timestamp"] = str(datetime.datetime.now())
+            add_timestamp(obj, args.ns_timestamps)
             obj["sequence"] = n
             n += 1
+            if n == 1:
+                report_first_sample(args.first_sample_budget)
 
             # Convert dictionary to json
             json_str = json.dumps(obj)
@@ -0,0 +1,176 @@
+import random
+import threading
+import time
+from retry_engine import THROTTLING_ERRORS, get_error_code
+from stream_metadata import metadata_cache
+from checkpoint_store import default_consumer_name
+
+
+"""
+Enhanced fan-out: Kinesis pushes the records of every shard to a registered stream consumer through
+a SubscribeToShard event stream, instead of the consumer polling them with GetRecords.
+Records arrive around 70 ms after they are put (instead of up to a whole poll interval later), and
+every registered consumer has its own 2 MB/s per shard, instead of sharing them with the other
+consumers of the stream. It costs extra per consumer-shard hour and per GB, see the Kinesis pricing.
+With --fan_out, the consumer is registered (with --consumer_name, default is the name of the script)
+and stream_reader.py uses a fan_out_worker for every shard instead of a shard_worker. A subscription
+lasts at most 5 minutes, so every worker subscribes again from the last sequence number received
+(ContinuationSequenceNumber) when it ends, or after resubscribe_s seconds.
+Kinesis sends an event at least every 5 seconds, even without records: a --read_timeout of 5 s (the
+default) may expire between two events, and then the worker just subscribes again. Use a longer
+one (10 s, for example) to avoid it.
+local_fan_out.py emulates SubscribeToShard, to try the workers without Kinesis.
+"""
+
+
+SUBSCRIPTION_SECONDS = 300
+
+
+def add_fan_out_argument(parser):
+    # Add the argument used to read with enhanced fan-out to an argparse parser
+    parser.add_argument("--fan_out", dest="fan_out", action="store_true", help="Use it to "
+                        "register an enhanced fan-out consumer (see --consumer_name) and receive "
+                        "the records pushed by SubscribeToShard instead of polling GetRecords.",)
+
+
+def register_consumer(kinesis_client, stream_name, consumer_name, timeout=60):
+    # Register a stream consumer (or find it if it is registered already), wait until it is ACTIVE
+    # and return its ARN
+    stream_arn = metadata_cache().arn(kinesis_client, stream_name)
+    try:
+        response = kinesis_client.register_stream_consumer(StreamARN=stream_arn,
+                                                           ConsumerName=consumer_name)
+        consumer = response["Consumer"]
+        print("Registered consumer '{}' of stream '{}'.".format(consumer_name, stream_name))
+    except kinesis_client.exceptions.ResourceInUseException:
+        consumer = kinesis_client.describe_stream_consumer(
+            StreamARN=stream_arn, ConsumerName=consumer_name)["ConsumerDescription"]
+    delay = 0.2
+    deadline = time.monotonic() + timeout
+    while consumer["ConsumerStatus"] != "ACTIVE":
+        if time.monotonic() > deadline:
+            raise RuntimeError("Consumer '{}' still has status {} after {} seconds.".format(
+                consumer_name, consumer["ConsumerStatus"], timeout))
+        print("Consumer '{}' has status {}, waiting {:.1f} seconds.".format(
+              consumer_name, consumer["ConsumerStatus"], delay))
+        time.sleep(delay)
+        delay = min(delay * 2, 5.0)
+        consumer = kinesis_client.describe_stream_consumer(
+            ConsumerARN=consumer["ConsumerARN"])["ConsumerDescription"]
+    return consumer["ConsumerARN"]
+
+
+def create_fan_out_consumer(args, kinesis_client, stream_name):
+    # Register the consumer if --fan_out is set and return its ARN, return None otherwise
+    if not args.fan_out:
+        return None
+    return register_consumer(kinesis_client, stream_name, default_consumer_name(args))
+
+
+class fan_out_worker(threading.Thread):
+    # Receive the records that Kinesis pushes for one shard, and give them to the reader. It is
+    # created by stream_reader like a shard_worker
+    def __init__(self, reader, shard_id, iterator_type, sequence_number=None, timestamp=None,
+                 resubscribe_s=SUBSCRIPTION_SECONDS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Save inputs
+        self.reader = reader
+        self.shard_id = shard_id
+        self.iterator_type = iterator_type
+        self.sequence_number = sequence_number
+        self.timestamp = timestamp
+        self.resubscribe_s = resubscribe_s
+
+        # Create state and statistics variables
+        self.continuation = None
+        self.last_sequence_number = None
+        self.lag_ms = None
+        self.records = 0
+        self.calls = 0
+        self.errors = 0
+        self.events = 0
+        self.throttled_calls = 0
+
+    def starting_position(self):
+        # Return the StartingPosition of the next subscription, after the last record received
+        if self.continuation is not None:
+            return {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": self.continuation}
+        position = {"Type": self.iterator_type}
+        if self.iterator_type in ("AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER"):
+            position["SequenceNumber"] = self.sequence_number
+        elif self.iterator_type == "AT_TIMESTAMP":
+            position["Timestamp"] = self.timestamp
+        return position
+
+    def subscribe(self):
+        # Read one subscription until it ends. Return True if the shard was read to the end, and
+        # False if the worker must subscribe again (or it was stopped)
+        response = self.reader.kinesis_client.subscribe_to_shard(
+            ConsumerARN=self.reader.consumer_arn, ShardId=self.shard_id,
+            StartingPosition=self.starting_position())
+        self.calls += 1
+        event_stream = response["EventStream"]
+        deadline = time.monotonic() + self.resubscribe_s
+        try:
+            for event in event_stream:
+                if "SubscribeToShardEvent" not in event:
+                    continue
+                event = event["SubscribeToShardEvent"]
+                self.events += 1
+                self.lag_ms = event.get("MillisBehindLatest", self.lag_ms)
+                records = event["Records"]
+                sequence_number = None
+                if len(records) > 0:
+                    self.records += len(records)
+                    sequence_number = records[-1]["SequenceNumber"]
+                    self.last_sequence_number = sequence_number
+                if not self.reader.deliver(self.shard_id, event, sequence_number):
+                    # Stopped before the records were processed
+                    return False
+                # A missing continuation means the shard is closed and has been read to the end
+                self.continuation = event.get("ContinuationSequenceNumber")
+                if self.continuation is None:
+                    return True
+                if time.monotonic() > deadline:
+                    break
+        finally:
+            close = getattr(event_stream, "close", None)
+            if close is not None:
+                close()
+        return False
+
+    def run(self):
+        stop_event = self.reader.stop_event
+        closed = False
+        backoff = 0.0
+        while not closed and not stop_event.is_set():
+            try:
+                closed = self.subscribe()
+                backoff = 0.0
+            except Exception as e:
+                self.errors += 1
+                error_code = get_error_code(e)
+                if error_code in THROTTLING_ERRORS or error_code in ("LimitExceededException",
+                                                                     "ResourceInUseException"):
+                    # Subscribing again too soon (a shard allows one subscription per second and
+                    # consumer), wait a bit more every time
+                    self.throttled_calls += 1
+                    backoff = min(max(2 * backoff, 1.0), 10.0)
+                    stop_event.wait(backoff * random.uniform(0.5, 1.0))
+                elif error_code is None and "timeout" in type(e).__name__.lower():
+                    # No event for too long, the read timeout closed the connection
+                    continue
+                else:
+                    print("Exception while subscribing to shard '{}': {}.".format(self.shard_id, e))
+                    backoff = min(max(2 * backoff, 0.05), 2.0)
+                    stop_event.wait(backoff)
+        self.reader.worker_finished(self, closed=closed)
+
+    def stats(self):
+        return {"records": self.records, "calls": self.calls, "errors": self.errors,
+                "last_sequence_number": self.last_sequence_number,
+                "millis_behind_latest": self.lag_ms, "catching_up": False, "catch_up_calls": 0,
+                "throttled_calls": self.throttled_calls, "failed_calls": self.errors,
+                "events": self.events}
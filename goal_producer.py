@@ -1,8 +1,7 @@
 import argparse
-import time
-import datetime
-import boto3
-import json
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from message_codec import add_codec_arguments, add_timestamp, serialize
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
 
 
 def create_parser():
@@ -14,55 +13,26 @@ Send goals as json objects into a selected stream. Works well with pid_controlle
     parser.add_argument("-r", "--regionName", "--region", dest="region", default="us-east-1",
                         help="The region you'd like to make this stream in. Default "
                         "is 'us-east-1'", metavar="REGION_NAME",)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_codec_arguments(parser)
+    add_session_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 def main():
     args = create_parser()
 
     # Create and connect to stream
     stream_name = args.stream_name
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    if not connect_to_stream(kinesis_client, stream_name):
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
         return
+    prewarm(kinesis_client, stream_name, args.prewarm)
+
+    # Choose how records are spread over the shards of the stream
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key="123")
 
     # Now the stream should exist
     usr_input = ""
@@ -88,15 +58,16 @@ def main():
         obj["msg_type"] = 2  # type 2 refers to motor postion
         obj["value"] = pos
         obj["sequence"] = counter
-        obj["timestamp"] = str(datetime.datetime.now())
+        add_timestamp(obj, args.binary or args.ns_timestamps)
         counter += 1
 
-        # Convert to json
-        json_str = json.dumps(obj)
+        # Convert to json (or to the binary format)
+        json_str = serialize(obj, args.binary)
 
         # Send into stream
         try:
-            kinesis_client.put_record(StreamName=stream_name, Data=json_str, PartitionKey="123")
+            partition = partitioner.partition(msg_type=2)
+            kinesis_client.put_record(StreamName=stream_name, Data=json_str, **partition)
             print("{}. Sent motor position '{:.2f}' into stream '{}'.".format(obj["sequence"],
                                                                            obj["value"],
                                                                            stream_name))
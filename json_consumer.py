@@ -1,10 +1,15 @@
 import argparse
 import json
-import datetime
 import time
-import numpy as np
-import boto3
-from matplotlib_utils import plotLine, plotPlotBox, plt_ion, plt_ioff
+from record_aggregator import deaggregate_records
+from message_codec import decode_all
+from latency_histogram import PERCENTILES, latency_histogram
+from kinesis_session import add_session_arguments, create_kinesis_client
+from stream_metadata import find_stream_shards
+from stream_reader import stream_reader
+from checkpoint_store import add_checkpoint_arguments, create_checkpoint_store
+from adaptive_poller import add_poller_arguments
+from fan_out import add_fan_out_argument, create_fan_out_consumer
 
 
 def create_parser():
@@ -18,10 +23,14 @@ The plots will also be saved into the figures folder.
                         help="The region you'd like to make this stream in. Default is "
                         "'us-east-1'", metavar="REGION_NAME",)
     parser.add_argument("-p", "--period", dest="period", type=int, default=None,
-                        help="How often to read stream. Default is 0.", metavar="MILLISECONDS",)
+                        help="How often to read stream once it has caught up. Default is "
+                        "--poll_rate.", metavar="MILLISECONDS",)
     parser.add_argument("-t", "--timeout", dest="timeout", type=int, default=60,
                         help="When to timeout and plot results. Default waits 1 minute.",
                         metavar="SECONDS",)
+    parser.add_argument("-i", "--print_period", dest="print_period", type=float, default=10,
+                        help="How often to print the delay percentiles while monitoring. 0 "
+                        "does not print them. Default is 10 seconds.", metavar="SECONDS",)
     parser.add_argument("-m", "--max_records", dest="max_records", type=int, default=None,
                         help="If set, stop monitoring stream after reading N records.",
                         metavar="RECORDS",)
@@ -34,8 +43,12 @@ The plots will also be saved into the figures folder.
     parser.add_argument("--noplot", dest="noplot", action="store_true", help="Do not plot "
                         "or save any figure.",)
     parser.add_argument("-f", "--filename", dest="filename", default=None,
-                        help="Choose file name to save data recorded. If unset, the data will"
-                        " not be saved.", metavar="FILE_NAME",)
+                        help="Choose file name to save the histogram of delays recorded (json). "
+                        "If unset, the data will not be saved.", metavar="FILE_NAME",)
+    add_session_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_poller_arguments(parser)
+    add_fan_out_argument(parser)
     return parser.parse_args()
 
 
@@ -44,100 +57,125 @@ def main():
     stream_name = args.stream_name
 
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status != "ACTIVE":
-            print("The stream '{}' has status {}, please rerun the script when the stream "
-                  "is ACTIVE.".format(stream_name))
-            return
-        else:
-            shard_id = stream_description["StreamDescription"]["Shards"][0]["ShardId"]
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("The stream '{}' was not found, please rerun the script when the stream has "
-              "been created.".format(stream_name))
+    kinesis_client = create_kinesis_client(args.region, args)
+    # Read the shards of the stream from the shared metadata cache, waiting for it to be ACTIVE
+    if find_stream_shards(kinesis_client, stream_name) is None:
         return
 
-    # If we reach this point, the string is active
-    shard_iterator_type = args.shard_iterator_type
-    shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
-                                                       ShardIteratorType=shard_iterator_type)["ShardIterator"]
+    # NumPy is imported once the stream is active, to compute the delays of every batch at once
+    from timestamp_utils import delays_ms_between, to_ns_array
+
+    # Count the delay of every message received (from any shard) in a histogram of the current
+    # interval, so memory does not grow however long the stream is monitored
+    interval = latency_histogram()
+    received = [0]
+
+    def receive(shard_id, response):
+        now_time = time.time_ns()
+        sent_times = [obj["timestamp"] for r in deaggregate_records(response["Records"])
+                      for obj in decode_all(r["Data"])]
+        if args.max_records is not None:
+            sent_times = sent_times[:max(args.max_records - received[0], 0)]
+        if len(sent_times) > 0:
+            interval.record_many(delays_ms_between(to_ns_array(sent_times), now_time).tolist())
+            received[0] += len(sent_times)
+        if args.max_records is not None and received[0] >= args.max_records:
+            reader.stop()
+
+    # If we reach this point, the string is active. Read all its shards until timeout
+    # Register the enhanced fan-out consumer if --fan_out is set (the records are pushed)
+    consumer_arn = create_fan_out_consumer(args, kinesis_client, stream_name)
+    # Save the last record processed in every shard, to continue from it after a restart
+    checkpoint = create_checkpoint_store(args, stream_name)
+    reader = stream_reader(kinesis_client, stream_name, receive, args.shard_iterator_type,
+                           period_ms=args.period, checkpoint=checkpoint,
+                           poll_rate=args.poll_rate, catch_up_lag_ms=args.catch_up_lag,
+                           consumer_arn=consumer_arn)
+    # Every print period, the interval histogram is printed and merged into the total one
+    total = latency_histogram()
+    interval_times = []
+    interval_percentiles = []
 
-    # Calculate termination time
-    terminate_time = datetime.datetime.now() + datetime.timedelta(seconds=args.timeout)
+    def end_interval():
+        snapshot = interval.snapshot(reset=True)
+        if snapshot.count > 0:
+            interval_times.append(time.time() - start_time)
+            interval_percentiles.append(snapshot.percentiles())
+        total.merge(snapshot)
+        return snapshot
 
-    # Read stream until timeout
-    max_num_records = 10000
-    start_end_times = []
-    sleep_time = 0.0 if args.period is None else args.period / 1000.0
-    number_exceptions = 0
-    num_records = 0
+    start_time = time.time()
     try:
         print("Monitoring data in stream for {} seconds.".format(args.timeout))
-        while datetime.datetime.now() < terminate_time:
-            try:
-                records = kinesis_client.get_records(ShardIterator=shard_iterator,
-                                                     Limit=max_num_records)
-                now_time = datetime.datetime.now()
-                for r in records["Records"]:
-                    start_end_times.append((r["Data"], now_time))
-                    num_records += 1
-                shard_iterator = records["NextShardIterator"]  # Update shard_iterator
-                if args.max_records is not None and num_records >= args.max_records:
+        reader.start()
+        if args.print_period > 0:
+            end_time = start_time + args.timeout
+            while not reader.wait(max(min(args.print_period, end_time - time.time()), 0)):
+                if time.time() >= end_time:
                     break
-                time.sleep(sleep_time)
-            except Exception as e:
-                number_exceptions += 1
-                time.sleep(0.01)
+                print("Delays of the last {:g} s: {}".format(args.print_period,
+                                                           end_interval().summary()))
+        else:
+            reader.wait(args.timeout)
         print("Finished data monitoring.")
-    except KeyError:
+    except KeyboardInterrupt:
         print("Ctrl+C interrupt received, prematurely halting data monitoring.")
+    finally:
+        reader.stop()
+        if checkpoint is not None:
+            checkpoint.stop()
+    number_exceptions = reader.stats()["errors"]
+    end_interval()
 
-    # Calculate delay and print some data about them
-    delays = []
-    for json_obj0, time1 in start_end_times:
-        time0 = json.loads(json_obj0.decode("utf-8"))["timestamp"]
-        delay = time1 - datetime.datetime.strptime(time0, "%Y-%m-%d %H:%M:%S.%f")
-        delays.append(delay)
-    if args.max_records is not None:
-        delays = delays[:args.max_records]
-    delays = np.array(delays)
-    delays_ms = [1000.0 * d.total_seconds() for d in delays]
-    print("Samples: {}".format(len(delays)))
-    if len(delays) == 0:
+    # Print some data about all delays
+    print("Samples: {}".format(total.count))
+    if total.count == 0:
         return
-    print("Min: {:.3f} ms".format(np.min(delays_ms)))
-    print("Max: {:.3f} ms".format(np.max(delays_ms)))
-    print("Med: {:.3f} ms".format(np.median(delays_ms)))
-    print("Avg: {:.3f} ms".format(np.mean(delays_ms)))
-    print("Std: {:.3f} ms".format(np.std(delays_ms)))
+    percentiles = total.percentiles([50] + PERCENTILES)
+    print("Min: {:.3f} ms".format(total.min))
+    print("Max: {:.3f} ms".format(total.max))
+    print("Med: {:.3f} ms".format(percentiles[50]))
+    print("Avg: {:.3f} ms".format(total.mean()))
+    print("Std: {:.3f} ms".format(total.std()))
+    for p in PERCENTILES[1:]:
+        print("P{:g}: {:.3f} ms".format(p, percentiles[p]))
     print("Err: {}".format(number_exceptions))
 
-    # Convert data to historiogram and cumulative format
-    bucket_delays_ms = [0] * int(np.max(delays_ms) + 1)
-    for d in delays_ms:
-        bucket_delays_ms[int(d)] += 1
-    cum_delays_ms = []
-    prev_delay = 0
-    for d in bucket_delays_ms:
-        prev_delay += d
-        cum_delays_ms.append(prev_delay)
-
     if args.filename is not None:
-        np.save(args.filename, delays_ms)
+        with open(args.filename, "w") as f:
+            json.dump(total.to_dict(), f)
 
     if not args.noplot:
+        # matplotlib is imported after monitoring, so that monitoring starts as soon as possible
+        from matplotlib_utils import plotLine, plt_ion, plt_ioff
+
+        # Convert the histogram to cases per ms (buckets are wider for larger delays), and to
+        # cumulative format
+        buckets = total.buckets()
+        bucket_ms = [(low + high) / 2.0 for low, high, _ in buckets]
+        bucket_delays_ms = [count / (high - low) for low, high, count in buckets]
+        cum_delays_ms = []
+        cumulative = 0
+        for _, _, count in buckets:
+            cumulative += count
+            cum_delays_ms.append(cumulative)
+
         # Plot 4 figures
         plt_ion()
-        plotLine(delays_ms, x_label="samples", y_label="ms", title="Delays", figure=0, color="r")
-        plotLine(bucket_delays_ms, x_label="ms", y_label="# cases", title="Historiogram delays",
-                 figure=1, color="b")
-        plotLine(cum_delays_ms, x_label="ms", y_label="# cases", title="Cumulative delays",
-                 figure=2, color="m")
-        plotPlotBox(delays_ms, y_label="ms", title="Box plot delays", figure=3)
+        for p in PERCENTILES:
+            # Percentiles of every print period
+            if len(interval_times) > 0:
+                plotLine([row[p] for row in interval_percentiles], interval_times, x_label="s",
+                         y_label="ms", title="Delays", figure=0, label="p{:g}".format(p))
+        plotLine(bucket_delays_ms, bucket_ms, x_label="ms", y_label="# cases / ms",
+                 title="Historiogram delays", figure=1, color="b")
+        plotLine(cum_delays_ms, [high for _, high, _ in buckets], x_label="ms",
+                 y_label="# cases", title="Cumulative delays", figure=2, color="m")
+        percentiles = [0, 25, 50, 75, 90, 99, 99.9, 99.99, 100]
+        values = total.percentiles(percentiles)
+        plotLine([values[p] for p in percentiles], [str(p) for p in percentiles],
+                 x_label="percentile", y_label="ms", title="Percentiles delays", figure=3,
+                 style="o-", color="r")
         plt_ioff()
         input("Type ENTER to close all figures.")
 
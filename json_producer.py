@@ -1,9 +1,12 @@
 import argparse
 import time
-import datetime
-import boto3
 import random
-import json
+from batch_sender import add_batch_arguments, batch_sender
+from rate_limiter import add_rate_limit_arguments, create_rate_limiter, record_size
+from retry_engine import add_retry_arguments, create_retry_engine
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from message_codec import add_codec_arguments, add_timestamp, serialize
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
 
 
 def create_parser():
@@ -21,90 +24,91 @@ Send random data as json objects into a selected stream.
                         metavar="MILLISECONDS",)
     parser.add_argument("--silent", dest="silent", action="store_true", help="Use it to mute "
                         "terminal prints every time a message is sent",)
+    add_batch_arguments(parser)
+    add_retry_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_codec_arguments(parser)
+    add_session_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 def main():
     args = create_parser()
 
     # Create and connect to stream
     stream_name = args.stream_name
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    if not connect_to_stream(kinesis_client, stream_name):
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
         return
+    prewarm(kinesis_client, stream_name, args.prewarm)
+
+    # Choose how records are spread over the shards of the stream
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key="123")
+
+    # Retry throttled records instead of dropping them
+    retry = create_retry_engine(args)
+
+    # Pace records to stay just under the shard write limits, if requested
+    rate_limiter = create_rate_limiter(args, kinesis_client, stream_name)
+
+    # Start thread that sends messages in batches, if requested
+    sender = None
+    if args.batch:
+        sender = batch_sender(kinesis_client, stream_name, linger_ms=args.linger, retry=retry,
+                              rate_limiter=rate_limiter)
+        sender.start()
 
     # Now the stream should exist
     n = [0, 0, 0]
     sleep_s = 0.0 if args.period is None else args.period / 1000
     if args.silent:
         print("Sending a json object every {} seconds.".format(sleep_s))
-    while True:
-        # Create object
-        obj = {}
-        r = random.randint(1, 501)
-        obj["msg_type"] = 0 if r < 401 else (1 if r < 501 else 2)
-        if obj["msg_type"] == 1:
-            obj["value"] = float(int(random.random() * 256))  # Value in range [0, 255]
-        else:
-            obj["value"] = random.random() * 2000 - 1000  # Value in range [-1000.0, 1000.0)
-        n[obj["msg_type"]] += 1
-        obj["sequence"] = n[obj["msg_type"]]
-        obj["timestamp"] = str(datetime.datetime.now())
+    try:
+        while True:
+            # Create object
+            obj = {}
+            r = random.randint(1, 501)
+            obj["msg_type"] = 0 if r < 401 else (1 if r < 501 else 2)
+            if obj["msg_type"] == 1:
+                obj["value"] = float(int(random.random() * 256))  # Value in range [0, 255]
+            else:
+                obj["value"] = random.random() * 2000 - 1000  # Value in range [-1000.0, 1000.0)
+            n[obj["msg_type"]] += 1
+            obj["sequence"] = n[obj["msg_type"]]
+            add_timestamp(obj, args.binary or args.ns_timestamps)
 
-        # Convert to json
-        json_str = json.dumps(obj)
+            # Convert to json (or to the binary format)
+            json_str = serialize(obj, args.binary)
 
-        # Send into stream
-        try:
-            kinesis_client.put_record(StreamName=stream_name, Data=json_str, PartitionKey="123")
-            if not args.silent:
-                print("{:5}. Sent data '{:+.5f}' with message type '{}' into stream '{}'.".format(
-                      obj["sequence"], obj["value"], obj["msg_type"], stream_name))
-        except Exception as e:
-            print("Encountered an exception while trying to put record '{}'".format(json_str) +
-                  " into stream '{}'.".format(stream_name))
-            print("Exception: {}.".format(e))
+            # Send into stream (or add it to the next batch)
+            try:
+                partition = partitioner.partition(msg_type=obj["msg_type"])
+                if sender is not None:
+                    sender.put(json_str, partition["PartitionKey"],
+                               partition.get("ExplicitHashKey"))
+                else:
+                    if rate_limiter is not None:
+                        rate_limiter.acquire(partition, record_size(json_str, partition))
+                    retry.call(kinesis_client.put_record, StreamName=stream_name, Data=json_str,
+                               **partition)
+                if not args.silent:
+                    print("{:5}. Sent data '{:+.5f}' with message type '{}' into stream "
+                          "'{}'.".format(obj["sequence"], obj["value"], obj["msg_type"],
+                                         stream_name))
+            except Exception as e:
+                print("Encountered an exception while trying to put record '{}'".format(json_str)
+                      + " into stream '{}'.".format(stream_name))
+                print("Exception: {}.".format(e))
 
-        # print("Sleeping for {} milliseconds.".format(args.period))
-        time.sleep(sleep_s)
+            # print("Sleeping for {} milliseconds.".format(args.period))
+            time.sleep(sleep_s)
+    finally:
+        if sender is not None:
+            sender.stop()
+            print("Batches: {}".format(sender.stats()))
 
 
 if __name__ == '__main__':
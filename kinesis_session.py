@@ -0,0 +1,188 @@
+import threading
+import time
+from stream_metadata import add_metadata_arguments, configure_metadata_cache, metadata_cache
+from metrics import add_metrics_arguments, start_metrics_exporter
+
+
+"""
+Kinesis clients shared by every script (and every thread of a script), and the functions used to
+connect to a stream.
+Clients are created from a single boto3 session per process and cached by region and settings, with
+a configurable connection pool, TCP keep-alive, timeouts and retry mode. Connections can be opened
+(prewarmed) before the first put, so the first real message does not pay for the TLS handshake.
+The time spent creating every client and doing its first call is measured and printed, to see the
+cold start penalty. boto3 is only imported when the first client is created, because importing it
+takes a long time in a Raspberry Pi.
+Scripts that retry their calls with a retry_engine (see retry_engine.py) get clients that make a
+single attempt per call, so throttles reach the retry budget and circuit breaker of the engine
+instead of being retried (and multiplied) inside botocore first.
+The status and shards of the streams are read through the cache of stream_metadata.py, configured
+with the same arguments, and the metrics exporter of metrics.py is started with them too.
+"""
+
+
+RETRY_MODES = ["legacy", "standard", "adaptive"]
+
+# Shared session, clients and timings of this process
+_session = None
+_clients = {}
+_timings = {}
+_clients_lock = threading.Lock()
+
+
+def add_session_arguments(parser):
+    # Add the arguments used to configure the Kinesis clients to an argparse parser
+    parser.add_argument("--max_pool_connections", dest="max_pool_connections", type=int,
+                        default=20, help="Maximum number of connections kept open with Kinesis. "
+                        "Default is 20.", metavar="CONNECTIONS",)
+    parser.add_argument("--connect_timeout", dest="connect_timeout", type=float, default=2,
+                        help="Timeout to open a connection. Default is 2 s.", metavar="SECONDS",)
+    parser.add_argument("--read_timeout", dest="read_timeout", type=float, default=5,
+                        help="Timeout to read a response. Default is 5 s.", metavar="SECONDS",)
+    parser.add_argument("--retry_mode", dest="retry_mode", default=RETRY_MODES[1],
+                        choices=RETRY_MODES, help="Retry mode of the boto3 client (scripts "
+                        "with --max_attempts retry with their own engine instead). Options are "
+                        "{}. Default is '{}'.".format(RETRY_MODES, RETRY_MODES[1]),
+                        metavar="MODE",)
+    parser.add_argument("--no_keepalive", dest="tcp_keepalive", action="store_false",
+                        help="Use it to disable TCP keep-alive in the connections.",)
+    parser.add_argument("--prewarm", dest="prewarm", type=int, default=2, help="Number of "
+                        "connections opened before sending the first record (0 disables it). "
+                        "Default is 2.", metavar="CONNECTIONS",)
+    add_metadata_arguments(parser)
+    add_metrics_arguments(parser)
+
+
+def create_config(max_pool_connections=20, connect_timeout=2, read_timeout=5,
+                  retry_mode="standard", tcp_keepalive=True, total_max_attempts=None):
+    # Return the botocore Config of the clients (total_max_attempts=1 disables the retries of
+    # botocore)
+    from botocore.config import Config
+    retries = {"mode": retry_mode}
+    if total_max_attempts is not None:
+        retries["total_max_attempts"] = total_max_attempts
+    settings = {"max_pool_connections": max_pool_connections, "connect_timeout": connect_timeout,
+                "read_timeout": read_timeout, "retries": retries}
+    if tcp_keepalive:
+        settings["tcp_keepalive"] = True
+    try:
+        return Config(**settings)
+    except TypeError:
+        # Old botocore versions do not support tcp_keepalive
+        print("TCP keep-alive is not supported by this botocore version, ignoring it.")
+        settings.pop("tcp_keepalive")
+        return Config(**settings)
+
+
+def _time_first_call(client, region):
+    # Measure the first call made with a client (it usually opens the first connection). Calls
+    # made at the same time from other threads are ignored
+    state = {}
+    lock = threading.Lock()
+
+    def before_call(**kwargs):
+        with lock:
+            state.setdefault("start", time.monotonic())
+
+    def after_call(model, **kwargs):
+        with lock:
+            if "start" not in state or "done" in state:
+                return
+            state["done"] = True
+        timing = _timings[region]
+        timing["first_call"] = model.name
+        timing["first_call_ms"] = 1000 * (time.monotonic() - state["start"])
+        client.meta.events.unregister("before-parameter-build.kinesis", before_call)
+        client.meta.events.unregister("after-call.kinesis", after_call)
+        print("First Kinesis call ({}) in region '{}' took {:.1f} ms.".format(
+              timing["first_call"], region, timing["first_call_ms"]))
+
+    client.meta.events.register("before-parameter-build.kinesis", before_call)
+    client.meta.events.register("after-call.kinesis", after_call)
+
+
+def create_kinesis_client(region, args=None):
+    # Return the shared Kinesis client of a region, creating it the first time. The settings are
+    # taken from args (parsed with add_session_arguments) if given
+    settings = {}
+    if args is not None:
+        configure_metadata_cache(args)
+        start_metrics_exporter(args)
+        settings = {"max_pool_connections": args.max_pool_connections,
+                    "connect_timeout": args.connect_timeout, "read_timeout": args.read_timeout,
+                    "retry_mode": args.retry_mode, "tcp_keepalive": args.tcp_keepalive}
+        if getattr(args, "max_attempts", None) is not None:
+            # The calls are retried by a retry_engine (add_retry_arguments), botocore must not
+            # retry them too
+            settings["total_max_attempts"] = 1
+    key = (region, tuple(sorted(settings.items())))
+    global _session
+    with _clients_lock:
+        if key not in _clients:
+            time0 = time.monotonic()
+            if _session is None:
+                import boto3
+                _session = boto3.session.Session()
+            client = _session.client("kinesis", region_name=region,
+                                     config=create_config(**settings))
+            creation_ms = 1000 * (time.monotonic() - time0)
+            _timings.setdefault(region, {})["client_creation_ms"] = creation_ms
+            _time_first_call(client, region)
+            print("Created Kinesis client for region '{}' in {:.1f} ms.".format(region,
+                                                                                 creation_ms))
+            _clients[key] = client
+        return _clients[key]
+
+
+def prewarm(kinesis_client, stream_name, connections=2):
+    # Open connections calling DescribeStreamSummary from several threads at the same time, so
+    # they are ready in the pool before the first put
+    if connections <= 0:
+        return
+    errors = []
+
+    def call():
+        try:
+            kinesis_client.describe_stream_summary(StreamName=stream_name)
+        except Exception as e:
+            errors.append(e)
+
+    time0 = time.monotonic()
+    threads = [threading.Thread(target=call) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("Prewarmed {} connection(s) in {:.1f} ms.".format(connections - len(errors),
+                                                         1000 * (time.monotonic() - time0)))
+    if len(errors) > 0:
+        print("Exception while prewarming connections: {}.".format(errors[0]))
+
+
+def session_timings():
+    # Return the client creation and first call times, by region
+    return {region: dict(timing) for region, timing in _timings.items()}
+
+
+def wait_for_stream(kinesis_client, stream_name, timeout=300):
+    # Wait for the provided stream to become active, return False if it does not in timeout seconds
+    return metadata_cache().wait_for_status(kinesis_client, stream_name, "ACTIVE",
+                                            timeout=timeout) is not None
+
+
+def connect_to_stream(kinesis_client, stream_name, shard_count=1):
+    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
+    try:
+        # The stream does exist already (if no Exception occurs)
+        status = metadata_cache().status(kinesis_client, stream_name)
+    except kinesis_client.exceptions.ResourceNotFoundException:
+        # The stream does not exist so we will try to create it with shard_count shards
+        print("Creating stream '{}' with {} shard(s).".format(stream_name, shard_count))
+        kinesis_client.create_stream(StreamName=stream_name, ShardCount=shard_count)
+        status = "CREATING"
+    if status == "DELETING":
+        print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
+        return False
+    elif status != "ACTIVE":
+        return wait_for_stream(kinesis_client, stream_name)
+    return True
@@ -0,0 +1,215 @@
+import math
+import threading
+
+
+"""
+Latency statistics of a stream with a fixed amount of memory, however long it is monitored.
+Every delay is counted in a log-linear (HDR style) bucket, instead of being saved: values are
+counted in units of resolution_ms, the first 2^sub_bucket_bits units have a bucket each, and every
+power of two above them is split in 2^(sub_bucket_bits - 1) buckets of the same width. The width
+of a bucket is never more than 1/2^(sub_bucket_bits - 1) of its values (0.8% with the default 7
+bits), so percentiles keep that relative precision from microseconds to hours, with about 1700
+buckets. Values above max_ms are counted in the last bucket, and negative delays (clocks out of
+sync) in the first one. The exact count, min, max, sum and sum of squares are kept too, for the
+mean and the standard deviation.
+Histograms with the same layout can be merged (the delays of an interval into the delays of the
+whole run, or the histograms saved by several consumers), and converted to and from a json
+serializable dict.
+"""
+
+
+# Percentiles printed by summary
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class latency_histogram(object):
+    # Count delays (ms) in log-linear buckets
+    def __init__(self, resolution_ms=0.001, max_ms=3600000, sub_bucket_bits=7):
+        if resolution_ms <= 0 or max_ms <= resolution_ms or sub_bucket_bits < 2:
+            raise ValueError("Invalid histogram layout.")
+
+        # Save inputs
+        self.resolution_ms = resolution_ms
+        self.max_ms = max_ms
+        self.sub_bucket_bits = sub_bucket_bits
+
+        # Create buckets
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.max_units = int(max_ms / resolution_ms)
+        self.counts = [0] * (self.index(self.max_units) + 1)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Forget every value recorded
+        with self.lock:
+            self.clear()
+
+    def clear(self):
+        # Forget every value recorded (the lock must be held)
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.sum_squares = 0.0
+
+    def index(self, units):
+        # Return the bucket of a value (in units of resolution_ms)
+        if units < self.sub_bucket_count:
+            return max(units, 0)
+        shift = units.bit_length() - self.sub_bucket_bits
+        half = self.sub_bucket_count >> 1
+        return self.sub_bucket_count + (shift - 1) * half + (units >> shift) - half
+
+    def bucket_range(self, index):
+        # Return the lowest and highest values (ms) counted in a bucket
+        if index < self.sub_bucket_count:
+            low, width = index, 1
+        else:
+            half = self.sub_bucket_count >> 1
+            shift, offset = divmod(index - self.sub_bucket_count, half)
+            width = 1 << (shift + 1)
+            low = (half + offset) * width
+        return low * self.resolution_ms, (low + width) * self.resolution_ms
+
+    def record(self, value_ms, count=1):
+        # Count a delay (ms) count times
+        units = min(int(value_ms / self.resolution_ms), self.max_units)
+        index = self.index(units)
+        with self.lock:
+            self.counts[index] += count
+            self.count += count
+            self.sum += value_ms * count
+            self.sum_squares += value_ms * value_ms * count
+            if self.min is None or value_ms < self.min:
+                self.min = value_ms
+            if self.max is None or value_ms > self.max:
+                self.max = value_ms
+
+    def record_many(self, values_ms):
+        # Count a list of delays (ms), taking the lock once
+        indexes = [self.index(min(int(v / self.resolution_ms), self.max_units))
+                   for v in values_ms]
+        if len(indexes) == 0:
+            return
+        with self.lock:
+            counts = self.counts
+            for index in indexes:
+                counts[index] += 1
+            self.count += len(indexes)
+            self.sum += sum(values_ms)
+            self.sum_squares += sum(v * v for v in values_ms)
+            low = min(values_ms)
+            high = max(values_ms)
+            if self.min is None or low < self.min:
+                self.min = low
+            if self.max is None or high > self.max:
+                self.max = high
+
+    def same_layout(self, other):
+        return (self.resolution_ms == other.resolution_ms and self.max_ms == other.max_ms and
+                self.sub_bucket_bits == other.sub_bucket_bits)
+
+    def merge(self, other):
+        # Add the values of another histogram with the same layout
+        if not self.same_layout(other):
+            raise ValueError("Cannot merge histograms with different layouts.")
+        other = other.snapshot()
+        with self.lock:
+            self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+            self.count += other.count
+            self.sum += other.sum
+            self.sum_squares += other.sum_squares
+            if other.min is not None and (self.min is None or other.min < self.min):
+                self.min = other.min
+            if other.max is not None and (self.max is None or other.max > self.max):
+                self.max = other.max
+        return self
+
+    def snapshot(self, reset=False):
+        # Return a copy of the histogram (and reset it, to start a new interval)
+        copy = latency_histogram(self.resolution_ms, self.max_ms, self.sub_bucket_bits)
+        with self.lock:
+            copy.counts = list(self.counts)
+            copy.count = self.count
+            copy.min = self.min
+            copy.max = self.max
+            copy.sum = self.sum
+            copy.sum_squares = self.sum_squares
+            if reset:
+                self.clear()
+        return copy
+
+    def percentile(self, percentile):
+        # Return the value (ms) below which percentile % of the values are (the middle of its
+        # bucket, within the min and max recorded), or None if there are no values
+        return self.percentiles([percentile])[percentile]
+
+    def percentiles(self, percentiles=PERCENTILES):
+        # Return {percentile: value} for a list of percentiles, with a single pass over the buckets
+        result = {}
+        if self.count == 0:
+            return {p: None for p in percentiles}
+        ranks = sorted((max(int(math.ceil(p / 100.0 * self.count)), 1), p) for p in percentiles)
+        cumulative = 0
+        position = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            while position < len(ranks) and cumulative >= ranks[position][0]:
+                rank, p = ranks[position]
+                if rank == 1:
+                    result[p] = self.min
+                elif rank >= self.count:
+                    result[p] = self.max
+                else:
+                    low, high = self.bucket_range(index)
+                    result[p] = min(max((low + high) / 2.0, self.min), self.max)
+                position += 1
+            if position == len(ranks):
+                break
+        return result
+
+    def mean(self):
+        return None if self.count == 0 else self.sum / self.count
+
+    def std(self):
+        if self.count == 0:
+            return None
+        mean = self.sum / self.count
+        return math.sqrt(max(self.sum_squares / self.count - mean * mean, 0.0))
+
+    def buckets(self):
+        # Return (lowest value, highest value, count) of every bucket with values
+        return [self.bucket_range(index) + (count,)
+                for index, count in enumerate(self.counts) if count > 0]
+
+    def summary(self, percentiles=PERCENTILES):
+        # Return a line with the count, percentiles and max
+        if self.count == 0:
+            return "n=0"
+        values = self.percentiles(percentiles)
+        text = " ".join("p{:g}={:.3f}".format(p, values[p]) for p in percentiles)
+        return "n={} {} max={:.3f} ms".format(self.count, text, self.max)
+
+    def to_dict(self):
+        # Return the histogram in a json serializable dict (only buckets with values are saved)
+        snapshot = self.snapshot()
+        return {"resolution_ms": self.resolution_ms, "max_ms": self.max_ms,
+                "sub_bucket_bits": self.sub_bucket_bits, "count": snapshot.count,
+                "min": snapshot.min, "max": snapshot.max, "sum": snapshot.sum,
+                "sum_squares": snapshot.sum_squares,
+                "counts": {str(i): c for i, c in enumerate(snapshot.counts) if c > 0}}
+
+
+def histogram_from_dict(obj):
+    # Create a latency_histogram from a dict returned by to_dict
+    histogram = latency_histogram(obj["resolution_ms"], obj["max_ms"], obj["sub_bucket_bits"])
+    for index, count in obj["counts"].items():
+        histogram.counts[int(index)] = count
+    histogram.count = obj["count"]
+    histogram.min = obj["min"]
+    histogram.max = obj["max"]
+    histogram.sum = obj["sum"]
+    histogram.sum_squares = obj["sum_squares"]
+    return histogram
@@ -0,0 +1,212 @@
+import argparse
+import queue
+import threading
+import time
+from stream_reader import stream_reader
+from fan_out import register_consumer
+
+
+"""
+Local stand-in of the Kinesis calls used by enhanced fan-out (DescribeStreamSummary, ListShards,
+RegisterStreamConsumer, DescribeStreamConsumer and SubscribeToShard), to try fan_out.py without an
+AWS account. Records put with put_record are pushed right away to the subscriptions of their shard,
+and every subscription ends after subscription_s seconds, like the real ones do after 5 minutes.
+When run, it puts records at a fixed rate, reads them with a stream_reader using enhanced fan-out,
+and prints the delay between putting and receiving them (and the number of subscriptions made).
+"""
+
+
+class _client_error(Exception):
+    # Error with the same attributes as a botocore ClientError, so get_error_code understands it
+    def __init__(self, code, message=""):
+        Exception.__init__(self, "{}: {}".format(code, message))
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class _exceptions(object):
+    # Exception classes of the client, like kinesis_client.exceptions
+    class ResourceInUseException(_client_error):
+        def __init__(self, message=""):
+            _client_error.__init__(self, "ResourceInUseException", message)
+
+    class ResourceNotFoundException(_client_error):
+        def __init__(self, message=""):
+            _client_error.__init__(self, "ResourceNotFoundException", message)
+
+
+class _meta(object):
+    region_name = "local"
+
+
+class local_event_stream(object):
+    # Iterable of SubscribeToShard events of one subscription, fed by the stand-in client
+    def __init__(self, duration_s, sequence_number, heartbeat_s=5.0):
+        self.events = queue.Queue()
+        self.deadline = time.monotonic() + duration_s
+        self.heartbeat_s = heartbeat_s
+        # Sequence number of the last record pushed (or of the starting position)
+        self.sequence_number = sequence_number
+        self.closed = False
+
+    def push(self, record):
+        self.events.put(record)
+
+    def __iter__(self):
+        while not self.closed and time.monotonic() < self.deadline:
+            # Wait for the first record, then take every record that is already waiting
+            timeout = min(self.heartbeat_s, max(self.deadline - time.monotonic(), 0))
+            records = []
+            try:
+                records.append(self.events.get(timeout=timeout))
+                while True:
+                    records.append(self.events.get_nowait())
+            except queue.Empty:
+                pass
+            if self.closed:
+                break
+            if len(records) > 0:
+                self.sequence_number = records[-1]["SequenceNumber"]
+            now_ms = int(time.time() * 1000)
+            lag_ms = 0 if len(records) == 0 else now_ms - records[0]["_put_ms"]
+            yield {"SubscribeToShardEvent": {
+                "Records": [{k: v for k, v in r.items() if k != "_put_ms"} for r in records],
+                "ContinuationSequenceNumber": self.sequence_number,
+                "MillisBehindLatest": max(lag_ms, 0)}}
+
+    def close(self):
+        self.closed = True
+
+
+class local_kinesis_client(object):
+    # Stream with shard_count shards that can only be read with enhanced fan-out
+    exceptions = _exceptions
+    meta = _meta
+
+    def __init__(self, stream_name, shard_count=1, subscription_s=300):
+        self.stream_name = stream_name
+        self.shard_ids = ["shardId-{:012d}".format(i) for i in range(shard_count)]
+        self.subscription_s = subscription_s
+        self.stream_arn = "arn:aws:kinesis:local:000000000000:stream/{}".format(stream_name)
+        self.lock = threading.Lock()
+        self.consumers = {}
+        self.subscriptions = {}
+        self.records = {shard_id: [] for shard_id in self.shard_ids}
+        self.sequence = 0
+        self.subscribe_calls = 0
+
+    def describe_stream_summary(self, StreamName):
+        if StreamName != self.stream_name:
+            raise self.exceptions.ResourceNotFoundException(StreamName)
+        return {"StreamDescriptionSummary": {"StreamName": StreamName, "StreamStatus": "ACTIVE",
+                                             "StreamARN": self.stream_arn}}
+
+    def list_shards(self, StreamName=None, NextToken=None):
+        return {"Shards": [{"ShardId": shard_id, "SequenceNumberRange": {
+            "StartingSequenceNumber": "0"}} for shard_id in self.shard_ids]}
+
+    def register_stream_consumer(self, StreamARN, ConsumerName):
+        with self.lock:
+            if ConsumerName in self.consumers:
+                raise self.exceptions.ResourceInUseException(ConsumerName)
+            self.consumers[ConsumerName] = {
+                "ConsumerName": ConsumerName, "ConsumerStatus": "ACTIVE",
+                "ConsumerARN": "{}/consumer/{}".format(StreamARN, ConsumerName)}
+            return {"Consumer": dict(self.consumers[ConsumerName])}
+
+    def describe_stream_consumer(self, StreamARN=None, ConsumerName=None, ConsumerARN=None):
+        with self.lock:
+            for consumer in self.consumers.values():
+                if (consumer["ConsumerName"] == ConsumerName or
+                        consumer["ConsumerARN"] == ConsumerARN):
+                    return {"ConsumerDescription": dict(consumer)}
+        raise self.exceptions.ResourceNotFoundException(ConsumerName or ConsumerARN)
+
+    def subscribe_to_shard(self, ConsumerARN, ShardId, StartingPosition):
+        # Push the records after the starting position first, and then the new ones (only
+        # LATEST, TRIM_HORIZON and AFTER_SEQUENCE_NUMBER are emulated)
+        with self.lock:
+            self.subscribe_calls += 1
+            previous = self.subscriptions.get((ConsumerARN, ShardId))
+            if previous is not None:
+                previous.close()
+            if StartingPosition["Type"] == "TRIM_HORIZON":
+                after = 0
+            elif StartingPosition["Type"] == "AFTER_SEQUENCE_NUMBER":
+                after = int(StartingPosition["SequenceNumber"])
+            else:
+                after = self.sequence
+            event_stream = local_event_stream(self.subscription_s, str(after))
+            for record in self.records[ShardId]:
+                if int(record["SequenceNumber"]) > after:
+                    event_stream.push(record)
+            self.subscriptions[(ConsumerARN, ShardId)] = event_stream
+        return {"EventStream": event_stream}
+
+    def put_record(self, StreamName, Data, PartitionKey):
+        with self.lock:
+            self.sequence += 1
+            shard_id = self.shard_ids[hash(PartitionKey) % len(self.shard_ids)]
+            record = {"SequenceNumber": str(self.sequence), "Data": Data,
+                      "PartitionKey": PartitionKey, "_put_ms": int(time.time() * 1000)}
+            self.records[shard_id].append(record)
+            for (_, subscribed_shard), event_stream in self.subscriptions.items():
+                if subscribed_shard == shard_id:
+                    event_stream.push(record)
+        return {"ShardId": shard_id, "SequenceNumber": record["SequenceNumber"]}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser("""
+Read records pushed by a local stand-in of enhanced fan-out, and print their delays.
+""")
+    parser.add_argument("-n", "--records", dest="records", type=int, default=200,
+                        help="Number of records put. Default is 200.", metavar="RECORDS",)
+    parser.add_argument("-p", "--period", dest="period", type=float, default=10,
+                        help="Period between records. Default is 10 ms.", metavar="MILLISECONDS",)
+    parser.add_argument("--shards", dest="shards", type=int, default=2,
+                        help="Number of shards of the stream. Default is 2.", metavar="SHARDS",)
+    parser.add_argument("--subscription", dest="subscription", type=float, default=0.5,
+                        help="Seconds every subscription lasts. Default is 0.5 s.",
+                        metavar="SECONDS",)
+    return parser.parse_args()
+
+
+def main():
+    args = create_parser()
+    stream_name = "local_stream"
+    kinesis_client = local_kinesis_client(stream_name, args.shards, args.subscription)
+    consumer_arn = register_consumer(kinesis_client, stream_name, "local_fan_out")
+
+    # Save the delay of every record received
+    delays_ms = []
+
+    def receive(shard_id, event):
+        now_ns = time.time_ns()
+        for r in event["Records"]:
+            delays_ms.append((now_ns - int(r["Data"])) / 1e6)
+        if len(delays_ms) >= args.records:
+            reader.stop()
+
+    reader = stream_reader(kinesis_client, stream_name, receive, "LATEST",
+                           consumer_arn=consumer_arn)
+    reader.start()
+    # Give the workers time to subscribe before putting records
+    time.sleep(0.1)
+    for i in range(args.records):
+        kinesis_client.put_record(StreamName=stream_name, Data=str(time.time_ns()).encode(),
+                                  PartitionKey=str(i))
+        time.sleep(args.period / 1000.0)
+    reader.wait(5)
+    reader.stop()
+
+    delays_ms.sort()
+    print("Received: {} of {} records".format(len(delays_ms), args.records))
+    print("Subscriptions: {}".format(kinesis_client.subscribe_calls))
+    if len(delays_ms) > 0:
+        print("Med: {:.3f} ms".format(delays_ms[len(delays_ms) // 2]))
+        print("Max: {:.3f} ms".format(delays_ms[-1]))
+    print("Stats: {}".format(reader.stats()))
+
+
+if __name__ == '__main__':
+    main()
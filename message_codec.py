@@ -0,0 +1,197 @@
+import datetime
+import json
+import re
+import struct
+import time
+
+
+"""
+Compact binary format for the messages sent between producers and consumers, as an alternative to
+json objects, and the timestamps of the messages.
+Every message starts with a header (magic byte, format version, msg_type), followed by an int64
+timestamp in nanoseconds since the epoch and the fields of its msg_type, packed with struct:
+    0 encoder:        value, sequence, counter
+    1 motor:          value, sequence, counter, timestamp2, timestamp3
+    2 goal:           value, sequence
+    3 motor+encoder:  encoder, motor, encoder_counter, motor_counter
+    4 pid:            p, i, d, sequence
+The counters of the encoder, motor and motor+encoder messages (iterations of the encoder loop)
+are uint64, as they pass 2^32 within hours. Every msg_type has a fixed size, so several messages
+can be concatenated in the same record.
+The magic byte can not start a json text (or any UTF-8 text), so consumers can use decode on any
+record and it will read the binary format, the columnar batches of columnar_batch.py and the legacy
+json objects.
+"""
+
+
+MAGIC = 0xB1
+COLUMNAR_MAGIC = 0xB2  # See columnar_batch.py
+VERSION = 2  # Version 2 packs the counters of msg_types 0, 1 and 3 as uint64
+HEADER_FORMAT = "<BBBq"  # magic, version, msg_type, timestamp
+MESSAGE_FIELDS = {
+    0: [("value", "d"), ("sequence", "I"), ("counter", "Q")],
+    1: [("value", "d"), ("sequence", "I"), ("counter", "Q"), ("timestamp2", "q"),
+        ("timestamp3", "q")],
+    2: [("value", "d"), ("sequence", "I")],
+    3: [("encoder", "i"), ("motor", "h"), ("encoder_counter", "Q"), ("motor_counter", "Q")],
+    4: [("p", "d"), ("i", "d"), ("d", "d"), ("sequence", "I")],
+}
+
+# Precompiled struct of every msg_type: (struct, field names, timestamp field names)
+_structs = {}
+for _msg_type, _fields in MESSAGE_FIELDS.items():
+    _structs[_msg_type] = (struct.Struct(HEADER_FORMAT + "".join(f[1] for f in _fields)),
+                           [f[0] for f in _fields],
+                           [f[0] for f in _fields if f[0].startswith("timestamp")])
+_header_struct = struct.Struct(HEADER_FORMAT)
+# "msg_type" field of a json message, found without parsing the whole text
+_json_msg_type = re.compile(rb'"msg_type"\s*:\s*(-?\d+)')
+
+
+class CodecError(ValueError):
+    pass
+
+
+def add_timestamp_argument(parser):
+    # Add the argument used to choose the timestamp format to an argparse parser
+    parser.add_argument("--ns_timestamps", dest="ns_timestamps", action="store_true",
+                        help="Use it to stamp json messages with an integer timestamp (ns since "
+                        "the epoch) and a monotonic clock field, instead of a date string.",)
+
+
+def add_codec_arguments(parser):
+    # Add the arguments used to choose the message format to an argparse parser
+    parser.add_argument("--binary", dest="binary", action="store_true", help="Use it to send "
+                        "messages in the compact binary format instead of json (binary messages "
+                        "always use integer timestamps).",)
+    add_timestamp_argument(parser)
+
+
+def timestamp_now():
+    # Return the current time as it is stored in binary messages (ns since the epoch)
+    return time.time_ns()
+
+
+def add_timestamp(obj, integer=False):
+    # Stamp a message with the current time, as ns since the epoch (and the monotonic clock in ns,
+    # to measure intervals in the same machine) or as the legacy date string
+    if integer:
+        obj["timestamp"] = time.time_ns()
+        obj["monotonic"] = time.monotonic_ns()
+    else:
+        obj["timestamp"] = str(datetime.datetime.now())
+
+
+def to_nanoseconds(timestamp):
+    # Convert a timestamp (ns since the epoch, or a legacy str(datetime.datetime.now())) to ns
+    if isinstance(timestamp, str):
+        date = datetime.datetime.fromisoformat(timestamp)
+        return int(date.timestamp()) * 1000000000 + date.microsecond * 1000
+    return int(timestamp)
+
+
+def to_datetime(timestamp):
+    # Convert a timestamp (ns since the epoch, or a legacy string) to a local naive datetime
+    if isinstance(timestamp, str):
+        return datetime.datetime.fromisoformat(timestamp)
+    seconds, nanoseconds = divmod(int(timestamp), 1000000000)
+    return datetime.datetime.fromtimestamp(seconds) + datetime.timedelta(
+        microseconds=nanoseconds // 1000)
+
+
+def is_binary(data):
+    # Return True if a record contains binary messages
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode(obj):
+    # Pack a message dict into bytes, missing fields are packed as 0
+    msg_type = obj.get("msg_type")
+    if msg_type not in _structs:
+        raise CodecError("Message type '{}' has no binary format.".format(msg_type))
+    packer, names, timestamps = _structs[msg_type]
+    timestamp = obj.get("timestamp")
+    values = [MAGIC, VERSION, msg_type,
+              timestamp_now() if timestamp is None else to_nanoseconds(timestamp)]
+    for name in names:
+        value = obj.get(name, 0)
+        values.append(to_nanoseconds(value) if name in timestamps else value)
+    try:
+        return packer.pack(*values)
+    except struct.error as e:
+        raise CodecError("Could not pack message type '{}': {}.".format(msg_type, e))
+
+
+def encode_many(objs):
+    # Pack a list of message dicts into the bytes of a single record
+    return b"".join(encode(obj) for obj in objs)
+
+
+def serialize(obj, binary=False):
+    # Return the record data of a message dict (or list of dicts), in binary or json
+    if not binary:
+        return json.dumps(obj)
+    if isinstance(obj, list):
+        return encode_many(obj)
+    return encode(obj)
+
+
+def decode_all(data):
+    # Return the list of message dicts in a record, binary, columnar or json
+    if len(data) > 0 and data[0] == COLUMNAR_MAGIC:
+        # Imported here so only the consumers that receive columnar batches need NumPy
+        from columnar_batch import decode_messages
+        return decode_messages(data)
+    if not is_binary(data):
+        obj = json.loads(data.decode("utf-8") if isinstance(data, bytes) else data)
+        return obj if isinstance(obj, list) else [obj]
+    objs = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < _header_struct.size:
+            raise CodecError("Truncated message header at byte {}.".format(offset))
+        magic, version, msg_type, _ = _header_struct.unpack_from(data, offset)
+        if magic != MAGIC or version != VERSION:
+            raise CodecError("Unsupported message (magic {}, version {}) at byte {}.".format(
+                magic, version, offset))
+        if msg_type not in _structs:
+            raise CodecError("Unknown message type '{}' at byte {}.".format(msg_type, offset))
+        packer, names, _ = _structs[msg_type]
+        if len(data) - offset < packer.size:
+            raise CodecError("Truncated message of type '{}' at byte {}.".format(msg_type,
+                                                                                  offset))
+        values = packer.unpack_from(data, offset)
+        obj = {"msg_type": msg_type, "timestamp": values[3]}
+        obj.update(zip(names, values[4:]))
+        objs.append(obj)
+        offset += packer.size
+    return objs
+
+
+def peek_msg_type(data):
+    # Return the msg_type of a record that contains a single message, reading only its header (or
+    # searching the field in the json text). Return None if the record must be decoded to know it
+    # (several messages, columnar batches, or json without a numeric msg_type)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if is_binary(data):
+        if len(data) < _header_struct.size:
+            return None
+        msg_type = data[2]
+        if msg_type not in _structs or len(data) != _structs[msg_type][0].size:
+            return None
+        return msg_type
+    if len(data) == 0 or data[:1] != b"{":
+        return None
+    matches = _json_msg_type.findall(data)
+    if len(matches) != 1:
+        return None
+    return int(matches[0])
+
+
+def decode(data):
+    # Return the message of a record like json.loads would: a dict, or a list if there are many
+    if not is_binary(data) and not (len(data) > 0 and data[0] == COLUMNAR_MAGIC):
+        return json.loads(data.decode("utf-8") if isinstance(data, bytes) else data)
+    objs = decode_all(data)
+    return objs[0] if len(objs) == 1 else objs
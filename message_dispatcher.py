@@ -0,0 +1,90 @@
+import time
+from record_aggregator import deaggregate_records
+from message_codec import decode_all
+from metrics import metrics
+
+
+"""
+Route the messages of every batch of records to handlers registered by msg_type, instead of an
+if/elif chain run for every message. Every batch (a GetRecords response, or an event pushed by
+SubscribeToShard) is decoded once, its messages are grouped by msg_type, and every handler is
+called once with all the messages of its types, as a list of (record, message) pairs in the order
+they were received. Handlers are called in the order they were registered, so a handler that
+updates some state (a goal position, for example) can be registered before the ones that use it.
+Messages of types without a handler are ignored (and counted).
+The pacing sleep of the consumers (--period) is done once per batch, after all handlers, instead
+of after every record. If a conflator (see conflation.py) is given, it decodes the batches, so
+the handlers only receive the newest message of every msg_type and device.
+"""
+
+
+class message_dispatcher(object):
+    # Call the handlers registered for every msg_type with the messages of a batch
+    def __init__(self, period_ms=None, conflator=None):
+        # Save inputs
+        self.sleep_s = 0.0 if period_ms is None or period_ms < 0 else period_ms / 1000.0
+        self.conflator = conflator
+
+        # Create handlers: list of (msg_types, handler), and msg_type -> position in the list
+        self.handlers = []
+        self.routes = {}
+
+        # Create statistics variables
+        self.batches = 0
+        self.messages = 0
+        self.ignored = 0
+        self.handler_calls = 0
+        metrics().collect("dispatcher", self.stats)
+
+    def register(self, msg_types, handler):
+        # Call handler(messages) with the (record, message) pairs of msg_types (a msg_type or a
+        # list of them) of every batch
+        if not isinstance(msg_types, (list, tuple, set)):
+            msg_types = [msg_types]
+        for msg_type in msg_types:
+            if msg_type in self.routes:
+                raise ValueError("Message type '{}' already has a handler.".format(msg_type))
+            self.routes[msg_type] = len(self.handlers)
+        self.handlers.append((list(msg_types), handler))
+        return handler
+
+    def decode(self, records):
+        # Return the (record, message) pairs of a batch of records
+        if self.conflator is not None:
+            return self.conflator.conflate_records(records)
+        return [(record, obj) for record in deaggregate_records(records)
+                for obj in decode_all(record["Data"])]
+
+    def dispatch(self, shard_id, response):
+        # Callback of a stream_reader: give the messages of a batch to their handlers, and wait
+        # the pacing period once
+        self.route(self.decode(response["Records"]))
+        self.pace()
+
+    def route(self, messages):
+        # Give a list of (record, message) pairs to the handlers of their msg_types
+        groups = [[] for _ in self.handlers]
+        routes = self.routes
+        ignored = 0
+        for record, obj in messages:
+            position = routes.get(obj.get("msg_type"))
+            if position is None:
+                ignored += 1
+            else:
+                groups[position].append((record, obj))
+        self.batches += 1
+        self.messages += len(messages)
+        self.ignored += ignored
+        for (_, handler), group in zip(self.handlers, groups):
+            if len(group) > 0:
+                self.handler_calls += 1
+                handler(group)
+
+    def pace(self):
+        # Wait the pacing period (once per batch)
+        if self.sleep_s > 0:
+            time.sleep(self.sleep_s)
+
+    def stats(self):
+        return {"batches": self.batches, "messages": self.messages, "ignored": self.ignored,
+                "handler_calls": self.handler_calls}
@@ -0,0 +1,327 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+import weakref
+
+
+"""
+Metrics of the producers and consumers (records and bytes sent and received, latency of the
+Kinesis calls, retries, throttles, MillisBehindLatest, queue depths, jitter of the control loops),
+exported while they run:
+    --metrics_port   Serve them in the Prometheus text format at http://127.0.0.1:PORT/metrics
+                     (and as json at /metrics.json).
+    --metrics_file   Save them as json into a file every --metrics_period seconds (and at exit).
+Counters and histograms are updated in the hot path, so they never take a lock: every thread
+writes into its own cells (created the first time the thread uses the metric), and the cells of
+all threads are added up when the metrics are exported. An update costs about a microsecond, far
+from the 1 ms period of the control loops.
+Everything else is read only when the metrics are exported: objects that already keep statistics
+(batch_sender, retry_engine, stream_reader...) register their stats method as a collector, and
+every numeric value it returns becomes a gauge. Collectors are held with weak references, and the
+values of collectors registered with the same name are added up.
+"""
+
+
+# Bucket upper bounds of the latency histograms (ms)
+LATENCY_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                      10000]
+# Bucket upper bounds of the jitter histograms of the control loops (ms)
+JITTER_BUCKETS_MS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 100]
+
+
+def add_metrics_arguments(parser):
+    # Add the arguments used to export the metrics to an argparse parser
+    parser.add_argument("--metrics_port", dest="metrics_port", type=int, default=None,
+                        help="Port of the local HTTP server that exports the metrics in the "
+                        "Prometheus text format. If not set, there is no server.", metavar="PORT",)
+    parser.add_argument("--metrics_file", dest="metrics_file", default=None, help="Json file "
+                        "where the metrics are saved periodically. If not set, they are not "
+                        "saved.", metavar="FILE_NAME",)
+    parser.add_argument("--metrics_period", dest="metrics_period", type=float, default=10,
+                        help="Period to save the metrics into --metrics_file. Default is 10 s.",
+                        metavar="SECONDS",)
+
+
+class _thread_cells(object):
+    # A list of numbers per thread, only written by its thread, that are added up when read
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cells = []
+
+    def cell(self):
+        # Return the cell of the calling thread (the lock is only taken the first time)
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = [0] * self.size
+            with self.lock:
+                self.cells.append(cell)
+            self.local.cell = cell
+            return cell
+
+    def total(self):
+        # Return the sum of the cells of every thread (the cells of finished threads are kept)
+        with self.lock:
+            cells = list(self.cells)
+        return [sum(values) for values in zip(*cells)] if len(cells) > 0 else [0] * self.size
+
+
+class counter(object):
+    # Number that only grows (records sent, bytes received...)
+    def __init__(self, name, description=""):
+        self.name = name
+        self.description = description
+        self.cells = _thread_cells(1)
+
+    def inc(self, amount=1):
+        self.cells.cell()[0] += amount
+
+    def value(self):
+        return self.cells.total()[0]
+
+
+class histogram(object):
+    # Count of the values observed in every bucket, and their sum
+    def __init__(self, name, description="", bounds=LATENCY_BUCKETS_MS):
+        self.name = name
+        self.description = description
+        self.bounds = sorted(bounds)
+        # Cell of every thread: one count per bucket (the last one is +Inf), then the sum
+        self.cells = _thread_cells(len(self.bounds) + 2)
+
+    def observe(self, value):
+        cell = self.cells.cell()
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def value(self):
+        # Return the cumulative counts of every bucket (upper bound, count), the count and the sum
+        total = self.cells.total()
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + [float("inf")], total[:-1]):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {"buckets": buckets, "count": cumulative, "sum": total[-1]}
+
+
+class metrics_registry(object):
+    # Counters, histograms and collectors of a process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = {}
+
+    def counter(self, name, description=""):
+        # Return the counter called name, creating it the first time
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = counter(name, description)
+            return self.counters[name]
+
+    def histogram(self, name, description="", bounds=LATENCY_BUCKETS_MS):
+        # Return the histogram called name, creating it the first time
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = histogram(name, description, bounds)
+            return self.histograms[name]
+
+    def collect(self, name, function):
+        # Export every numeric value of the dict returned by function (usually the stats method
+        # of an object) as the gauge name_key. Bound methods do not keep their object alive
+        if hasattr(function, "__self__"):
+            reference = weakref.WeakMethod(function)
+        else:
+            reference = lambda: function
+        with self.lock:
+            self.collectors.setdefault(name, []).append(reference)
+
+    def gauges(self):
+        # Call the collectors and return their values by gauge name
+        with self.lock:
+            collectors = {name: list(references) for name, references in self.collectors.items()}
+        values = {}
+        for name, references in collectors.items():
+            alive = []
+            for reference in references:
+                function = reference()
+                if function is None:
+                    continue
+                alive.append(reference)
+                try:
+                    stats = function()
+                except Exception:
+                    continue
+                for key, value in stats.items():
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if isinstance(value, (int, float)):
+                        gauge = "{}_{}".format(name, key)
+                        values[gauge] = values.get(gauge, 0) + value
+            if len(alive) < len(references):
+                # Forget the collectors of objects that no longer exist
+                with self.lock:
+                    self.collectors[name] = [r for r in self.collectors.get(name, [])
+                                             if r() is not None]
+        return values
+
+    def snapshot(self):
+        # Return every metric in a json serializable dict
+        with self.lock:
+            counters = list(self.counters.values())
+            histograms = list(self.histograms.values())
+        result = {"time": time.time(), "pid": os.getpid(),
+                  "script": os.path.basename(sys.argv[0]),
+                  "counters": {c.name: c.value() for c in counters},
+                  "gauges": self.gauges(), "histograms": {}}
+        for h in histograms:
+            value = h.value()
+            value["buckets"] = [["+Inf" if b == float("inf") else b, c]
+                                for b, c in value["buckets"]]
+            result["histograms"][h.name] = value
+        return result
+
+    def prometheus_text(self):
+        # Return every metric in the Prometheus text exposition format
+        with self.lock:
+            counters = list(self.counters.values())
+            histograms = list(self.histograms.values())
+        lines = []
+        for c in counters:
+            lines.append("# HELP {} {}".format(c.name, c.description or c.name))
+            lines.append("# TYPE {} counter".format(c.name))
+            lines.append("{} {}".format(c.name, c.value()))
+        for name, value in sorted(self.gauges().items()):
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+        for h in histograms:
+            value = h.value()
+            lines.append("# HELP {} {}".format(h.name, h.description or h.name))
+            lines.append("# TYPE {} histogram".format(h.name))
+            for bound, count in value["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append('{}_bucket{{le="{}"}} {}'.format(h.name, le, count))
+            lines.append("{}_sum {}".format(h.name, value["sum"]))
+            lines.append("{}_count {}".format(h.name, value["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# Registry shared by every module and thread of this process
+_registry = metrics_registry()
+
+
+def metrics():
+    # Return the metrics registry of this process
+    return _registry
+
+
+class metrics_exporter(object):
+    # Export the metrics of a registry through HTTP and/or into a json file periodically
+    def __init__(self, registry, port=None, filename=None, period=10, address="127.0.0.1"):
+        # Save inputs
+        self.registry = registry
+        self.port = port
+        self.filename = filename
+        self.period = max(period, 0.1)
+        self.address = address
+
+        # Create server and threads (started in start)
+        self.server = None
+        self.threads = []
+
+        # Create variable to stop the threads
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            # Imported here, so the scripts that do not export metrics do not pay for it
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            registry = self.registry
+
+            class handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path == "/metrics":
+                        body = registry.prometheus_text().encode("utf-8")
+                        content_type = "text/plain; version=0.0.4"
+                    elif self.path == "/metrics.json":
+                        body = json.dumps(registry.snapshot()).encode("utf-8")
+                        content_type = "application/json"
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self.server = ThreadingHTTPServer((self.address, self.port), handler)
+                self.server.daemon_threads = True
+                self.add_thread(self.server.serve_forever)
+                print("Exporting metrics at http://{}:{}/metrics.".format(self.address,
+                                                                         self.server.server_port))
+            except OSError as e:
+                print("Could not export metrics on port {}: {}.".format(self.port, e))
+        if self.filename is not None:
+            self.add_thread(self.dump_periodically)
+
+    def add_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def dump(self):
+        # Save the metrics into filename (written to a temporary file first, so it is never
+        # corrupt)
+        temporary = "{}.{}.tmp".format(self.filename, os.getpid())
+        try:
+            with open(temporary, "w") as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            print("Could not save metrics into '{}': {}.".format(self.filename, e))
+
+    def dump_periodically(self):
+        while not self.stop_event.wait(self.period):
+            self.dump()
+
+    def stop(self):
+        # Stop the server, and save the metrics a last time
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.filename is not None:
+            self.dump()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def start_metrics_exporter(args):
+    # Start the exporter of this process with the settings parsed with add_metrics_arguments (only
+    # the first call starts it). Return it, or None if the metrics are not exported
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None and (args.metrics_port is not None or
+                                  args.metrics_file is not None):
+            _exporter = metrics_exporter(_registry, args.metrics_port, args.metrics_file,
+                                         args.metrics_period)
+            _exporter.start()
+            # Save the last values when the script finishes
+            import atexit
+            atexit.register(_exporter.stop)
+        return _exporter
@@ -1,9 +1,13 @@
 import argparse
 import atexit
-import boto3
-import json
-import time
 from Adafruit_MotorHAT import Adafruit_MotorHAT
+from conflation import add_conflation_arguments, create_conflator
+from kinesis_session import add_session_arguments, create_kinesis_client
+from stream_metadata import find_stream_shards
+from stream_reader import stream_reader
+from checkpoint_store import add_checkpoint_arguments, create_checkpoint_store
+from adaptive_poller import add_poller_arguments
+from fan_out import add_fan_out_argument, create_fan_out_consumer
 
 
 def create_parser():
@@ -16,7 +20,8 @@ Read and print the contents of a selected stream as fast as possible, and plot p
                         help="The region you'd like to make this stream in. Default is "
                         "'us-east-1'", metavar="REGION_NAME",)
     parser.add_argument("-p", "--period", dest="period", type=int, default=None,
-                        help="How often to read stream. Default is 0.", metavar="MILLISECONDS",)
+                        help="How often to read stream once it has caught up. Default is "
+                        "--poll_rate.", metavar="MILLISECONDS",)
     choices = ["LATEST", "TRIM_HORIZON"]
     parser.add_argument("-sit", "--shard_iterator_type", dest="shard_iterator_type", type=str,
                         default=choices[0], choices=choices, help="Select what data will be "
@@ -25,6 +30,11 @@ Read and print the contents of a selected stream as fast as possible, and plot p
                         metavar="SHARD_ITERATOR_TYPE")
     parser.add_argument("--motor", "-m", dest="motor", default=1, type=int, help="The motor "
                         "that is being controlled. Default is 1.", choices=[1, 2, 3, 4])
+    add_session_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_poller_arguments(parser)
+    add_conflation_arguments(parser)
+    add_fan_out_argument(parser)
     return parser.parse_args()
 
 
@@ -33,28 +43,11 @@ def main():
     stream_name = args.stream_name
 
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status != "ACTIVE":
-            print("The stream '{}' has status {}, please rerun the script when the stream "
-                  "is ACTIVE.".format(stream_name))
-            return
-        else:
-            shard_id = stream_description["StreamDescription"]["Shards"][0]["ShardId"]
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("The stream '{}' was not found, please rerun the script when the stream has "
-              "been created.".format(stream_name))
+    kinesis_client = create_kinesis_client(args.region, args)
+    # Read the shards of the stream from the shared metadata cache, waiting for it to be ACTIVE
+    if find_stream_shards(kinesis_client, stream_name) is None:
         return
 
-    # If we reach this point, the string is active
-    shard_iterator_type = args.shard_iterator_type
-    shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
-                                                       ShardIteratorType=shard_iterator_type)["ShardIterator"]
-
     # Create default object to control the motor using the MototrHAT (I2C)
     mh = Adafruit_MotorHAT(addr=0x60)
 
@@ -69,20 +62,17 @@ def main():
         mh.getMotor(4).run(Adafruit_MotorHAT.RELEASE)
     atexit.register(turnOffMotors)
 
-    # Read stream forever and move motor at the received speed
-    max_num_records = 10000
-    sleep_s = 0.0 if args.period is None or args.period < 0 else args.period / 1000.0
-    prev_speed = None
-    prev_direction = None
-    while True:
+    # Read all shards of the stream forever and move motor at the received speed
+    motor_state = {"speed": None, "direction": None}
+    # Only the newest speed of every batch is decoded and applied
+    conflator = create_conflator(args)
+
+    def move_motor(shard_id, response):
         try:
-            records = kinesis_client.get_records(ShardIterator=shard_iterator,
-                                                 Limit=max_num_records)
-            shard_iterator = records["NextShardIterator"]  # Update shard_iterator
             # Move motor at speed received
-            if len(records["Records"]) > 0:
-                last_record = records["Records"][-1]["Data"]
-                speed = int(json.loads(last_record.decode("utf-8"))["value"])
+            messages = conflator.conflate(response["Records"])
+            if len(messages) > 0:
+                speed = int(messages[-1]["value"])
                 direction = 1
                 if speed < 0:
                     speed = -speed
@@ -90,20 +80,35 @@ def main():
                 if speed == 999:
                     # 999 speed will release the motors
                     motor.run(Adafruit_MotorHAT.RELEASE)
-                    prev_speed = speed
-                    prev_direction = 0
+                    motor_state["speed"] = speed
+                    motor_state["direction"] = 0
                 else:
                     if speed > 255:
                         speed = 255
-                    if direction != prev_direction:
+                    if direction != motor_state["direction"]:
                         motor.run(Adafruit_MotorHAT.FORWARD if direction == 1 else Adafruit_MotorHAT.BACKWARD)
-                    prev_direction = direction
-                    if speed != prev_speed:
+                    motor_state["direction"] = direction
+                    if speed != motor_state["speed"]:
                         motor.setSpeed(speed)
-                    prev_speed = speed
-            time.sleep(sleep_s)
+                    motor_state["speed"] = speed
         except Exception as e:
-            time.sleep(0.01)
+            pass
+
+    # Register the enhanced fan-out consumer if --fan_out is set (the records are pushed)
+    consumer_arn = create_fan_out_consumer(args, kinesis_client, stream_name)
+    # Save the last record processed in every shard, to continue from it after a restart
+    checkpoint = create_checkpoint_store(args, stream_name)
+    reader = stream_reader(kinesis_client, stream_name, move_motor, args.shard_iterator_type,
+                           period_ms=args.period, checkpoint=checkpoint,
+                           poll_rate=args.poll_rate, catch_up_lag_ms=args.catch_up_lag,
+                           consumer_arn=consumer_arn)
+    try:
+        reader.start()
+        reader.wait()
+    finally:
+        reader.stop()
+        if checkpoint is not None:
+            checkpoint.stop()
 
 
 if __name__ == '__main__':
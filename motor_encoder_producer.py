@@ -1,12 +1,18 @@
 from Adafruit_MotorHAT import Adafruit_MotorHAT
 from RPi import GPIO
 import argparse
-import boto3
 import datetime
-import json
 import numpy as np
 import threading
 import time
+from retry_engine import add_retry_arguments, create_retry_engine
+from record_aggregator import add_aggregation_arguments, record_aggregator
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from message_codec import add_codec_arguments, add_timestamp, serialize
+from columnar_batch import add_columnar_arguments, encode_columns
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
+from startup_benchmark import add_startup_arguments, report_first_sample
+from metrics import JITTER_BUCKETS_MS, metrics
 
 
 """
@@ -55,46 +61,17 @@ for System Identification.""")
     parser.add_argument("-ns", "--number_samples", dest="number_samples", type=int,
                         help="Number of samples (values sent to the motor) before stopping the"
                         " program. Default is 10000.", default=10000, metavar="MOTOR_WRITES",)
+    add_aggregation_arguments(parser)
+    add_retry_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_codec_arguments(parser)
+    add_columnar_arguments(parser)
+    add_session_arguments(parser)
+    add_startup_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 class encoder_reader(threading.Thread):
     # Parse encoder as fast as possible
     def __init__(self, clk, dt, one_turn_value=500, message_type=0):
@@ -154,7 +131,9 @@ class encoder_reader(threading.Thread):
 
 class motor_writer(threading.Thread):
     # Write motor and read encoder, and save both values into a list
-    def __init__(self, motor, encoder_reader, num_samples=10000, period_ms=1, message_type=3):
+    def __init__(self, motor, encoder_reader, num_samples=10000, period_ms=1, message_type=3,
+                 binary=False, columnar=False, compress=False, ns_timestamps=False,
+                 first_sample_budget=None):
         threading.Thread.__init__(self)
 
         # Save inputs
@@ -164,6 +143,11 @@ class motor_writer(threading.Thread):
         self.period_ms = period_ms
         self.period = datetime.timedelta(seconds=self.period_ms / 1000)
         self.message_type = message_type
+        self.binary = binary
+        self.columnar = columnar
+        self.compress = compress
+        self.ns_timestamps = ns_timestamps
+        self.first_sample_budget = first_sample_budget
 
         # Create default object to control the motor using the MototrHAT (I2C)
         self.mh = Adafruit_MotorHAT(addr=0x60)
@@ -183,6 +167,11 @@ class motor_writer(threading.Thread):
         self.prev_direction = None
         self.prev_speed = None
 
+        # Create histogram of the difference between the period of every loop and period_ms
+        self.jitter = metrics().histogram("control_loop_jitter_ms", "Difference between the "
+                                          "period of the control loop and its target in ms",
+                                          JITTER_BUCKETS_MS)
+
         # Create variable to stop thread
         self.stop_event = threading.Event()
 
@@ -225,6 +214,7 @@ class motor_writer(threading.Thread):
     def run(self):
         # Move motor pseudo-randomly and save encoder and motor values
         self.counter = 0
+        loop_time = None
         try:
             while not self.stop_event.is_set():
                 # Calculate termination time
@@ -232,11 +222,17 @@ class motor_writer(threading.Thread):
                 # Active wait because apparently time.sleep has an accuracy of ~1ms
                 while datetime.datetime.now() < terminate_time:
                     pass
+                now = time.perf_counter()
+                if loop_time is not None:
+                    self.jitter.observe(abs(1000 * (now - loop_time) - self.period_ms))
+                loop_time = now
                 encoder_value, i = self.reader.value()
                 motor_value = int(self.motor_values[self.counter])
                 self.move_motor(motor_value)
                 self.add_json_to_list(encoder_value, motor_value, i)
                 self.counter += 1
+                if self.counter == 1:
+                    report_first_sample(self.first_sample_budget)
                 if self.counter >= self.num_samples:
                     break
         finally:
@@ -250,18 +246,30 @@ class motor_writer(threading.Thread):
         obj["msg_type"] = self.message_type
         obj["encoder"] = encoder_value
         obj["motor"] = motor_value
-        obj["timestamp"] = str(datetime.datetime.now())
+        add_timestamp(obj, self.binary or self.columnar or self.ns_timestamps)
         obj["encoder_counter"] = encoder_counter
         obj["motor_counter"] = self.counter
         self.json_list.append(obj)
 
     def status(self):
         last = self.counter
-        obj = self.json_list[self.json_idx:self.counter]
+        obj = self.json_list[self.json_idx:last]
+        self.json_idx = last
+        if len(obj) == 0:
+            return None
+        self.message_number += 1
+        # Convert list of dictionaries to columns, json or the binary format and return it
+        if self.columnar:
+            return encode_columns(obj, msg_type=self.message_type, compress=self.compress)
+        return serialize(obj, self.binary)
+
+    def status_messages(self):
+        # Like status, but return every new sample as a separate message
+        last = self.counter
+        objs = self.json_list[self.json_idx:last]
         self.json_idx = last
         self.message_number += 1
-        # Convert dictionary to json and return it
-        return json.dumps(obj)
+        return [serialize(obj, self.binary) for obj in objs]
 
     def value(self):
         # Return motor value
@@ -274,15 +282,52 @@ class motor_writer(threading.Thread):
         return self.stop_event.is_set()
 
 
+def put_encoder_motor_record(kinesis_client, stream_name, data, description, partitioner,
+                             retry):
+    # Send a record into stream, printing description if it succeeds
+    try:
+        retry.call(kinesis_client.put_record, StreamName=stream_name, Data=data,
+                   **partitioner.partition(msg_type=3))
+        print("Sent encoder message {} into stream '{}'.".format(description, stream_name))
+    except Exception as e:
+        print("Encountered an exception while trying to put record sensor data into "
+              "stream '{}'.".format(stream_name))
+        print("Exception: {}.".format(e))
+
+
+def send_status(kinesis_client, stream_name, writer, partitioner, retry, aggregator=None):
+    # Send the samples saved by the writer since the last call, as a single record or aggregated
+    # (columnar batches are already a single record, they are never aggregated)
+    if aggregator is None or writer.columnar:
+        encoder_motor_str = writer.status()
+        if encoder_motor_str is not None:
+            description = encoder_motor_str
+            if writer.columnar:
+                description = "(columnar, {} bytes)".format(len(encoder_motor_str))
+            elif writer.binary:
+                description = "(binary, {} bytes)".format(len(encoder_motor_str))
+            put_encoder_motor_record(kinesis_client, stream_name, encoder_motor_str,
+                                     description, partitioner, retry)
+        return
+    records = [aggregator.add(message) for message in writer.status_messages()]
+    records.append(aggregator.flush())
+    for record in records:
+        if record is not None:
+            put_encoder_motor_record(kinesis_client, stream_name, record,
+                                     "(aggregated, {} bytes)".format(len(record)), partitioner,
+                                     retry)
+
+
 def main():
     args = create_parser()
 
     # Create and connect to stream
     stream_name = args.stream_name
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    if not connect_to_stream(kinesis_client, stream_name):
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
         return
+    prewarm(kinesis_client, stream_name, args.prewarm)
 
     # Start thread to monitor encoder's position
     reader = encoder_reader(args.clk, args.dt)
@@ -290,40 +335,35 @@ def main():
 
     # Start thread to change motor's position
     writer = motor_writer(args.motor, reader, period_ms=args.motor_period,
-                          num_samples=args.number_samples)
+                          num_samples=args.number_samples, binary=args.binary,
+                          columnar=args.columnar, compress=args.compress,
+                          ns_timestamps=args.ns_timestamps,
+                          first_sample_budget=args.first_sample_budget)
     writer.start()
 
+    # Choose how records are spread over the shards of the stream
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key=";P")
+
+    # Retry throttled records instead of dropping them
+    retry = create_retry_engine(args)
+
+    # Create aggregator to pack the samples into records, if requested
+    aggregator = None
+    if args.aggregate:
+        aggregator = record_aggregator(max_messages=args.aggregate_messages)
+
     # Send encoder values into stream at args.period rate
     sleep_s = 0.0 if args.period is None or args.period < 0 else args.period / 1000.0
     try:
         while not writer.finished():
-            encoder_motor_str = writer.status()
-            if encoder_motor_str != "[]":
-                try:
-                    kinesis_client.put_record(StreamName=stream_name, Data=encoder_motor_str,
-                                              PartitionKey=";P")
-                    print("Sent encoder message {} into stream '{}'.".format(encoder_motor_str,
-                                                                             stream_name))
-                except Exception as e:
-                    print("Encountered an exception while trying to put record sensor data into "
-                          "stream '{}'.".format(stream_name))
-                    print("Exception: {}.".format(e))
+            send_status(kinesis_client, stream_name, writer, partitioner, retry, aggregator)
             time.sleep(sleep_s)
         # Send remaining messages before terminating
-        encoder_motor_str = writer.status()
-        if encoder_motor_str != "[]":
-            try:
-                kinesis_client.put_record(StreamName=stream_name, Data=encoder_motor_str,
-                                          PartitionKey=";P")
-                print("Sent encoder message {} into stream '{}'.".format(encoder_motor_str,
-                                                                         stream_name))
-            except Exception as e:
-                print("Encountered an exception while trying to put record sensor data into "
-                      "stream '{}'.".format(stream_name))
-                print("Exception: {}.".format(e))
+        send_status(kinesis_client, stream_name, writer, partitioner, retry, aggregator)
     finally:
         writer.stop()
         reader.stop()
+        print("Retry stats: {}".format(retry.stats()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+import json
+import numpy as np
+from message_codec import MAGIC, MESSAGE_FIELDS, VERSION, decode_all, is_binary, \
+    peek_msg_type, to_nanoseconds
+
+
+"""
+Vectorized version of the transformation done by encoder_motor_converter.py: a whole batch of
+encoder messages (msg_type 0) is turned into motor messages (msg_type 1) with NumPy, instead of
+one message at a time.
+    decode_encoder_records  Read the encoder messages of a batch of records into NumPy columns.
+                            Binary records are joined and read with a single np.frombuffer (every
+                            msg_type has a fixed size); json records are decoded one by one.
+    p_transform             Wrap the encoder values to degrees and apply the P gain to all of
+                            them at once. The goal can be a number or an array (one per message).
+    encode_motor_messages   Return the data of a record for every motor message. Binary messages
+                            are packed at once into a NumPy structured array.
+Records with other messages (or with several messages of different types) are returned apart, to
+be handled message by message.
+"""
+
+
+def message_dtype(msg_type):
+    # Return the NumPy dtype of a binary message of msg_type (see message_codec.py)
+    fields = [("magic", "u1"), ("version", "u1"), ("msg_type", "u1"), ("timestamp", "<i8")]
+    fields += [(name, "<" + code) for name, code in MESSAGE_FIELDS[msg_type]]
+    return np.dtype(fields)
+
+
+ENCODER_DTYPE = message_dtype(0)
+MOTOR_DTYPE = message_dtype(1)
+ENCODER_HEADER = bytes([MAGIC, VERSION, 0])
+ENCODER_COLUMNS = ["timestamp", "value", "sequence", "counter"]
+
+
+class encoder_batch(object):
+    # Encoder messages of a batch of records, in the order they were received
+    def __init__(self, columns, partition_keys, objs):
+        # NumPy array of every field in ENCODER_COLUMNS (timestamps in ns)
+        self.columns = columns
+        # Partition key of the record of every message
+        self.partition_keys = partition_keys
+        # Decoded dict of every json message (None for binary ones), to keep their other fields
+        self.objs = objs
+
+    def __len__(self):
+        return len(self.partition_keys)
+
+    @property
+    def values(self):
+        return self.columns["value"]
+
+
+def _encoder_count(data):
+    # Return the number of messages of a record that only contains binary encoder messages, and 0
+    # if it has other messages
+    size = ENCODER_DTYPE.itemsize
+    if len(data) % size != 0 or data[:3] != ENCODER_HEADER:
+        return 0
+    count = len(data) // size
+    if count > 1 and not (data[0::size] == bytes([MAGIC]) * count and
+                          data[1::size] == bytes([VERSION]) * count and
+                          data[2::size] == bytes(count)):
+        return 0
+    return count
+
+
+def decode_encoder_records(records):
+    # Split a list of (deaggregated) records into an encoder_batch with their encoder messages,
+    # and the list of records with other messages
+    binary_data = []
+    binary_counts = []
+    binary_positions = []
+    json_objs = []
+    json_positions = []
+    others = []
+    keys = []
+    for record in records:
+        data = record["Data"]
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        count = _encoder_count(data)
+        if count > 0:
+            binary_data.append(data)
+            binary_counts.append(count)
+            binary_positions.append(len(keys))
+            keys.append(record["PartitionKey"])
+        elif not is_binary(data) and peek_msg_type(data) == 0:
+            json_objs.append(decode_all(data)[0])
+            json_positions.append(len(keys))
+            keys.append(record["PartitionKey"])
+        else:
+            others.append(record)
+
+    # Read all binary messages at once, then add the json ones
+    messages = np.frombuffer(b"".join(binary_data), dtype=ENCODER_DTYPE)
+    columns = {}
+    for name in ENCODER_COLUMNS:
+        if name == "timestamp":
+            json_column = [to_nanoseconds(obj.get(name, 0)) for obj in json_objs]
+        else:
+            json_column = [obj.get(name, 0) for obj in json_objs]
+        dtype = np.float64 if name == "value" else np.int64
+        columns[name] = np.concatenate([messages[name].astype(dtype),
+                                        np.array(json_column, dtype=dtype)])
+
+    # Restore the order of the records (binary messages were read first)
+    positions = np.concatenate([np.repeat(np.array(binary_positions, dtype=np.int64),
+                                          binary_counts),
+                                np.array(json_positions, dtype=np.int64)])
+    objs = [None] * len(messages) + json_objs
+    if len(json_objs) > 0 and len(binary_data) > 0:
+        order = np.argsort(positions, kind="stable")
+        for name in ENCODER_COLUMNS:
+            columns[name] = columns[name][order]
+        positions = positions[order]
+        objs = [objs[i] for i in order.tolist()]
+    partition_keys = [keys[i] for i in positions.tolist()]
+    return encoder_batch(columns, partition_keys, objs), others
+
+
+def encoder_batch_from_messages(messages):
+    # Return an encoder_batch with a list of decoded (record, message) pairs of msg_type 0
+    columns = {}
+    for name in ENCODER_COLUMNS:
+        dtype = np.float64 if name == "value" else np.int64
+        if name == "timestamp":
+            column = [to_nanoseconds(obj.get(name, 0)) for _, obj in messages]
+        else:
+            column = [obj.get(name, 0) for _, obj in messages]
+        columns[name] = np.array(column, dtype=dtype)
+    return encoder_batch(columns, [record["PartitionKey"] for record, _ in messages],
+                         [obj for _, obj in messages])
+
+
+def p_transform(values, goal, p_constant, invert=True):
+    # Transform encoder values from linear to degrees, and apply the P gain to their error
+    degrees = np.mod(values, 360)
+    degrees = np.where(degrees > 180, 360 - degrees, degrees)
+    motor_values = (degrees - goal) * p_constant
+    return -motor_values if invert else motor_values
+
+
+def encode_motor_messages(batch, values, timestamp2, timestamp3, binary=False):
+    # Return the data of a record for every motor message of a batch, with the transformed values
+    # and the timestamps given (in the format of the output messages)
+    columns = batch.columns
+    if binary:
+        messages = np.zeros(len(batch), dtype=MOTOR_DTYPE)
+        messages["magic"] = MAGIC
+        messages["version"] = VERSION
+        messages["msg_type"] = 1
+        messages["value"] = values
+        for name in ("timestamp", "sequence", "counter"):
+            messages[name] = columns[name]
+        messages["timestamp2"] = to_nanoseconds(timestamp2)
+        messages["timestamp3"] = to_nanoseconds(timestamp3)
+        data = messages.tobytes()
+        size = MOTOR_DTYPE.itemsize
+        return [data[i:i + size] for i in range(0, len(data), size)]
+    result = []
+    timestamps = columns["timestamp"].tolist()
+    sequences = columns["sequence"].tolist()
+    counters = columns["counter"].tolist()
+    for i, value in enumerate(values.tolist()):
+        obj = batch.objs[i]
+        if obj is None:
+            obj = {"timestamp": timestamps[i], "sequence": sequences[i], "counter": counters[i]}
+        obj["value"] = value
+        obj["msg_type"] = 1  # type 1 refers to motor data
+        obj["timestamp2"] = timestamp2
+        obj["timestamp3"] = timestamp3
+        result.append(json.dumps(obj))
+    return result
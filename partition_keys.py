@@ -0,0 +1,105 @@
+import itertools
+import socket
+import zlib
+from stream_metadata import metadata_cache
+
+
+"""
+Choose the partition key (and optionally the explicit hash key) of the records sent by a producer.
+Records with the same partition key always go to the same shard and keep their order, so a stream
+with several shards can only be used fully if the producers use different keys.
+
+Strategies:
+    fixed        Use the same key for every record (what every producer did before).
+    device       Use the device id as key: every device goes to one shard, in order.
+    msg_type     Use the message type as key: every message type goes to one shard, in order.
+    round_robin  Send every record to the next shard. Maximum throughput, no ordering.
+    hash         Route every device to one shard with an explicit hash key, picking the shard from
+                 the shard map returned by ListShards, so devices are spread evenly over shards.
+"""
+
+
+STRATEGIES = ["fixed", "device", "msg_type", "round_robin", "hash"]
+
+
+def add_partition_arguments(parser):
+    # Add the arguments used to configure a partitioner to an argparse parser
+    parser.add_argument("--partition", dest="partition", default=STRATEGIES[0],
+                        choices=STRATEGIES, help="How to choose the partition key of every "
+                        "record. Options are {}. Default is '{}'.".format(STRATEGIES,
+                                                                          STRATEGIES[0]),
+                        metavar="STRATEGY",)
+    parser.add_argument("--device", dest="device", default=None, help="Device id used by the "
+                        "'device' and 'hash' partition strategies. Default is the hostname.",
+                        metavar="DEVICE_ID",)
+
+
+def add_shards_argument(parser):
+    # Add the argument used to choose the number of shards of a new stream
+    parser.add_argument("--shards", dest="shards", type=int, default=1, help="Number of shards "
+                        "of the stream if it has to be created. Default is 1.", metavar="N",)
+
+
+def list_open_shards(kinesis_client, stream_name):
+    # Return the open shards of a stream (the ones that can be written), sorted by hash key range
+    shards = metadata_cache().shards(kinesis_client, stream_name, open_only=True)
+    return sorted(shards, key=lambda s: int(s["HashKeyRange"]["StartingHashKey"]))
+
+
+class partitioner(object):
+    # Return the partition key (and explicit hash key if needed) of every record
+    def __init__(self, strategy="fixed", default_key="123", device=None, shards=None):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown partition strategy '{}'.".format(strategy))
+
+        # Save inputs
+        self.strategy = strategy
+        self.default_key = default_key
+        self.device = socket.gethostname() if device is None else device
+
+        # Use the first hash key of every open shard to route records explicitly
+        self.hash_keys = []
+        if shards is not None:
+            self.hash_keys = [s["HashKeyRange"]["StartingHashKey"] for s in shards]
+        self.counter = itertools.count()
+
+    def requires_shards(self):
+        # Return True if the strategy needs the shard map of the stream
+        return self.strategy in ("round_robin", "hash")
+
+    def set_shards(self, shards):
+        # Update the shard map (call it again after resharding)
+        self.hash_keys = [s["HashKeyRange"]["StartingHashKey"] for s in shards]
+
+    def partition(self, msg_type=None, device=None):
+        # Return a dict with the PartitionKey and, if needed, the ExplicitHashKey of a record
+        device = self.device if device is None else device
+        if self.strategy == "device":
+            return {"PartitionKey": str(device)}
+        if self.strategy == "msg_type":
+            return {"PartitionKey": str(msg_type) if msg_type is not None else self.default_key}
+        if self.strategy == "round_robin":
+            n = next(self.counter)
+            if len(self.hash_keys) == 0:
+                return {"PartitionKey": str(n)}
+            return {"PartitionKey": str(n),
+                    "ExplicitHashKey": self.hash_keys[n % len(self.hash_keys)]}
+        if self.strategy == "hash":
+            if len(self.hash_keys) == 0:
+                return {"PartitionKey": str(device)}
+            index = zlib.crc32(str(device).encode("utf-8")) % len(self.hash_keys)
+            return {"PartitionKey": str(device), "ExplicitHashKey": self.hash_keys[index]}
+        return {"PartitionKey": self.default_key}
+
+
+def create_partitioner(args, kinesis_client, stream_name, default_key):
+    # Create a partitioner from the parsed arguments, loading the shard map if it is needed
+    part = partitioner(args.partition, default_key=default_key, device=args.device)
+    if part.requires_shards():
+        try:
+            part.set_shards(list_open_shards(kinesis_client, stream_name))
+        except Exception as e:
+            print("Could not list the shards of stream '{}', records will be spread by "
+                  "partition key only.".format(stream_name))
+            print("Exception: {}.".format(e))
+    return part
@@ -1,11 +1,20 @@
 from Adafruit_MotorHAT import Adafruit_MotorHAT
 from RPi import GPIO
 import argparse
-import boto3
 import datetime
 import json
 import threading
 import time
+from conflation import add_conflation_arguments, create_conflator
+from message_dispatcher import message_dispatcher
+from partition_keys import add_shards_argument
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
+from stream_metadata import find_stream_shards
+from stream_reader import add_prefetch_argument, stream_reader
+from checkpoint_store import add_checkpoint_arguments, create_checkpoint_store
+from adaptive_poller import add_poller_arguments
+from fan_out import add_fan_out_argument, create_fan_out_consumer
+from metrics import JITTER_BUCKETS_MS, metrics
 
 
 """
@@ -66,46 +75,16 @@ identification or adaptative control can be run remotely.
                         type=float, help="Initial I constant. Default is {}.".format(defaults[1]))
     parser.add_argument("-dc", "--d_constant", dest="d_constant", default=defaults[2],
                         type=float, help="Initial D constant. Default is {}.".format(defaults[2]))
+    add_shards_argument(parser)
+    add_session_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_poller_arguments(parser)
+    add_fan_out_argument(parser)
+    add_prefetch_argument(parser)
+    add_conflation_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
-
-
 class encoder_reader(threading.Thread):
     # Parse encoder as fast as possible
     def __init__(self, clk, dt, one_turn_value=500, message_type=0):
@@ -213,6 +192,11 @@ class motor_writer(threading.Thread):
         self.goal_value, _ = self.reader.value()  # set initial goal to current encoder position
         self.min_encoder_sample_difference = encoder_sample_diff if encoder_sample_diff > 0 else 1
 
+        # Create histogram of the difference between the period of every loop and period_ms
+        self.jitter = metrics().histogram("control_loop_jitter_ms", "Difference between the "
+                                          "period of the control loop and its target in ms",
+                                          JITTER_BUCKETS_MS)
+
         # Create variable to stop thread
         self.stop_event = threading.Event()
 
@@ -307,9 +291,14 @@ class motor_writer(threading.Thread):
     def run(self):
         # Move motor pseudo-randomly and save encoder and motor values
         self.counter = 0
+        loop_time = None
         try:
             while not self.stop_event.is_set():
                 motor_value = self.get_pid()
+                now = time.perf_counter()
+                if loop_time is not None:
+                    self.jitter.observe(abs(1000 * (now - loop_time) - self.period_ms))
+                loop_time = now
                 self.move_motor(motor_value)
                 # self.add_json_to_list(motor_value)  # We could use this to send messages int sout
                 self.counter += 1
@@ -340,36 +329,19 @@ def main():
     stream_name_out = args.stream_out_name
     print("Connecting to output stream '{}' in region '{}'.".format(stream_name_out,
                                                                     args.region_out))
-    kinesis_client = boto3.client('kinesis', region_name=args.region_out)
-    if not connect_to_stream(kinesis_client, stream_name_out):
+    kinesis_client = create_kinesis_client(args.region_out, args)
+    if not connect_to_stream(kinesis_client, stream_name_out, args.shards):
         return
+    prewarm(kinesis_client, stream_name_out, args.prewarm)
 
     # Create and connect to input stream
     stream_name_in = args.stream_in_name
     print("Connecting to input stream '{}' in region '{}'.".format(stream_name_in, args.region_in))
-    kinesis_client = boto3.client('kinesis', region_name=args.region_in)
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name_in)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status != "ACTIVE":
-            print("The stream '{}' has status {}, please rerun the script when the stream "
-                  "is ACTIVE.".format(stream_name_in))
-            return
-        else:
-            shard_id = stream_description["StreamDescription"]["Shards"][0]["ShardId"]
-    except:
-        # We assume the stream doesn't exist so we will interrupt the program
-        print("The stream '{}' was not found, please rerun the script when the stream has "
-              "been created.".format(stream_name_in))
+    kinesis_client = create_kinesis_client(args.region_in, args)
+    # Read the shards of the stream from the shared metadata cache, waiting for it to be ACTIVE
+    if find_stream_shards(kinesis_client, stream_name_in) is None:
         return
 
-    # If we reach this point, both strings are active
-    shard_iterator_type = "LATEST"
-    shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name_in,
-                                                       ShardId=shard_id,
-                                                       ShardIteratorType=shard_iterator_type)["ShardIterator"]
-
     # Start thread to monitor encoder's position
     reader = encoder_reader(args.clk, args.dt)
     reader.start()
@@ -380,41 +352,44 @@ def main():
                           encoder_sample_diff=1, invert_motor=True)
     writer.start()
 
-    # Receive pid config from 'stream in' and send pid progress into 'stream out'
-    max_num_records = 10000
-    sleep_s = 0.0 if args.period is None or args.period < 0 else args.period / 1000.0
+    # Receive pid config from all shards of 'stream in' and send pid progress into 'stream out'
+    # Only the newest goal and pid constants of every batch are decoded (every command with
+    # --replay), and the handlers of their message types apply them in order. The period is
+    # waited once per batch
+    dispatcher = message_dispatcher(args.period, conflator=create_conflator(args))
+
+    def update_goal(messages):
+        # Goal positions (messages of type 2)
+        for _, obj in messages:
+            writer.update_goal_value(obj["value"])
+
+    def update_pid(messages):
+        # PID constants (messages of type 4)
+        for _, obj in messages:
+            writer.update_pid_constants(obj["p"], obj["i"], obj["d"])
+
+    dispatcher.register(2, update_goal)
+    dispatcher.register(4, update_pid)
+    # Motor and encoder data could be sent here if we want a closed loop (registering a handler)
+    # See how it is done in motor_encoder_producer.py
+
+    # If we reach this point, both strings are active
+    # Register the enhanced fan-out consumer if --fan_out is set (the records are pushed)
+    consumer_arn = create_fan_out_consumer(args, kinesis_client, stream_name_in)
+    # Save the last record processed in every shard, to continue from it after a restart
+    checkpoint = create_checkpoint_store(args, stream_name_in)
+    stream = stream_reader(kinesis_client, stream_name_in, dispatcher.dispatch, "LATEST",
+                           checkpoint=checkpoint, poll_rate=args.poll_rate,
+                           catch_up_lag_ms=args.catch_up_lag, prefetch=args.prefetch,
+                           consumer_arn=consumer_arn)
     try:
-        while not writer.finished():
-            try:
-                records = kinesis_client.get_records(ShardIterator=shard_iterator,
-                                                     Limit=max_num_records)
-                shard_iterator = records["NextShardIterator"]  # Update shard_iterator
-            except Exception as e:
-                time.sleep(0.01)
-                continue
-
-            for record in records["Records"]:
-                # Receive object from input stream
-                json_str_in = record["Data"].decode("utf-8")
-                obj = json.loads(json_str_in)
-
-                # If we receive goal_postion (if we get a message of type 2)
-                if obj["msg_type"] == 2:
-                    goal_pos = obj["value"]
-                    writer.update_goal_value(goal_pos)
-                # If we receive pid information (if we get a message of type 4)
-                elif obj["msg_type"] == 4:
-                    p = obj["p"]
-                    i = obj["i"]
-                    d = obj["d"]
-                    writer.update_pid_constants(p, i, d)
-
-                # Motor and encoder data could be sent here if we want a closed loop
-                # See how it is done in motor_encoder_producer.py
-
-                # Wait delay
-                time.sleep(sleep_s)
+        stream.start()
+        while not writer.finished() and not stream.wait(0.1):
+            pass
     finally:
+        stream.stop()
+        if checkpoint is not None:
+            checkpoint.stop()
         writer.stop()
         reader.stop()
 
@@ -0,0 +1,168 @@
+import bisect
+import hashlib
+import threading
+import time
+from partition_keys import list_open_shards
+from metrics import metrics
+
+
+"""
+Pace the records sent into a stream so every shard stays just under its write limits (1000 records
+and 1 MB per second), instead of sending as fast as possible and getting throttled.
+Every shard has two token buckets, one for records and one for bytes, and a sender waits until both
+of them have enough tokens for what it is going to send. The limiters are shared by all the threads
+of a process that write into the same stream (see shared_rate_limiter).
+"""
+
+
+# Write limits of a single shard
+SHARD_RECORDS_PER_SECOND = 1000
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+
+# Shared limiters of this process, by stream name
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def add_rate_limit_arguments(parser):
+    # Add the arguments used to configure a shard_rate_limiter to an argparse parser
+    parser.add_argument("--rate_limit", dest="rate_limit", action="store_true", help="Use it to "
+                        "pace the records sent to stay under the write limits of every shard.",)
+    parser.add_argument("--rate_fraction", dest="rate_fraction", type=float, default=0.95,
+                        help="Fraction of the shard write limits used when --rate_limit is set. "
+                        "Default is 0.95.", metavar="FRACTION",)
+
+
+def partition_hash_key(partition):
+    # Return the 128 bit hash key Kinesis uses to choose the shard of a record
+    if partition.get("ExplicitHashKey") is not None:
+        return int(partition["ExplicitHashKey"])
+    return int(hashlib.md5(partition["PartitionKey"].encode("utf-8")).hexdigest(), 16)
+
+
+def record_size(data, partition):
+    # Return the bytes a record counts against the write limit of its shard (its data and its
+    # partition key, str are counted once encoded, like PutRecords sends them)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return len(data) + len(partition["PartitionKey"].encode("utf-8"))
+
+
+class token_bucket(object):
+    # Token bucket that refills at rate tokens per second up to capacity tokens
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = self.rate if capacity is None else float(capacity)
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def wait_time(self, amount, now):
+        # Return how long we have to wait until amount tokens can be taken. Amounts bigger than
+        # the capacity only need a full bucket, and leave the bucket in debt
+        self.refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class shard_rate_limiter(object):
+    # Keep a record bucket and a byte bucket for every shard of a stream (thread safe)
+    def __init__(self, shards=None, fraction=0.95, records_per_second=SHARD_RECORDS_PER_SECOND,
+                 bytes_per_second=SHARD_BYTES_PER_SECOND):
+        # Save inputs
+        self.fraction = fraction
+        self.records_per_second = records_per_second * fraction
+        self.bytes_per_second = bytes_per_second * fraction
+
+        # Create buckets and statistics
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.starting_hash_keys = []
+        self.shard_ids = []
+        self.set_shards(shards if shards is not None else [])
+        self.time_waited = 0.0
+        metrics().collect("rate_limiter", self.stats)
+
+    def set_shards(self, shards):
+        # Update the shard map used to find the shard of every record (call it after resharding)
+        shards = sorted(shards, key=lambda s: int(s["HashKeyRange"]["StartingHashKey"]))
+        with self.lock:
+            self.starting_hash_keys = [int(s["HashKeyRange"]["StartingHashKey"]) for s in shards]
+            self.shard_ids = [s["ShardId"] for s in shards]
+
+    def shard_for(self, partition):
+        # Return the id of the shard a record with this partition goes to
+        if len(self.shard_ids) == 0:
+            return None
+        index = bisect.bisect_right(self.starting_hash_keys, partition_hash_key(partition)) - 1
+        return self.shard_ids[max(index, 0)]
+
+    def _buckets(self, shard_id):
+        # Return the (records, bytes) buckets of a shard, creating them if needed
+        if shard_id not in self.buckets:
+            self.buckets[shard_id] = (token_bucket(self.records_per_second),
+                                      token_bucket(self.bytes_per_second))
+        return self.buckets[shard_id]
+
+    def acquire_shard(self, shard_id, num_records, num_bytes):
+        # Block until the shard can accept num_records records of num_bytes bytes in total
+        while True:
+            with self.lock:
+                records_bucket, bytes_bucket = self._buckets(shard_id)
+                now = time.monotonic()
+                wait = max(records_bucket.wait_time(num_records, now),
+                           bytes_bucket.wait_time(num_bytes, now))
+                if wait <= 0:
+                    records_bucket.take(num_records)
+                    bytes_bucket.take(num_bytes)
+                    return
+                self.time_waited += wait
+            time.sleep(wait)
+
+    def acquire(self, partition, num_bytes):
+        # Block until a single record with this partition can be sent
+        self.acquire_shard(self.shard_for(partition), 1, num_bytes)
+
+    def acquire_batch(self, entries):
+        # Block until a list of PutRecords entries can be sent
+        totals = {}
+        for entry in entries:
+            shard_id = self.shard_for(entry)
+            num_records, num_bytes = totals.get(shard_id, (0, 0))
+            totals[shard_id] = (num_records + 1, num_bytes + record_size(entry["Data"], entry))
+        for shard_id, (num_records, num_bytes) in totals.items():
+            self.acquire_shard(shard_id, num_records, num_bytes)
+
+    def stats(self):
+        return {"shards": len(self.shard_ids), "rate_limit_wait_s": self.time_waited}
+
+
+def shared_rate_limiter(kinesis_client, stream_name, fraction=0.95):
+    # Return the rate limiter of a stream shared by every thread of this process, creating it
+    # (and loading its shard map) the first time
+    with _limiters_lock:
+        if stream_name not in _limiters:
+            try:
+                shards = list_open_shards(kinesis_client, stream_name)
+            except Exception as e:
+                print("Could not list the shards of stream '{}', limiting it as if it had a "
+                      "single shard.".format(stream_name))
+                print("Exception: {}.".format(e))
+                shards = []
+            _limiters[stream_name] = shard_rate_limiter(shards, fraction=fraction)
+        return _limiters[stream_name]
+
+
+def create_rate_limiter(args, kinesis_client, stream_name):
+    # Create (or get) the shared rate limiter if --rate_limit is set, return None otherwise
+    if not args.rate_limit:
+        return None
+    return shared_rate_limiter(kinesis_client, stream_name, fraction=args.rate_fraction)
@@ -0,0 +1,161 @@
+import struct
+import zlib
+
+
+"""
+Pack many small messages into a single Kinesis record, and unpack them again in the consumers.
+Every record put into a stream is billed in 25 KB units, and a shard accepts up to 1000 records per
+second, so sending one ~100 bytes message per record wastes most of both budgets.
+
+Aggregated record format (all integers are little endian):
+    magic         4 bytes   b"KAGG"
+    version       1 byte    currently 1
+    count         4 bytes   number of messages in the record
+    then, for every message:
+        sequence  8 bytes   sequence number of the message, assigned by the aggregator
+        length    4 bytes   length of the message data
+        data      length bytes
+    checksum      4 bytes   CRC32 of everything before it
+
+Records that do not start with the magic bytes are treated as normal (not aggregated) records, so
+consumers can read aggregated and plain records from the same stream.
+"""
+
+
+AGGREGATION_MAGIC = b"KAGG"
+AGGREGATION_VERSION = 1
+HEADER_FORMAT = "<4sBI"
+MESSAGE_HEADER_FORMAT = "<QI"
+CHECKSUM_FORMAT = "<I"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MESSAGE_HEADER_SIZE = struct.calcsize(MESSAGE_HEADER_FORMAT)
+CHECKSUM_SIZE = struct.calcsize(CHECKSUM_FORMAT)
+
+# Maximum size of a record's data (1 MB), leaving some room for the partition key
+MAX_AGGREGATED_BYTES = 1024 * 1024 - 256
+
+
+class AggregationError(ValueError):
+    # Raised when an aggregated record is truncated or its checksum does not match
+    pass
+
+
+def add_aggregation_arguments(parser):
+    # Add the arguments used to configure a record_aggregator to an argparse parser
+    parser.add_argument("--aggregate", dest="aggregate", action="store_true", help="Use it to "
+                        "pack several messages into every record sent into the stream.",)
+    parser.add_argument("--aggregate_messages", dest="aggregate_messages", type=int, default=50,
+                        help="Maximum number of messages packed into one record when "
+                        "--aggregate is used. Default is 50.", metavar="MESSAGES",)
+
+
+def aggregate(messages, first_sequence=0):
+    # Pack a list of messages (str or bytes) into an aggregated record, numbering them from
+    # first_sequence
+    parts = [struct.pack(HEADER_FORMAT, AGGREGATION_MAGIC, AGGREGATION_VERSION, len(messages))]
+    for i, data in enumerate(messages):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        parts.append(struct.pack(MESSAGE_HEADER_FORMAT, first_sequence + i, len(data)))
+        parts.append(data)
+    body = b"".join(parts)
+    return body + struct.pack(CHECKSUM_FORMAT, zlib.crc32(body))
+
+
+def is_aggregated(data):
+    # Return True if data is an aggregated record
+    return data[:len(AGGREGATION_MAGIC)] == AGGREGATION_MAGIC
+
+
+def deaggregate(data):
+    # Unpack an aggregated record into a list of (sequence, data) tuples. Records that are not
+    # aggregated are returned as a single message with sequence None
+    if not is_aggregated(data):
+        return [(None, data)]
+    if len(data) < HEADER_SIZE + CHECKSUM_SIZE:
+        raise AggregationError("Aggregated record is truncated.")
+    body = data[:-CHECKSUM_SIZE]
+    checksum, = struct.unpack_from(CHECKSUM_FORMAT, data, len(body))
+    if zlib.crc32(body) != checksum:
+        raise AggregationError("Aggregated record checksum does not match.")
+    _, version, count = struct.unpack_from(HEADER_FORMAT, body, 0)
+    if version != AGGREGATION_VERSION:
+        raise AggregationError("Unknown aggregated record version {}.".format(version))
+    messages = []
+    offset = HEADER_SIZE
+    for _ in range(count):
+        if offset + MESSAGE_HEADER_SIZE > len(body):
+            raise AggregationError("Aggregated record is truncated.")
+        sequence, length = struct.unpack_from(MESSAGE_HEADER_FORMAT, body, offset)
+        offset += MESSAGE_HEADER_SIZE
+        if offset + length > len(body):
+            raise AggregationError("Aggregated record is truncated.")
+        messages.append((sequence, body[offset:offset + length]))
+        offset += length
+    return messages
+
+
+def deaggregate_records(records):
+    # Turn the records returned by get_records into a list with one record per message. Every
+    # returned record is a copy of the original with "Data" replaced by the message, and with the
+    # fields "SubSequenceNumber" (position in the aggregated record) and "MessageSequence"
+    # (sequence given by the aggregator, None for plain records)
+    result = []
+    for record in records:
+        data = record["Data"]
+        if not is_aggregated(data):
+            result.append(record)
+            continue
+        for i, (sequence, message) in enumerate(deaggregate(data)):
+            sub_record = dict(record)
+            sub_record["Data"] = message
+            sub_record["SubSequenceNumber"] = i
+            sub_record["MessageSequence"] = sequence
+            result.append(sub_record)
+    return result
+
+
+class record_aggregator(object):
+    # Collect messages until there are enough of them to fill an aggregated record
+    def __init__(self, max_messages=50, max_bytes=MAX_AGGREGATED_BYTES):
+        # Save inputs
+        self.max_messages = max(max_messages, 1)
+        self.max_bytes = min(max_bytes, MAX_AGGREGATED_BYTES)
+
+        # Create variables for the messages waiting to be aggregated
+        self.messages = []
+        self.size = HEADER_SIZE + CHECKSUM_SIZE
+        self.next_sequence = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, data):
+        # Add a message. If the message does not fit in the current aggregated record, or the
+        # record is full after adding it, a finished aggregated record is returned, None otherwise
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        message_size = MESSAGE_HEADER_SIZE + len(data)
+        if HEADER_SIZE + CHECKSUM_SIZE + message_size > self.max_bytes:
+            raise AggregationError("Message of {} bytes does not fit in an aggregated "
+                                   "record.".format(len(data)))
+        record = None
+        if self.size + message_size > self.max_bytes:
+            record = self.flush()
+        self.messages.append(data)
+        self.size += message_size
+        if len(self.messages) >= self.max_messages:
+            # Only one record can be finished per call, the previous one is returned first
+            if record is None:
+                record = self.flush()
+        return record
+
+    def flush(self):
+        # Return an aggregated record with all waiting messages, or None if there are none
+        if len(self.messages) == 0:
+            return None
+        record = aggregate(self.messages, first_sequence=self.next_sequence)
+        self.next_sequence += len(self.messages)
+        self.messages = []
+        self.size = HEADER_SIZE + CHECKSUM_SIZE
+        return record
@@ -0,0 +1,175 @@
+import random
+import threading
+import time
+from metrics import metrics
+
+
+"""
+Retry the calls to Kinesis that fail because the stream is throttling us (or because of a temporary
+service error) instead of dropping the records.
+Retries wait with exponential backoff and full jitter, so producers slow down to the rate the shards
+can accept. A retry budget limits how many retries can be made when most calls are failing, and a
+circuit breaker makes every thread using the engine wait for a while after too many consecutive
+failures, instead of all of them hammering the stream.
+"""
+
+
+# Error codes that are worth retrying
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException",
+                     "LimitExceededException", "RequestLimitExceeded")
+TRANSIENT_ERRORS = ("InternalFailure", "InternalFailureException", "ServiceUnavailable",
+                    "ServiceUnavailableException", "KMSThrottlingException")
+
+
+def add_retry_arguments(parser):
+    # Add the arguments used to configure a retry_engine to an argparse parser
+    parser.add_argument("--max_attempts", dest="max_attempts", type=int, default=10,
+                        help="Maximum number of times a record is sent before dropping it. "
+                        "Default is 10.", metavar="ATTEMPTS",)
+    parser.add_argument("--backoff", dest="backoff", type=float, default=50,
+                        help="Base delay of the exponential backoff between retries. "
+                        "Default is 50 ms.", metavar="MILLISECONDS",)
+
+
+def create_retry_engine(args):
+    # Create a retry_engine from the parsed arguments
+    return retry_engine(max_attempts=args.max_attempts, base_delay_ms=args.backoff)
+
+
+def get_error_code(exception):
+    # Return the error code of a botocore ClientError, or None for other exceptions
+    response = getattr(exception, "response", None)
+    if not isinstance(response, dict):
+        return None
+    return response.get("Error", {}).get("Code")
+
+
+def is_retryable_error(error_code):
+    # Return True if a failed call or record with this error code should be retried
+    return error_code in THROTTLING_ERRORS or error_code in TRANSIENT_ERRORS
+
+
+class retry_engine(object):
+    # Decide when to retry, wait between retries and keep count of what happened (thread safe)
+    def __init__(self, max_attempts=10, base_delay_ms=50, max_delay_ms=5000, retry_budget=500,
+                 retry_cost=5, throttle_cost=10, breaker_failures=20, breaker_cooldown_ms=1000):
+        # Save inputs
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay_ms / 1000.0
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_budget = retry_budget
+        self.retry_cost = retry_cost
+        self.throttle_cost = throttle_cost
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown_ms / 1000.0
+
+        # Create state variables
+        self.lock = threading.Lock()
+        self.budget = retry_budget
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+        # Create counters
+        self.retries = 0
+        self.throttles = 0
+        self.dropped = 0
+        self.breaker_trips = 0
+
+        # Create metrics: latency histogram of every function called, and records sent
+        self.latencies = {}
+        self.records_out = metrics().counter("records_out_total", "Records sent")
+        self.bytes_out = metrics().counter("bytes_out_total", "Bytes of the records sent")
+        metrics().collect("retry", self.stats)
+
+    def delay(self, attempt):
+        # Return the time to wait before retry number attempt (exponential backoff, full jitter)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def success(self, num_records=1):
+        # Call after a successful call, it refunds the retry budget (one unit per record sent)
+        # and resets the count of consecutive failures
+        with self.lock:
+            self.budget = min(self.max_budget, self.budget + num_records)
+            self.consecutive_failures = 0
+
+    def failure(self, throttled=False):
+        # Call after a failed call, it opens the breaker after too many consecutive failures
+        with self.lock:
+            if throttled:
+                self.throttles += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.breaker_failures:
+                self.open_until = time.monotonic() + self.breaker_cooldown
+                self.consecutive_failures = 0
+                self.breaker_trips += 1
+
+    def acquire_retry(self, attempt, throttled=False):
+        # Return True if another retry can be made after attempt failed attempts, spending
+        # budget for it. Return False if the record should be dropped
+        with self.lock:
+            cost = self.throttle_cost if throttled else self.retry_cost
+            if attempt + 1 >= self.max_attempts or self.budget < cost:
+                return False
+            self.budget -= cost
+            self.retries += 1
+            return True
+
+    def drop(self, num_records=1):
+        # Count records that were given up on
+        with self.lock:
+            self.dropped += num_records
+
+    def wait_if_open(self):
+        # Block while the circuit breaker is open
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def backoff(self, attempt):
+        # Wait before retry number attempt
+        self.wait_if_open()
+        time.sleep(self.delay(attempt))
+
+    def call(self, function, **kwargs):
+        # Call function(**kwargs), retrying it while it fails with a retryable error. The last
+        # exception is raised if the call can not be retried anymore
+        attempt = 0
+        while True:
+            self.wait_if_open()
+            time0 = time.monotonic()
+            try:
+                result = function(**kwargs)
+            except Exception as e:
+                error_code = get_error_code(e)
+                throttled = error_code in THROTTLING_ERRORS
+                self.failure(throttled)
+                if not is_retryable_error(error_code) or not self.acquire_retry(attempt,
+                                                                               throttled):
+                    self.drop()
+                    raise
+                self.backoff(attempt)
+                attempt += 1
+                continue
+            self.latency(function).observe(1000 * (time.monotonic() - time0))
+            if "Data" in kwargs:
+                self.records_out.inc()
+                self.bytes_out.inc(len(kwargs["Data"]))
+            self.success()
+            return result
+
+    def latency(self, function):
+        # Return the latency histogram of the calls to function (put_record, get_records...)
+        name = getattr(function, "__name__", "call")
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = metrics().histogram("kinesis_{}_latency_ms".format(name),
+                                            "Latency of the {} calls in ms".format(name))
+            self.latencies[name] = histogram
+        return histogram
+
+    def stats(self):
+        # Return retry and drop counters
+        with self.lock:
+            return {"retries": self.retries, "throttles": self.throttles,
+                    "dropped": self.dropped, "breaker_trips": self.breaker_trips,
+                    "retry_budget": self.budget}
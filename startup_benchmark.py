@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+import time
+
+
+"""
+Measure how long every script takes to start, before it can do anything useful.
+Every entry point is imported in a new Python interpreter with -X importtime, and we print the
+import time of the script, and the direct imports that take longest (the ones worth deferring to the
+code that needs them). Use --budget to fail (exit code 1) when a script takes longer to import than
+the budget, so slow imports are noticed before they reach the Raspberry Pi.
+The producers that read the encoder also print the time from the start of the process to their
+first sample (see report_first_sample), and warn when it is over --first_sample_budget.
+"""
+
+
+ENTRY_POINTS = ["data_plotter", "data_producer", "delete_streams", "encoder_motor_converter",
+                "encoder_producer", "encoder_thread_producer", "encoder_udp", "goal_producer",
+                "json_consumer", "json_producer", "motor_consumer", "motor_encoder_producer",
+                "motor_producer", "pid_controller", "pid_producer", "stream_consumer",
+                "stream_producer", "udp_async_producer", "udp_producer"]
+
+
+def create_parser():
+    parser = argparse.ArgumentParser("Measure the import time of every script.")
+    parser.add_argument("-e", "--entry_points", dest="entry_points", nargs="+",
+                        default=ENTRY_POINTS, help="Scripts to measure (without .py). Default "
+                        "is all of them.", metavar="SCRIPT",)
+    parser.add_argument("-n", "--runs", dest="runs", type=int, default=3, help="Number of "
+                        "times every script is imported, the fastest run is shown. Default is 3.",
+                        metavar="RUNS",)
+    parser.add_argument("--top", dest="top", type=int, default=5, help="Number of slowest "
+                        "imports shown for every script. Default is 5.", metavar="IMPORTS",)
+    parser.add_argument("--budget", dest="budget", type=float, default=None, help="Maximum "
+                        "import time of every script. If set, exit with an error when a script "
+                        "goes over it.", metavar="MILLISECONDS",)
+    return parser.parse_args()
+
+
+def add_startup_arguments(parser):
+    # Add the argument used to check the time to first sample to an argparse parser
+    parser.add_argument("--first_sample_budget", dest="first_sample_budget", type=float,
+                        default=3000, help="Warn when the first sample is taken later than this "
+                        "after starting the program. Default is 3000 ms.", metavar="MILLISECONDS",)
+
+
+def process_age_ms():
+    # Return the time since this process was started in ms (Linux only, None elsewhere)
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the process name, the start time (field 22) is the 20th of them
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return 1000 * (uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def report_first_sample(budget_ms=None):
+    # Print the time to the first sample of a producer, warning if it is over budget_ms
+    age_ms = process_age_ms()
+    if age_ms is None:
+        return
+    print("First sample taken {:.0f} ms after starting the program.".format(age_ms))
+    if budget_ms is not None and age_ms > budget_ms:
+        print("Warning: the first sample was taken later than the {:.0f} ms budget.".format(
+              budget_ms))
+
+
+def parse_importtime(output):
+    # Parse the output of -X importtime into a list of (name, depth, self ms, cumulative ms)
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_column, cumulative_column, name = line.split("|", 2)
+        self_us = int(self_column.split(":")[1])
+        cumulative_us = int(cumulative_column)
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), depth, self_us / 1000.0, cumulative_us / 1000.0))
+    return imports
+
+
+def measure_imports(module):
+    # Import module in a new interpreter, return the wall time in ms (interpreter start included),
+    # its import time in ms and the (name, ms) of its direct imports, slowest first
+    import subprocess
+    time0 = time.monotonic()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall_ms = 1000 * (time.monotonic() - time0)
+    if result.returncode != 0:
+        error = [line for line in result.stderr.splitlines() if line.strip() != ""]
+        raise ImportError(error[-1] if len(error) > 0 else "Unknown error.")
+    imports = parse_importtime(result.stderr)
+    total_ms = [cumulative for name, depth, _, cumulative in imports
+                if name == module and depth == 0][-1]
+    # Direct imports of the module are listed (one level deeper) before the module itself
+    index = [i for i, (name, depth, _, _) in enumerate(imports)
+             if name == module and depth == 0][-1]
+    direct = []
+    for name, depth, _, cumulative in reversed(imports[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct.append((name, cumulative))
+    direct.sort(key=lambda x: x[1], reverse=True)
+    return wall_ms, total_ms, direct
+
+
+def main():
+    args = create_parser()
+    over_budget = []
+    for module in args.entry_points:
+        runs = []
+        try:
+            for _ in range(max(args.runs, 1)):
+                runs.append(measure_imports(module))
+        except ImportError as e:
+            print("{:25} could not be imported: {}".format(module, e))
+            continue
+        wall_ms, total_ms, direct = min(runs, key=lambda run: run[1])
+        slowest = ", ".join("{} {:.1f} ms".format(name, ms) for name, ms in direct[:args.top])
+        print("{:25} import {:7.1f} ms, with interpreter {:7.1f} ms | {}".format(
+              module, total_ms, wall_ms, slowest))
+        if args.budget is not None and total_ms > args.budget:
+            over_budget.append(module)
+    if args.budget is not None:
+        if len(over_budget) > 0:
+            print("Scripts over the {:.0f} ms budget: {}.".format(args.budget,
+                                                                 ", ".join(over_budget)))
+            sys.exit(1)
+        print("Every script is under the {:.0f} ms budget.".format(args.budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 import argparse
 import datetime
-import time
-import boto3
+from record_aggregator import deaggregate_records
+from message_codec import decode_all, is_binary
+from kinesis_session import add_session_arguments, create_kinesis_client
+from stream_metadata import find_stream_shards
+from stream_reader import stream_reader
+from checkpoint_store import add_checkpoint_arguments, create_checkpoint_store
+from adaptive_poller import add_poller_arguments
 
 
 def create_parser():
@@ -15,7 +20,8 @@ It will only print up to 10000 records every iteration.
                         help="The region you'd like to make this stream in. Default is "
                         "'us-east-1'", metavar="REGION_NAME",)
     parser.add_argument("-p", "--period", dest="period", type=int, default=None,
-                        help="How often to read stream", metavar="MILLISECONDS",)
+                        help="How often to read stream once it has caught up. If not set, "
+                        "the stream is read only once.", metavar="MILLISECONDS",)
     choices = ["TRIM_HORIZON", "LATEST", "AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER",
                "AT_TIMESTAMP"]
     parser.add_argument("-sit", "--shard_iterator_type", dest="shard_iterator_type", type=str,
@@ -23,6 +29,9 @@ It will only print up to 10000 records every iteration.
                         "returned from stream every query. Options are "
                         "{}. Default is '{}'.".format(choices, choices[0]),
                         metavar="SHARD_ITERATOR_TYPE")
+    add_session_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_poller_arguments(parser)
     return parser.parse_args()
 
 
@@ -31,63 +40,54 @@ def main():
     stream_name = args.stream_name
 
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status != "ACTIVE":
-            print("The stream '{}' has status {}, please rerun the script when the stream "
-                  "is ACTIVE.".format(stream_name))
-            return
-        else:
-            shard_id = stream_description["StreamDescription"]["Shards"][0]["ShardId"]
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("The stream '{}' was not found, please rerun the script when the stream has "
-              "been created.".format(stream_name))
+    kinesis_client = create_kinesis_client(args.region, args)
+    # Read the shards of the stream from the shared metadata cache, waiting for it to be ACTIVE
+    if find_stream_shards(kinesis_client, stream_name) is None:
         return
 
     # If we reach this point, the string is active
     shard_iterator_type = args.shard_iterator_type
-    if shard_iterator_type == "TRIM_HORIZON" or shard_iterator_type == "LATEST":
-        shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
-                                                           ShardIteratorType=shard_iterator_type)["ShardIterator"]
-    elif shard_iterator_type == "AT_SEQUENCE_NUMBER" or shard_iterator_type == "AFTER_SEQUENCE_NUMBER":
-        sequence_number = str(0)  # This crashes, we need to use a valid sequence_number
-        shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
-                                                           ShardIteratorType=shard_iterator_type,
-                                                           StartingSequenceNumber=sequence_number)["ShardIterator"]
+    sequence_numbers = None
+    timestamp = None
+    from_checkpoint = shard_iterator_type in ("AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER")
+    if from_checkpoint and args.checkpoint is None:
+        print("The shard iterator type {} needs the sequence numbers saved with "
+              "--checkpoint.".format(shard_iterator_type))
+        return
+    # Save the last record printed in every shard, to continue from it after a restart
+    checkpoint = create_checkpoint_store(args, stream_name)
+    if from_checkpoint:
+        # Start at (or after) the sequence numbers saved in the checkpoints, shards without a
+        # checkpoint are read from the beginning
+        sequence_numbers = checkpoint.load()
     elif shard_iterator_type == "AT_TIMESTAMP":
         timestamp = datetime.datetime.now()  # Because timestamp is now, this acts like LATEST
-        shard_iterator = kinesis_client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
-                                                           ShardIteratorType=shard_iterator_type,
-                                                           Timestamp=timestamp)["ShardIterator"]
-    else:
-        print("Unknown shard iterator type {}.".format(shard_iterator_type))
-        return
 
-    max_num_records = 10000
-    # Get records, print them and sleep (forever)
-    if args.period is not None:
-        sleep_time = args.period / 1000.0
-        while True:
-            records = kinesis_client.get_records(ShardIterator=shard_iterator,
-                                                 Limit=max_num_records)
-            shard_iterator = records["NextShardIterator"]  # Update shard_iterator
-            millis_behind = records["MillisBehindLatest"]
-            if millis_behind != 0:
-                print("We are {} ms behind".format(millis_behind))
-                time.sleep(3)
-            for r in records["Records"]:
-                print(r["Data"])
+    # Get records of every shard and print them, forever if a period is set or once otherwise
+    shards_read = set()
 
-            time.sleep(sleep_time)
+    def print_records(shard_id, response):
+        # The reader reads as fast as possible while we are behind, just show the lag
+        millis_behind = response["MillisBehindLatest"]
+        if millis_behind != 0:
+            print("We are {} ms behind in shard '{}'".format(millis_behind, shard_id))
+        for r in deaggregate_records(response["Records"]):
+            print(decode_all(r["Data"]) if is_binary(r["Data"]) else r["Data"])
+        shards_read.add(shard_id)
+        if args.period is None and len(shards_read) >= reader.stats()["shards_reading"]:
+            reader.stop()
 
-    # Get records and print them once
-    records = kinesis_client.get_records(ShardIterator=shard_iterator, Limit=max_num_records)
-    for r in records["Records"]:
-        print(r["Data"])
+    reader = stream_reader(kinesis_client, stream_name, print_records, shard_iterator_type,
+                           period_ms=args.period, sequence_numbers=sequence_numbers,
+                           timestamp=timestamp, checkpoint=checkpoint,
+                           poll_rate=args.poll_rate, catch_up_lag_ms=args.catch_up_lag)
+    try:
+        reader.start()
+        reader.wait()
+    finally:
+        reader.stop()
+        if checkpoint is not None:
+            checkpoint.stop()
 
 
 if __name__ == '__main__':
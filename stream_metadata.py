@@ -0,0 +1,222 @@
+import json
+import os
+import random
+import threading
+import time
+from metrics import metrics
+
+
+"""
+Cache of the metadata of the streams (status and shard map, with the hash key range of every shard)
+shared by every script and thread of a process, so the control plane of Kinesis (DescribeStream,
+ListShards...) is not called again every time a script needs to know the shards of a stream. These
+calls have much lower rate limits than the data plane (DescribeStreamSummary allows 20 calls per
+second per account, ListShards 1000 per second per stream), and they are slow.
+Entries of ACTIVE streams are kept for --metadata_ttl seconds, and they can be saved in a json file
+(--metadata_cache) so the next runs start without asking Kinesis again. Streams that are being
+created or updated are never cached: wait_for_status polls them with exponential backoff (and
+jitter) until they reach the desired status, instead of polling in a fixed (or tight) loop.
+"""
+
+
+DEFAULT_TTL = 60
+WAIT_TIMEOUT = 300
+
+
+def add_metadata_arguments(parser):
+    # Add the arguments used to configure the stream metadata cache to an argparse parser
+    parser.add_argument("--metadata_ttl", dest="metadata_ttl", type=float, default=DEFAULT_TTL,
+                        help="Seconds the status and shards of an active stream are cached. "
+                        "Default is {} s.".format(DEFAULT_TTL), metavar="SECONDS",)
+    parser.add_argument("--metadata_cache", dest="metadata_cache", default=None, help="Json "
+                        "file where the stream metadata is saved and loaded, to reuse it across "
+                        "runs. If not set, it is only kept in memory.", metavar="FILE_NAME",)
+
+
+class stream_metadata_cache(object):
+    # Status and shards of every (region, stream), fetched when missing or older than ttl seconds
+    def __init__(self, ttl=DEFAULT_TTL, filename=None):
+        # Save inputs
+        self.ttl = ttl
+        self.filename = filename
+
+        # Create entries: (region, stream) -> {"status", "shards", "time" (seconds since epoch)}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        # Create statistics variables
+        self.hits = 0
+        self.calls = 0
+        metrics().collect("metadata", self.stats)
+
+        if self.filename is not None:
+            self.load()
+
+    def load(self):
+        # Load the entries saved in filename, ignoring the file if it can not be read
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+            with self.lock:
+                for key, entry in saved.items():
+                    region, stream_name = key.split("/", 1)
+                    self.entries[(region, stream_name)] = entry
+        except (OSError, ValueError) as e:
+            if os.path.exists(self.filename):
+                print("Could not load stream metadata from '{}': {}.".format(self.filename, e))
+
+    def save(self):
+        # Save the entries in filename (written to a temporary file first, so it is never corrupt)
+        if self.filename is None:
+            return
+        with self.lock:
+            saved = {"{}/{}".format(*key): entry for key, entry in self.entries.items()}
+        temporary = "{}.{}.tmp".format(self.filename, os.getpid())
+        try:
+            with open(temporary, "w") as f:
+                json.dump(saved, f)
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            print("Could not save stream metadata into '{}': {}.".format(self.filename, e))
+
+    def fresh_entry(self, key):
+        # Return the entry of key if it is still valid, None otherwise
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry["time"] > self.ttl:
+            return None
+        return entry
+
+    def count_call(self):
+        # Count a control plane call (the cache is shared by every thread)
+        with self.lock:
+            self.calls += 1
+
+    def describe(self, kinesis_client, stream_name, refresh=False):
+        # Return the entry of a stream, calling Kinesis only if it is not cached (or refresh is
+        # set). Raises the exception of the client if the stream does not exist
+        key = (kinesis_client.meta.region_name, stream_name)
+        with self.lock:
+            entry = None if refresh else self.fresh_entry(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+        summary = kinesis_client.describe_stream_summary(StreamName=stream_name)
+        status = summary["StreamDescriptionSummary"]["StreamStatus"]
+        self.count_call()
+        entry = {"status": status, "shards": None, "time": time.time(),
+                 "arn": summary["StreamDescriptionSummary"].get("StreamARN")}
+        if status in ("ACTIVE", "UPDATING"):
+            entry["shards"] = self.list_shards(kinesis_client, stream_name)
+        with self.lock:
+            if status == "ACTIVE":
+                self.entries[key] = entry
+            else:
+                # The status will change soon, do not cache it
+                self.entries.pop(key, None)
+        if status == "ACTIVE":
+            self.save()
+        return entry
+
+    def list_shards(self, kinesis_client, stream_name):
+        # Return every shard of a stream (open and closed), following the pagination of ListShards
+        shards = []
+        response = kinesis_client.list_shards(StreamName=stream_name)
+        self.count_call()
+        while True:
+            shards.extend(response["Shards"])
+            if "NextToken" not in response:
+                break
+            response = kinesis_client.list_shards(NextToken=response["NextToken"])
+            self.count_call()
+        return shards
+
+    def status(self, kinesis_client, stream_name, refresh=False):
+        # Return the status of a stream
+        return self.describe(kinesis_client, stream_name, refresh)["status"]
+
+    def arn(self, kinesis_client, stream_name, refresh=False):
+        # Return the ARN of a stream
+        return self.describe(kinesis_client, stream_name, refresh).get("arn")
+
+    def shards(self, kinesis_client, stream_name, open_only=False, refresh=False):
+        # Return the shards of a stream (only the ones that can be written if open_only is set)
+        shards = self.describe(kinesis_client, stream_name, refresh)["shards"] or []
+        if open_only:
+            shards = [s for s in shards if "EndingSequenceNumber" not in s["SequenceNumberRange"]]
+        return shards
+
+    def invalidate(self, kinesis_client, stream_name):
+        # Forget the entry of a stream (call it after resharding or deleting it)
+        with self.lock:
+            self.entries.pop((kinesis_client.meta.region_name, stream_name), None)
+        self.save()
+
+    def wait_for_status(self, kinesis_client, stream_name, status="ACTIVE", timeout=WAIT_TIMEOUT,
+                        initial_delay=0.2, max_delay=5.0):
+        # Wait until a stream has the desired status, polling with exponential backoff. A stream
+        # that was just created may not be found for a moment, so that is not an error either.
+        # Return the entry of the stream, or None if the timeout expires
+        delay = initial_delay
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                entry = self.describe(kinesis_client, stream_name, refresh=True)
+                current = entry["status"]
+            except kinesis_client.exceptions.ResourceNotFoundException:
+                entry = None
+                current = "NOT_FOUND"
+            if current == status:
+                return entry
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print("Stream '{}' still has status {} after {} seconds.".format(stream_name,
+                                                                               current, timeout))
+                return None
+            sleep_seconds = min(delay * random.uniform(0.5, 1.0), remaining)
+            print("Stream '{}' has status {}, waiting {:.1f} seconds.".format(stream_name, current,
+                                                                            sleep_seconds))
+            time.sleep(sleep_seconds)
+            delay = min(delay * 2, max_delay)
+
+    def stats(self):
+        return {"streams": len(self.entries), "cache_hits": self.hits, "control_calls": self.calls}
+
+
+# Cache shared by every script and thread of this process
+_cache = stream_metadata_cache()
+_cache_lock = threading.Lock()
+
+
+def configure_metadata_cache(args):
+    # Apply the settings parsed with add_metadata_arguments to the shared cache
+    global _cache
+    with _cache_lock:
+        if args.metadata_cache != _cache.filename:
+            _cache = stream_metadata_cache(args.metadata_ttl, args.metadata_cache)
+        _cache.ttl = args.metadata_ttl
+    return _cache
+
+
+def metadata_cache():
+    # Return the stream metadata cache shared by this process
+    return _cache
+
+
+def find_stream_shards(kinesis_client, stream_name, timeout=WAIT_TIMEOUT):
+    # Return the shards of a stream that is going to be read, waiting for it to become ACTIVE if it
+    # is being created or updated. Return None (after printing why) if it can not be read
+    cache = metadata_cache()
+    try:
+        status = cache.status(kinesis_client, stream_name)
+    except kinesis_client.exceptions.ResourceNotFoundException:
+        print("The stream '{}' was not found, please rerun the script when the stream has "
+              "been created.".format(stream_name))
+        return None
+    if status == "DELETING":
+        print("The stream '{}' is being deleted, please rerun the script when the stream has "
+              "been created again.".format(stream_name))
+        return None
+    if status != "ACTIVE" and cache.wait_for_status(kinesis_client, stream_name,
+                                                    timeout=timeout) is None:
+        return None
+    return cache.shards(kinesis_client, stream_name)
@@ -0,0 +1,398 @@
+import queue
+import threading
+import time
+from retry_engine import THROTTLING_ERRORS, get_error_code
+from stream_metadata import metadata_cache
+from checkpoint_store import SHARD_END
+from adaptive_poller import GET_RECORDS_PER_SECOND, MAX_RECORDS_PER_CALL, adaptive_poller
+from fan_out import fan_out_worker
+from metrics import metrics
+
+
+"""
+Read every shard of a stream at the same time, instead of only the first one.
+The shards are listed with ListShards (through the cache of stream_metadata.py) and every shard is
+read by its own thread (a shard_worker), so the read throughput grows with the number of shards.
+The records of all the shards are given to a single callback, callback(shard_id, response), where
+response is what GetRecords returned. The callback is never called from two threads at the same
+time, so it does not need to be thread safe.
+After a split or a merge, the parent shards are closed and new child shards are created. A child
+shard is only read after all its parents have been read to the end, so the records of every
+partition key are still received in order. When a worker reaches the end of its shard, the shards
+are listed again to find its children.
+If a checkpoint store (see checkpoint_store.py) is given, the last sequence number processed in
+every shard is saved in it, and the shards with a checkpoint are read from right after it.
+Every worker is paced by an adaptive_poller (see adaptive_poller.py): it reads as fast as possible
+while its shard is behind, and at --poll_rate calls per second once it has caught up.
+With --prefetch, the workers do not wait for the callback: they put every response in a bounded
+queue and make the next call right away, while a dispatcher thread gives the responses to the
+callback. Fetching and processing overlap, so the latency is the slowest of them instead of their
+sum, and a full queue makes the workers wait (so memory stays bounded).
+If consumer_arn is given (see fan_out.py), the shards are read with enhanced fan-out: a
+fan_out_worker receives the records that SubscribeToShard pushes instead of polling GetRecords, and
+response is the SubscribeToShardEvent (it also has Records and MillisBehindLatest).
+If shard_ids is given, only those shards (and the children of the ones that are closed) are read,
+so several processes can share a stream (see converter_pool.py). Parents that are not in shard_ids
+are read by someone else, and they do not make their children wait.
+"""
+
+
+ITERATOR_TYPES = ["TRIM_HORIZON", "LATEST", "AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER",
+                  "AT_TIMESTAMP"]
+
+
+def add_prefetch_argument(parser):
+    # Add the argument used to choose the prefetch depth of a stream_reader to an argparse parser
+    parser.add_argument("--prefetch", dest="prefetch", type=int, default=2, help="Number of "
+                        "GetRecords responses read ahead while the previous ones are processed "
+                        "(0 reads and processes one at a time). Default is 2.",
+                        metavar="RESPONSES",)
+
+
+def is_closed(shard):
+    # Return True if a shard was closed by a split or a merge (it has no new records)
+    return "EndingSequenceNumber" in shard["SequenceNumberRange"]
+
+
+def parent_ids(shard):
+    # Return the ids of the parents of a shard (none, one after a split, two after a merge)
+    return [shard[key] for key in ("ParentShardId", "AdjacentParentShardId") if key in shard]
+
+
+class shard_worker(threading.Thread):
+    # Read one shard until it is closed (or the reader is stopped), giving its records to the reader
+    def __init__(self, reader, shard_id, iterator_type, sequence_number=None, timestamp=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Save inputs
+        self.reader = reader
+        self.shard_id = shard_id
+        self.iterator_type = iterator_type
+        self.sequence_number = sequence_number
+        self.timestamp = timestamp
+
+        # Create poller that paces the calls from the lag of the shard
+        self.poller = adaptive_poller(reader.poll_rate, reader.period_ms, reader.catch_up_lag_ms,
+                                      reader.limit)
+
+        # Create state and statistics variables
+        self.last_sequence_number = None
+        self.records = 0
+        self.calls = 0
+        self.errors = 0
+        self.latency = metrics().histogram("kinesis_get_records_latency_ms",
+                                           "Latency of the get_records calls in ms")
+
+    def get_iterator(self):
+        # Return a new shard iterator, after the last record read if there is one
+        kwargs = {"StreamName": self.reader.stream_name, "ShardId": self.shard_id}
+        if self.last_sequence_number is not None:
+            kwargs["ShardIteratorType"] = "AFTER_SEQUENCE_NUMBER"
+            kwargs["StartingSequenceNumber"] = self.last_sequence_number
+        else:
+            kwargs["ShardIteratorType"] = self.iterator_type
+            if self.iterator_type in ("AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER"):
+                kwargs["StartingSequenceNumber"] = self.sequence_number
+            elif self.iterator_type == "AT_TIMESTAMP":
+                kwargs["Timestamp"] = self.timestamp
+        return self.reader.kinesis_client.get_shard_iterator(**kwargs)["ShardIterator"]
+
+    def run(self):
+        kinesis_client = self.reader.kinesis_client
+        stop_event = self.reader.stop_event
+        try:
+            shard_iterator = self.get_iterator()
+        except Exception as e:
+            print("Could not get an iterator of shard '{}'.".format(self.shard_id))
+            print("Exception: {}.".format(e))
+            self.reader.worker_finished(self, closed=False)
+            return
+        poller = self.poller
+        # An iterator of None means that the shard is closed and all its records have been read
+        while shard_iterator is not None and not stop_event.is_set():
+            limit = poller.next_limit()
+            poller.call_started()
+            try:
+                response = kinesis_client.get_records(ShardIterator=shard_iterator, Limit=limit)
+                self.latency.observe(1000 * (time.monotonic() - poller.call_time))
+                self.calls += 1
+            except Exception as e:
+                self.errors += 1
+                error_code = get_error_code(e)
+                if error_code == "ExpiredIteratorException":
+                    try:
+                        shard_iterator = self.get_iterator()
+                    except Exception:
+                        stop_event.wait(poller.failed())
+                elif error_code in THROTTLING_ERRORS:
+                    stop_event.wait(poller.throttled())
+                else:
+                    stop_event.wait(poller.failed())
+                continue
+            records = response["Records"]
+            if len(records) > 0:
+                self.records += len(records)
+                self.last_sequence_number = records[-1]["SequenceNumber"]
+            sequence_number = self.last_sequence_number if len(records) > 0 else None
+            if not self.reader.deliver(self.shard_id, response, sequence_number):
+                # Stopped before the records were processed
+                break
+            shard_iterator = response.get("NextShardIterator")
+            stop_event.wait(poller.succeeded(response, limit))
+        self.reader.worker_finished(self, closed=shard_iterator is None)
+
+    def stats(self):
+        stats = {"records": self.records, "calls": self.calls, "errors": self.errors,
+                 "last_sequence_number": self.last_sequence_number}
+        stats.update(self.poller.stats())
+        return stats
+
+
+class stream_reader(object):
+    # Read all the shards of a stream (following resharding) and call callback with their records
+    def __init__(self, kinesis_client, stream_name, callback, iterator_type="LATEST",
+                 period_ms=None, limit=MAX_RECORDS_PER_CALL, sequence_numbers=None,
+                 timestamp=None, checkpoint=None, poll_rate=GET_RECORDS_PER_SECOND,
+                 catch_up_lag_ms=1000, prefetch=0, consumer_arn=None, shard_ids=None):
+        if iterator_type not in ITERATOR_TYPES:
+            raise ValueError("Unknown shard iterator type '{}'.".format(iterator_type))
+
+        # Save inputs
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.callback = callback
+        self.iterator_type = iterator_type
+        # Pace of the calls of every shard (see adaptive_poller.py)
+        self.period_ms = period_ms
+        self.poll_rate = poll_rate
+        self.catch_up_lag_ms = catch_up_lag_ms
+        self.limit = min(limit, MAX_RECORDS_PER_CALL)
+        # Sequence number to start from in every shard (by shard id), for the *_SEQUENCE_NUMBER
+        # iterator types
+        self.sequence_numbers = {} if sequence_numbers is None else sequence_numbers
+        self.timestamp = timestamp
+        # Checkpoint store where the last sequence number processed in every shard is saved, and
+        # the checkpoints saved before a restart
+        self.checkpoint = checkpoint
+        self.checkpoints = {} if checkpoint is None else checkpoint.load()
+        # If prefetch is set, the workers put up to prefetch responses in a queue and keep reading
+        # while another thread gives them to the callback
+        self.queue = None if prefetch <= 0 else queue.Queue(maxsize=prefetch)
+        self.dispatcher = None
+        # ARN of the registered consumer if the shards are read with enhanced fan-out
+        self.consumer_arn = consumer_arn
+        self.worker_class = shard_worker if consumer_arn is None else fan_out_worker
+        # Shards read by this reader (None reads all), it grows with the children of closed ones
+        self.shard_ids = None if shard_ids is None else set(shard_ids)
+
+        # Create shard state: workers by shard id, and ids of the shards read to the end
+        self.lock = threading.Lock()
+        # Reentrant, so the callback can stop the reader
+        self.callback_lock = threading.RLock()
+        self.workers = {}
+        self.finished = set()
+        self.finished_workers = []
+        self.error = None
+
+        # Create variables to stop the reader, and to know when it has stopped
+        self.stop_event = threading.Event()
+        self.done_event = threading.Event()
+
+        # Create metrics
+        self.records_in = metrics().counter("records_in_total", "Records received")
+        self.bytes_in = metrics().counter("bytes_in_total", "Bytes of the records received")
+        metrics().collect("reader", self.stats)
+
+    def start(self):
+        # Start a worker for every shard that can be read now (and the dispatcher if prefetching)
+        if self.queue is not None:
+            self.dispatcher = threading.Thread(target=self.dispatch)
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+        self.update_shards(refresh=False)
+
+    def update_shards(self, refresh=True):
+        # List the shards of the stream and start the workers of the shards whose parents have
+        # been read to the end (or are too old to be listed)
+        try:
+            shards = metadata_cache().shards(self.kinesis_client, self.stream_name, refresh=refresh)
+        except Exception as e:
+            print("Could not list the shards of stream '{}'.".format(self.stream_name))
+            print("Exception: {}.".format(e))
+            shards = []
+        with self.lock:
+            if self.stop_event.is_set():
+                return
+            known = set(s["ShardId"] for s in shards)
+            first_time = len(self.workers) == 0 and len(self.finished) == 0
+            if first_time:
+                for shard in shards:
+                    shard_id = shard["ShardId"]
+                    checkpoint = self.checkpoints.get(shard_id)
+                    if checkpoint == SHARD_END:
+                        # Read to the end before a restart
+                        self.finished.add(shard_id)
+                    elif (checkpoint is None and is_closed(shard) and
+                          self.iterator_type in ("LATEST", "AT_TIMESTAMP")):
+                        # Closed shards will not receive new records, there is nothing to read
+                        self.finished.add(shard_id)
+            for shard in shards:
+                shard_id = shard["ShardId"]
+                if shard_id in self.workers or shard_id in self.finished:
+                    continue
+                parents = parent_ids(shard)
+                if self.shard_ids is not None:
+                    if shard_id not in self.shard_ids and not any(p in self.shard_ids
+                                                                  for p in parents):
+                        continue
+                    # Parents read by someone else do not make this shard wait
+                    parents = [p for p in parents if p in self.shard_ids]
+                if any(p in known and p not in self.finished for p in parents):
+                    continue
+                if self.shard_ids is not None:
+                    self.shard_ids.add(shard_id)
+                sequence_number = self.sequence_numbers.get(shard_id)
+                if (self.iterator_type in ("AT_SEQUENCE_NUMBER", "AFTER_SEQUENCE_NUMBER") and
+                        sequence_number is not None):
+                    iterator_type = self.iterator_type
+                elif shard_id in self.checkpoints:
+                    # Continue right after the last record processed before a restart
+                    iterator_type = "AFTER_SEQUENCE_NUMBER"
+                    sequence_number = self.checkpoints[shard_id]
+                elif first_time and self.iterator_type in ("LATEST", "AT_TIMESTAMP"):
+                    iterator_type = self.iterator_type
+                else:
+                    # Shards created while reading (or without a sequence number to start from)
+                    # are read from their first record
+                    iterator_type = "TRIM_HORIZON"
+                worker = self.worker_class(self, shard_id, iterator_type, sequence_number,
+                                           self.timestamp)
+                self.workers[shard_id] = worker
+                worker.start()
+            reading = len(self.workers)
+        if reading == 0:
+            # Unblock those who wait, there is nothing left to read
+            self.all_read()
+        else:
+            print("Reading {} shard(s) of stream '{}'.".format(reading, self.stream_name))
+
+    def deliver(self, shard_id, response, sequence_number=None):
+        # Give the records of a shard to the callback, or put them in the queue if prefetching.
+        # sequence_number (if not None) is saved as checkpoint once they are processed. Return
+        # False if the reader was stopped before
+        if self.queue is None:
+            return self.process(shard_id, response, sequence_number)
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put((shard_id, response, sequence_number), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def process(self, shard_id, response, sequence_number=None):
+        # Give the records of a shard to the callback, one shard at a time, and save the
+        # checkpoint. Return True if the callback processed them
+        with self.callback_lock:
+            if self.stop_event.is_set():
+                return False
+            if response is not None:
+                records = response["Records"]
+                self.records_in.inc(len(records))
+                self.bytes_in.inc(sum(len(r["Data"]) for r in records))
+                try:
+                    self.callback(shard_id, response)
+                except Exception as e:
+                    # Stop reading, the exception will be raised again in wait
+                    self.error = e
+                    self.stop()
+                    return False
+        if sequence_number is not None:
+            self.save_checkpoint(shard_id, sequence_number)
+        return True
+
+    def dispatch(self):
+        # Give the responses in the queue to the callback until stopped (prefetch thread)
+        while not self.stop_event.is_set():
+            try:
+                shard_id, response, sequence_number = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if shard_id is None:
+                # Everything has been read and processed
+                self.done_event.set()
+                break
+            self.process(shard_id, response, sequence_number)
+
+    def all_read(self):
+        # Called when no shard is being read, set done once its records are processed
+        if self.queue is None:
+            self.done_event.set()
+        else:
+            self.deliver(None, None)
+
+    def save_checkpoint(self, shard_id, sequence_number):
+        # Save the last sequence number processed in a shard, if there is a checkpoint store
+        if self.checkpoint is not None:
+            self.checkpoint.update(shard_id, sequence_number)
+
+    def worker_finished(self, worker, closed):
+        # Called by a worker when it stops. If its shard was closed, read its children next
+        with self.lock:
+            self.workers.pop(worker.shard_id, None)
+            self.finished_workers.append(worker)
+            if closed:
+                self.finished.add(worker.shard_id)
+        if closed:
+            # Saved after the records of the shard waiting in the queue have been processed
+            self.deliver(worker.shard_id, None, SHARD_END)
+        if closed and not self.stop_event.is_set():
+            print("Shard '{}' of stream '{}' was read to the end.".format(worker.shard_id,
+                                                                      self.stream_name))
+            metadata_cache().invalidate(self.kinesis_client, self.stream_name)
+            self.update_shards()
+        elif len(self.workers) == 0:
+            self.all_read()
+
+    def wait(self, timeout=None):
+        # Wait until the reader is stopped, there is nothing left to read or timeout seconds have
+        # passed. Raise the exception of the callback if it failed
+        self.done_event.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.done_event.is_set()
+
+    def stop(self):
+        # Stop all workers (they finish the call they are doing in the background). Once it
+        # returns, the callback will not be called again
+        with self.callback_lock:
+            self.stop_event.set()
+        self.done_event.set()
+
+    def stats(self):
+        # Return the statistics of every worker added up, and the shards being read
+        with self.lock:
+            workers = list(self.workers.values()) + self.finished_workers
+            reading = len(self.workers)
+        totals = {"shards_reading": reading, "shards_finished": len(self.finished),
+                  "records": 0, "calls": 0, "errors": 0, "catch_up_calls": 0,
+                  "throttled_calls": 0, "millis_behind_latest": None,
+                  "queue_depth": 0 if self.queue is None else self.queue.qsize()}
+        lags = []
+        for i, worker in enumerate(workers):
+            stats = worker.stats()
+            for key in ("records", "calls", "errors", "catch_up_calls", "throttled_calls"):
+                totals[key] += stats[key]
+            if i < reading and stats["millis_behind_latest"] is not None:
+                lags.append(stats["millis_behind_latest"])
+        # The lag of the stream is the lag of the shard that is most behind (being read now)
+        if len(lags) > 0:
+            totals["millis_behind_latest"] = max(lags)
+        return totals
+
+    def lag(self):
+        # Return the MillisBehindLatest of every shard being read (None before its first call)
+        with self.lock:
+            workers = dict(self.workers)
+        return {shard_id: w.stats()["millis_behind_latest"] for shard_id, w in workers.items()}
@@ -0,0 +1,56 @@
+import time
+import numpy as np
+
+
+"""
+Vectorized handling of message timestamps in the consumers.
+Messages are stamped with integer ns since the epoch (binary messages, or json messages sent with
+--ns_timestamps) or with the legacy str(datetime.datetime.now()) date string, in local time.
+Both are converted to int64 arrays of ns since the epoch, so every delay can be computed with a
+single NumPy operation instead of calling datetime.strptime for every message.
+"""
+
+
+NS_PER_MS = 1000000
+
+
+def local_utc_offset_ns(epoch_ns=None):
+    # Return the offset of the local time zone from UTC (in ns) at epoch_ns (default is now)
+    seconds = None if epoch_ns is None else int(epoch_ns) // 1000000000
+    return time.localtime(seconds).tm_gmtoff * 1000000000
+
+
+def parse_date_strings(strings):
+    # Convert legacy local date strings ('%Y-%m-%d %H:%M:%S.%f') to ns since the epoch, all at once
+    if len(strings) == 0:
+        return np.zeros(0, dtype=np.int64)
+    local_ns = np.array(strings, dtype="datetime64[ns]").astype(np.int64)
+    # The offset of the first timestamp is used for all of them (a capture does not usually cross
+    # a daylight saving time change)
+    return local_ns - local_utc_offset_ns(local_ns[0])
+
+
+def to_ns_array(timestamps):
+    # Convert a list of timestamps (ns integers, legacy date strings or a mix) to an int64 array
+    timestamps = list(timestamps)
+    is_string = np.fromiter((isinstance(t, str) for t in timestamps), dtype=bool,
+                            count=len(timestamps))
+    if not is_string.any():
+        return np.array(timestamps, dtype=np.int64)
+    result = np.zeros(len(timestamps), dtype=np.int64)
+    string_index = np.flatnonzero(is_string)
+    integer_index = np.flatnonzero(~is_string)
+    result[string_index] = parse_date_strings([timestamps[i] for i in string_index])
+    if len(integer_index) > 0:
+        result[integer_index] = np.array([timestamps[i] for i in integer_index], dtype=np.int64)
+    return result
+
+
+def to_datetime64(ns_array):
+    # Convert an array of ns since the epoch to datetime64[ns] (UTC)
+    return np.asarray(ns_array, dtype=np.int64).astype("datetime64[ns]")
+
+
+def delays_ms_between(start_ns, end_ns):
+    # Return the delays between two arrays of ns timestamps, in ms
+    return (np.asarray(end_ns, dtype=np.int64) - np.asarray(start_ns, dtype=np.int64)) / NS_PER_MS
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import concurrent.futures
+import socket
+import time
+from batch_sender import MAX_BYTES_PER_REQUEST, MAX_RECORDS_PER_REQUEST, batch_sender
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from retry_engine import add_retry_arguments, create_retry_engine
+from udp_producer import kernel_drops, set_receive_buffer
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
+
+
+"""
+This program will send all messages received from an UDP connection into a selected stream, like
+udp_producer.py, but using asyncio so a single process can serve many encoder devices.
+It runs three stages linked by bounded queues:
+    * receive: an asyncio DatagramProtocol puts every datagram into the receive queue.
+    * batch:   takes datagrams from the receive queue and groups them into PutRecords batches,
+               sending a batch when it is full or when its oldest datagram has waited --linger ms.
+    * send:    several tasks send batches at the same time (--in_flight), running the blocking
+               boto3 calls in a thread pool.
+When the send stage can not keep up, the batch queue fills, then the receive queue fills, and new
+datagrams are handled with the chosen --overflow policy (drop the newest or the oldest datagram).
+"""
+
+
+OVERFLOW_POLICIES = ["drop_newest", "drop_oldest"]
+
+
+def create_parser():
+    parser = argparse.ArgumentParser("Send messages received from an UDP connection into a "
+                                     "selected stream, using asyncio.")
+    parser.add_argument("-s", "--stream", dest="stream_name", required=True,
+                        help="The stream you'd like to create.", metavar="STREAM_NAME",)
+    parser.add_argument("-r", "--regionName", "--region", dest="region", default="us-east-1",
+                        help="The region you'd like to make this stream in. Default "
+                        "is 'us-east-1'", metavar="REGION_NAME",)
+    parser.add_argument("--ip", dest="ip", default="localhost", help="Connection IP. Default is"
+                        "localhost.", metavar="IP_ADDRESS")
+    parser.add_argument("--port", dest="port", default=9999, type=int, help="Connection port. "
+                        "Default is 9999.", metavar="PORT")
+    parser.add_argument("--rcvbuf", dest="rcvbuf", type=int, default=4 * 1024 * 1024,
+                        help="Size of the socket receive buffer. Default is 4 MB.",
+                        metavar="BYTES",)
+    parser.add_argument("--linger", dest="linger", type=float, default=5,
+                        help="Maximum time a datagram waits before its batch is sent. "
+                        "Default is 5 ms.", metavar="MILLISECONDS",)
+    parser.add_argument("--in_flight", dest="in_flight", type=int, default=4,
+                        help="Number of PutRecords requests sent at the same time. Default is 4.",
+                        metavar="REQUESTS",)
+    parser.add_argument("--queue_size", dest="queue_size", type=int, default=50000,
+                        help="Maximum number of datagrams waiting to be batched. "
+                        "Default is 50000.", metavar="DATAGRAMS",)
+    parser.add_argument("--overflow", dest="overflow", default=OVERFLOW_POLICIES[0],
+                        choices=OVERFLOW_POLICIES, help="What to do with datagrams when the "
+                        "receive queue is full. Options are {}. Default is '{}'.".format(
+                            OVERFLOW_POLICIES, OVERFLOW_POLICIES[0]), metavar="POLICY",)
+    parser.add_argument("--stats", dest="stats_period", type=float, default=10,
+                        help="Period to print statistics. Default is 10 s.", metavar="SECONDS",)
+    add_retry_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_session_arguments(parser)
+    return parser.parse_args()
+
+
+class datagram_receiver(asyncio.DatagramProtocol):
+    # Put every datagram received into a bounded queue, applying the overflow policy when full
+    def __init__(self, queue, overflow="drop_newest"):
+        self.queue = queue
+        self.overflow = overflow
+        self.received = 0
+        self.overflow_drops = 0
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        try:
+            self.queue.put_nowait((data, addr))
+        except asyncio.QueueFull:
+            self.overflow_drops += 1
+            if self.overflow == "drop_oldest":
+                self.queue.get_nowait()
+                self.queue.put_nowait((data, addr))
+
+    def error_received(self, exc):
+        print("Error received in UDP socket: {}.".format(exc))
+
+
+class udp_async_service(object):
+    # Receive, batch and send stages, and their statistics
+    def __init__(self, kinesis_client, stream_name, partitioner, retry, linger_ms=5, in_flight=4,
+                 queue_size=50000, overflow="drop_newest"):
+        # Save inputs
+        self.partitioner = partitioner
+        self.linger_s = linger_ms / 1000.0
+        self.in_flight = max(in_flight, 1)
+        self.queue_size = max(queue_size, 1)
+        self.overflow = overflow
+
+        # The queues that link the stages are created in serve, inside the event loop
+        self.receive_queue = None
+        self.batch_queue = None
+        self.receiver = None
+
+        # Every send task uses its own (not started) batch_sender to send, retry and count
+        self.senders = [batch_sender(kinesis_client, stream_name, retry=retry)
+                        for _ in range(self.in_flight)]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.in_flight)
+        self.batches = 0
+
+    def make_entry(self, data, addr):
+        # Create the PutRecords entry of a datagram, return it with its size
+        # Every address sending datagrams is treated as a different device
+        partition = self.partitioner.partition(device=addr[0])
+        entry = {"Data": data, "PartitionKey": partition["PartitionKey"]}
+        if "ExplicitHashKey" in partition:
+            entry["ExplicitHashKey"] = partition["ExplicitHashKey"]
+        return entry, len(data) + len(entry["PartitionKey"])
+
+    async def batch_stage(self):
+        # Group datagrams into batches that fit in a PutRecords request
+        carry = None
+        while True:
+            if carry is None:
+                carry = self.make_entry(*(await self.receive_queue.get()))
+            batch = [carry]
+            batch_bytes = carry[1]
+            carry = None
+            deadline = time.monotonic() + self.linger_s
+            while len(batch) < MAX_RECORDS_PER_REQUEST:
+                if self.receive_queue.empty():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.receive_queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self.receive_queue.get_nowait()
+                entry = self.make_entry(*item)
+                if batch_bytes + entry[1] > MAX_BYTES_PER_REQUEST:
+                    # It does not fit, it will start the next batch
+                    carry = entry
+                    break
+                batch.append(entry)
+                batch_bytes += entry[1]
+            # Waits here when every send task is busy, which is what fills the receive queue
+            await self.batch_queue.put(batch)
+            self.batches += 1
+
+    async def send_stage(self, sender):
+        # Send batches with a blocking boto3 call in the thread pool
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.batch_queue.get()
+            await loop.run_in_executor(self.executor, sender.send_batch, batch)
+
+    async def stats_stage(self, sock, period):
+        # Print statistics every period seconds
+        initial_drops = kernel_drops(sock)
+        while True:
+            await asyncio.sleep(period)
+            print("Service stats: {}".format(self.stats(sock, initial_drops)))
+
+    def stats(self, sock=None, initial_drops=None):
+        # Return statistics of all stages
+        drops = kernel_drops(sock) if sock is not None else None
+        if drops is not None and initial_drops is not None:
+            drops -= initial_drops
+        stats = {"kernel_drops": drops, "batches": self.batches}
+        if self.receiver is not None:
+            stats.update({"received": self.receiver.received,
+                          "overflow_drops": self.receiver.overflow_drops,
+                          "receive_queue": self.receive_queue.qsize(),
+                          "batch_queue": self.batch_queue.qsize()})
+        for key in ("records_sent", "records_failed", "bytes_sent", "requests"):
+            stats[key] = sum(sender.stats()[key] for sender in self.senders)
+        stats.update(self.senders[0].retry.stats())
+        return stats
+
+    async def serve(self, sock, stats_period=10):
+        # Create the bounded queues and run every stage until cancelled
+        self.receive_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.batch_queue = asyncio.Queue(maxsize=2 * self.in_flight)
+        self.receiver = datagram_receiver(self.receive_queue, overflow=self.overflow)
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: self.receiver, sock=sock)
+        tasks = [asyncio.ensure_future(self.batch_stage()),
+                 asyncio.ensure_future(self.stats_stage(sock, stats_period))]
+        tasks.extend(asyncio.ensure_future(self.send_stage(sender)) for sender in self.senders)
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            transport.close()
+            for task in tasks:
+                task.cancel()
+            self.executor.shutdown(wait=True)
+
+
+def main():
+    args = create_parser()
+
+    # Create and connect to stream
+    stream_name = args.stream_name
+    print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
+        return
+    prewarm(kinesis_client, stream_name, args.prewarm)
+
+    # Choose how records are spread over the shards, and retry throttled records
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key=":)")
+    retry = create_retry_engine(args)
+
+    # Create UDP socket with a big receive buffer
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # SOCK_DGRAM means UDP
+    sock.bind((args.ip, args.port))
+    rcvbuf = set_receive_buffer(sock, args.rcvbuf)
+    print("Listening at {}:{} with a {} bytes receive buffer.".format(args.ip, args.port, rcvbuf))
+
+    # Run service forever
+    service = udp_async_service(kinesis_client, stream_name, partitioner, retry,
+                                linger_ms=args.linger, in_flight=args.in_flight,
+                                queue_size=args.queue_size, overflow=args.overflow)
+    try:
+        asyncio.run(service.serve(sock, stats_period=args.stats_period))
+    except KeyboardInterrupt:
+        print("Ctrl+C interrupt received, stopping service.")
+    print("Service stats: {}".format(service.stats()))
+
+
+if __name__ == '__main__':
+    main()
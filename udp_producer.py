@@ -1,11 +1,20 @@
 import argparse
-import boto3
+import os
+import select
 import socket
 import time
+from batch_sender import add_batch_arguments, batch_sender
+from retry_engine import add_retry_arguments, create_retry_engine
+from partition_keys import add_partition_arguments, add_shards_argument, create_partitioner
+from kinesis_session import add_session_arguments, connect_to_stream, create_kinesis_client, prewarm
 
 
 """
 This program will send all messages received from an UDP connection into a selected stream.
+In gateway mode (--gateway), every time the socket wakes up we read all the datagrams waiting in it
+without blocking, and send them in batches with PutRecords. Datagrams arriving while a batch is
+being sent wait in the kernel receive buffer (which can be made bigger with --rcvbuf) instead of
+being dropped. The datagrams dropped by the kernel and by the gateway are reported periodically.
 """
 
 
@@ -25,44 +34,112 @@ def create_parser():
                         help="Period to wait between every encoder parse and stream transmition. "
                         "If not set, data will be sent as fast as possible.",
                         metavar="MILLISECONDS",)
+    parser.add_argument("--gateway", dest="gateway", action="store_true", help="Use it to read "
+                        "every waiting datagram at once and send them in batches.",)
+    parser.add_argument("--rcvbuf", dest="rcvbuf", type=int, default=4 * 1024 * 1024,
+                        help="Size of the socket receive buffer in gateway mode. Default is 4 MB.",
+                        metavar="BYTES",)
+    parser.add_argument("--max_pending", dest="max_pending", type=int, default=50000,
+                        help="Maximum number of datagrams waiting to be sent in gateway mode, "
+                        "new datagrams are dropped above it. Default is 50000.",
+                        metavar="DATAGRAMS",)
+    parser.add_argument("--stats", dest="stats_period", type=float, default=10,
+                        help="Period to print gateway statistics. Default is 10 s.",
+                        metavar="SECONDS",)
+    add_batch_arguments(parser)
+    add_retry_arguments(parser)
+    add_shards_argument(parser)
+    add_partition_arguments(parser)
+    add_session_arguments(parser)
     return parser.parse_args()
 
 
-def wait_for_stream(kinesis_client, stream_name, sleep_seconds=3):
-    # Wait for the provided stream to become active
-    describe_stream_error = True
-    while describe_stream_error:
-        try:
-            stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-            status = stream_description["StreamDescription"]["StreamStatus"]
-            describe_stream_error = False
-        except KeyError:
-            pass
-    while status != 'ACTIVE':
-        print("Stream '{}' has status {}, sleeping for {} seconds.".format(stream_name, status,
-                                                                           sleep_seconds))
-        time.sleep(sleep_seconds)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-
-
-def connect_to_stream(kinesis_client, stream_name):
-    # Connect to stream, and if it does not exist, create it and wait until it is ACTIVE
+def set_receive_buffer(sock, num_bytes):
+    # Ask for a bigger socket receive buffer and return the size we got (Linux doubles it, and
+    # caps it to net.core.rmem_max)
     try:
-        # The stream does exist already (if no Exception occurs)
-        stream_description = kinesis_client.describe_stream(StreamName=stream_name)
-        status = stream_description["StreamDescription"]["StreamStatus"]
-        if status == "DELETING":
-            print("The stream '{}' is being deleted, please rerun the script.".format(stream_name))
-            return False
-        elif status != "ACTIVE":
-            wait_for_stream(kinesis_client, stream_name)
-    except:
-        # We assume the stream didn't exist so we will try to create it with just one shard
-        print("Creating stream '{}'.".format(stream_name))
-        kinesis_client.create_stream(StreamName=stream_name, ShardCount=1)
-        wait_for_stream(kinesis_client, stream_name)
-    return True
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, num_bytes)
+    except OSError as e:
+        print("Could not set the receive buffer to {} bytes: {}.".format(num_bytes, e))
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+def kernel_drops(sock):
+    # Return the number of datagrams the kernel dropped for this socket because its receive
+    # buffer was full, or None if it can not be known (only available in Linux)
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for table in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(table) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 12 and fields[9] == inode:
+                return int(fields[12])
+    return None
+
+
+class udp_gateway(object):
+    # Drain every datagram waiting in a socket and hand them to a batch_sender
+    def __init__(self, sock, sender, partitioner, max_pending=50000, max_datagram=65535):
+        # Save inputs
+        self.sock = sock
+        self.sender = sender
+        self.partitioner = partitioner
+        self.max_pending = max_pending
+        self.max_datagram = max_datagram
+        self.sock.setblocking(False)
+
+        # Create statistics variables
+        self.received = 0
+        self.gateway_drops = 0
+        self.wakeups = 0
+        self.max_drained = 0
+        self.initial_kernel_drops = kernel_drops(sock)
+
+    def drain(self):
+        # Read every datagram waiting in the socket, return how many were read
+        drained = 0
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(self.max_datagram)
+            except (BlockingIOError, InterruptedError):
+                break
+            drained += 1
+            if self.sender.pending() >= self.max_pending:
+                self.gateway_drops += 1
+                continue
+            # Every address sending datagrams is treated as a different device
+            partition = self.partitioner.partition(device=addr[0])
+            self.sender.put(data, partition["PartitionKey"], partition.get("ExplicitHashKey"))
+        self.received += drained
+        self.wakeups += 1
+        self.max_drained = max(self.max_drained, drained)
+        return drained
+
+    def run(self, stats_period=10):
+        # Wait for datagrams and drain the socket forever, printing statistics periodically
+        next_stats = time.monotonic() + stats_period
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], stats_period)
+            if len(readable) > 0:
+                self.drain()
+            if time.monotonic() >= next_stats:
+                print("Gateway stats: {}".format(self.stats()))
+                next_stats = time.monotonic() + stats_period
+
+    def stats(self):
+        # Return gateway statistics, together with the ones of the sender
+        drops = kernel_drops(self.sock)
+        if drops is not None and self.initial_kernel_drops is not None:
+            drops -= self.initial_kernel_drops
+        stats = {"received": self.received, "gateway_drops": self.gateway_drops,
+                 "kernel_drops": drops, "wakeups": self.wakeups,
+                 "max_drained": self.max_drained}
+        stats.update(self.sender.stats())
+        return stats
 
 
 def main():
@@ -71,32 +148,69 @@ def main():
     # Create and connect to stream
     stream_name = args.stream_name
     print("Connecting to stream '{}' in region '{}'.".format(stream_name, args.region))
-    kinesis_client = boto3.client('kinesis', region_name=args.region)
-    if not connect_to_stream(kinesis_client, stream_name):
+    kinesis_client = create_kinesis_client(args.region, args)
+    if not connect_to_stream(kinesis_client, stream_name, args.shards):
         return
+    prewarm(kinesis_client, stream_name, args.prewarm)
+
+    # Choose how records are spread over the shards of the stream
+    partitioner = create_partitioner(args, kinesis_client, stream_name, default_key=":)")
+
+    # Retry throttled records instead of dropping them
+    retry = create_retry_engine(args)
+
+    # Start thread that sends messages in batches, if requested (the gateway always uses it)
+    sender = None
+    if args.batch or args.gateway:
+        sender = batch_sender(kinesis_client, stream_name, linger_ms=args.linger, retry=retry)
+        sender.start()
 
     # Create UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # SOCK_DGRAM means UDP
     sock.bind((args.ip, args.port))
 
+    # In gateway mode, drain the socket at every wakeup and send datagrams in batches
+    if args.gateway:
+        rcvbuf = set_receive_buffer(sock, args.rcvbuf)
+        print("Gateway listening at {}:{} with a {} bytes receive buffer.".format(args.ip,
+                                                                                   args.port,
+                                                                                   rcvbuf))
+        gateway = udp_gateway(sock, sender, partitioner, max_pending=args.max_pending)
+        try:
+            gateway.run(stats_period=args.stats_period)
+        finally:
+            sender.stop()
+            print("Gateway stats: {}".format(gateway.stats()))
+        return
+
     # Read the encoder and send position to stream
     sleep_s = None if args.period is None else args.period / 1000
-    while True:
-        udp_str, addr = sock.recvfrom(1024)
-        udp_str = udp_str.decode("utf-8")
-
-        # Send into stream
-        try:
-            kinesis_client.put_record(StreamName=stream_name, Data=udp_str, PartitionKey=":)")
-            print("Sending '{}' into stream '{}'.".format(udp_str, stream_name))
-        except Exception as e:
-            print("Encountered an exception while trying to put '{}' into "
-                  "stream '{}'.".format(udp_str, stream_name))
-            print("Exception: {}.".format(e))
-
-        if sleep_s is not None:
-            # print("Sleeping for {} milliseconds.".format(args.period))
-            time.sleep(sleep_s)
+    try:
+        while True:
+            udp_str, addr = sock.recvfrom(1024)
+            udp_str = udp_str.decode("utf-8")
+
+            # Send into stream (or add it to the next batch)
+            try:
+                # Every address sending datagrams is treated as a different device
+                partition = partitioner.partition(device=addr[0])
+                if sender is not None:
+                    sender.put(udp_str, partition["PartitionKey"], partition.get("ExplicitHashKey"))
+                else:
+                    retry.call(kinesis_client.put_record, StreamName=stream_name, Data=udp_str,
+                               **partition)
+                print("Sending '{}' into stream '{}'.".format(udp_str, stream_name))
+            except Exception as e:
+                print("Encountered an exception while trying to put '{}' into "
+                      "stream '{}'.".format(udp_str, stream_name))
+                print("Exception: {}.".format(e))
+
+            if sleep_s is not None:
+                # print("Sleeping for {} milliseconds.".format(args.period))
+                time.sleep(sleep_s)
+    finally:
+        if sender is not None:
+            sender.stop()
 
 
 if __name__ == '__main__':